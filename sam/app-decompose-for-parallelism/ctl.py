@@ -8,6 +8,11 @@ import time
 import json
 import datetime
 import argparse
+import timeit
+import functools
+import contextlib
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
 
 default_sam_config_filename = 'samconfig.toml'
 
@@ -16,6 +21,8 @@ def handler_datetime(field):
         return field.isoformat()
     raise TypeError("Type not recognized")
 
+# The config and the stack don't change while we run, so they are read once per run
+@functools.lru_cache()
 def load_sam_config(file_name = default_sam_config_filename):
     cfg = {}
     try:
@@ -57,15 +64,19 @@ def get_parameter(parameter,file_name = default_sam_config_filename):
     
     return r_val
 
-def describe_stack(file_name = default_sam_config_filename):
+@functools.lru_cache()
+def get_session(file_name = default_sam_config_filename):
     profile = get_parameter('profile',file_name)
-    stack_name = get_parameter('stack_name',file_name)
     region = get_parameter('region',file_name)
+    return boto3.session.Session(profile_name=profile,region_name=region)
+
+@functools.lru_cache()
+def describe_stack(file_name = default_sam_config_filename):
+    stack_name = get_parameter('stack_name',file_name)
     stack = {}
 
     try:
-        boto3.setup_default_session(profile_name=profile,region_name=region)
-        client = boto3.client('cloudformation')
+        client = get_session(file_name).client('cloudformation')
         stack = client.describe_stacks(StackName=stack_name)
     except:
         print("Error: Failed to describe stack {}: {}".format(stack_name,sys.exc_info()[0]))
@@ -110,7 +121,6 @@ def process_execution_description(execution_description):
     return(execution_description)
 
 def cmd_create_dashboard(cli_args):
-    profile = get_parameter('profile')
     region = get_parameter('region')
 
     dashboard_json = ''
@@ -129,8 +139,7 @@ def cmd_create_dashboard(cli_args):
 
 
     try:
-        boto3.setup_default_session(profile_name=profile,region_name=region)
-        client = boto3.client('cloudwatch')
+        client = get_session().client('cloudwatch')
         client.put_dashboard(
             DashboardName='{}Summary-{}'.format(metrics_namespace,region),
             DashboardBody=dashboard_json
@@ -148,9 +157,6 @@ def cmd_run_smoke_test(cli_args):
     except:
         iteration_count = 1
 
-    profile = get_parameter('profile')
-    region = get_parameter('region')
-
     state_machine_arn = get_output_value('StateMachineMain')
 
     if state_machine_arn == '':
@@ -162,8 +168,7 @@ def cmd_run_smoke_test(cli_args):
     exec_input = {'iteration_count': iteration_count}
     exec_name = "smoketest_{}iterations_{}".format(iteration_count,int(time.time()))
     try:
-        boto3.setup_default_session(profile_name=profile,region_name=region)
-        client = boto3.client('stepfunctions')
+        client = get_session().client('stepfunctions')
         start_time = time.time()
         test_execution = client.start_execution(stateMachineArn=state_machine_arn,input=json.dumps(exec_input),name=exec_name)
         print("Started execution test execution {} at {} with input {}".format(test_execution['executionArn'],start_time,exec_input))
@@ -188,6 +193,135 @@ def cmd_run_smoke_test(cli_args):
         # Just pring an error and continue
         print("Error: Failed to execute {}: {}".format(test_execution['executionArn'],sys.exc_info()))
 
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+# The load test makes its boto3 calls on a bounded pool of threads, one client shared by all of them. All
+# executions are started first, then the ones still running are described in rounds until they finish
+default_load_test_threads = 32
+
+def run_load_test(state_machine_arn, execution_count, iteration_count, poll_seconds, threads):
+    client = get_session().client('stepfunctions', config=Config(
+        max_pool_connections=threads, retries={'max_attempts': 10, 'mode': 'adaptive'}))
+
+    exec_input = json.dumps({'iteration_count': iteration_count})
+    run_id = int(time.time())
+    results = []
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        starts = [
+            executor.submit(client.start_execution, stateMachineArn=state_machine_arn, input=exec_input,
+                name="loadtest_{}iterations_{}_{}".format(iteration_count, run_id, i))
+            for i in range(execution_count)
+        ]
+        running = []
+        for future in starts:
+            try:
+                running.append(future.result()['executionArn'])
+            except Exception as e:
+                results.append(e)
+
+        while running:
+            time.sleep(poll_seconds)
+            descriptions = [executor.submit(client.describe_execution, executionArn=arn) for arn in running]
+            running = []
+            for future in descriptions:
+                try:
+                    execution_description = future.result()
+                except Exception as e:
+                    results.append(e)
+                    continue
+                if execution_description['status'] == 'RUNNING':
+                    running.append(execution_description['executionArn'])
+                else:
+                    results.append(execution_description)
+    return results
+
+def cmd_run_load_test(cli_args):
+
+    try:
+        execution_count = int(cli_args[0])
+    except:
+        print("Error: usage: run_load_test <execution count> [iteration count] [poll seconds] [threads]")
+        exit()
+
+    iteration_count = int(cli_args[1]) if len(cli_args) > 1 else 1
+    poll_seconds = float(cli_args[2]) if len(cli_args) > 2 else 2
+    threads = int(cli_args[3]) if len(cli_args) > 3 else default_load_test_threads
+
+    state_machine_arn = get_output_value('StateMachineMain')
+    if state_machine_arn == '':
+        print("Error: Failed to find statemachine arn in output: {}".format(get_stack_output()))
+        exit()
+
+    print("Starting {} executions of {} with {} iterations each".format(execution_count, state_machine_arn, iteration_count))
+    start_time = time.time()
+    results = run_load_test(state_machine_arn, execution_count, iteration_count, poll_seconds, threads)
+    elapsed = time.time() - start_time
+
+    # Latency is measured by Step Functions from start to stop, so it doesn't depend on how often we poll
+    statuses = {}
+    latencies = []
+    errors = []
+    for result in results:
+        if isinstance(result, Exception):
+            errors.append(repr(result))
+            continue
+        statuses[result['status']] = statuses.get(result['status'], 0) + 1
+        latencies.append((result['stopDate'] - result['startDate']).total_seconds())
+
+    report = {
+        'executions': execution_count,
+        'iteration_count': iteration_count,
+        'statuses': statuses,
+        'client_errors': errors[:10],
+        'elapsed_seconds': round(elapsed, 3),
+        'executions_per_second': round(len(latencies) / elapsed, 3),
+    }
+    if latencies:
+        report.update({
+            'latency_p50_seconds': round(percentile(latencies, 50), 3),
+            'latency_p95_seconds': round(percentile(latencies, 95), 3),
+            'latency_p99_seconds': round(percentile(latencies, 99), 3),
+            'latency_max_seconds': round(max(latencies), 3),
+        })
+    print(json.dumps(report, indent=2))
+
+    # A non-zero exit code lets a pipeline fail the load test
+    if errors or statuses.get('SUCCEEDED', 0) < execution_count:
+        sys.exit(1)
+
+def cmd_bench_result_extraction(cli_args):
+    from functions.get_test_results_from_state_machine_output import app
+
+    output_mb = float(cli_args[0]) if len(cli_args) > 0 else 1
+
+    # A test result like the ones startExecution.sync:2 hands the result recorder, with an output of about output_mb
+    output = {'test_results': {
+        'result{}'.format(i): {'detail': {'Status': 'DONE', 'values': {'a': i, 'b': 'x' * 50}}}
+        for i in range(int(output_mb * 1024 * 1024 / 90))
+    }}
+    succeeded = {
+        'ExecutionArn': 'arn:aws:states:us-east-1:123456789012:execution:SimpleWait:test1',
+        'Input': {'test-run-id': 'bench', 'test-number': 1},
+        'Name': 'test1',
+        'Output': output,
+        'StartDate': 1600000000000,
+        'StateMachineArn': 'arn:aws:states:us-east-1:123456789012:stateMachine:SimpleWait',
+        'Status': 'SUCCEEDED',
+        'StopDate': 1600000001000
+    }
+    failed = dict(succeeded, Status='FAILED', Input=json.dumps(succeeded['Input']), Output=json.dumps(output))
+    events = {
+        'succeeded': succeeded,
+        'failed': {'Error': 'States.TaskFailed', 'Cause': json.dumps(failed)}
+    }
+
+    for name, event in events.items():
+        with contextlib.redirect_stdout(None):
+            seconds = min(timeit.repeat(lambda: app.lambda_handler(event, None), number=10, repeat=3)) / 10
+        print("{}: {:.3f} ms per event with a {} MB output".format(name, seconds * 1000, output_mb))
+
 def cmd_print_entry_point(cli_args):
     print(get_output_value('StateMachineMain'))
 
@@ -196,6 +330,8 @@ if __name__ == "__main__":
     # Available commands to be run along with a description of each
     commands = {
         'run_smoke_test': (cmd_run_smoke_test,"Run a smoke test"),
+        'run_load_test': (cmd_run_load_test,"Run <execution count> executions at the same time and report their latency"),
+        'bench_result_extraction': (cmd_bench_result_extraction,"Time the result recorder's extraction on [size] MB outputs"),
         'print_entry_point': (cmd_print_entry_point,"Print the ARN of the entry point statemachine for this app"),
         'create_dashboard': (cmd_create_dashboard,"Create a dashboard for monitoring the app")
     }
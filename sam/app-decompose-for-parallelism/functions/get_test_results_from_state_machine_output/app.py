@@ -1,7 +1,59 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 import json
+import os
 import sys
+import zlib
+from collections import deque
+
+# The event is the result of startExecution.sync:2, so the fields are almost always at these paths. Each
+# field lists the paths to try in the order the breadth first walk below would have found them
+idx = {
+    "StartDate": ["TestStartTimeEpoch",'','str',[("StartDate",)]],
+    "StopDate": ["TestEndTimeEpoch",'','str',[("StopDate",)]],
+    "Status": ["TestStatus",'','str',[("Status",)]],
+    "StateMachineArn": ["StateMachineArn",'','str',[("StateMachineArn",)]],
+    "Name": ["Iteration",'','str',[("Name",)]],
+    "test-run-id": ["test-run-id",'unknown','str',[("test-run-id",),("Input","test-run-id")]]
+}
+
+missing = object()
+
+def convert(val, k_info):
+    if k_info[2] == 'str':
+        val = str(val)
+    elif k_info[2] == 'int':
+        val = int(val)
+    return val
+
+def lookup(item, path):
+    for key in path:
+        if isinstance(item, str):
+            # In the Cause of a failure the Input is still a JSON string, we only parse it when we need it
+            try:
+                item = json.loads(item)
+            except ValueError:
+                return missing
+        if not isinstance(item, dict) or key not in item:
+            return missing
+        item = item[key]
+    return item
+
+def walk(event, res, remaining):
+    # The fields that weren't at their usual path are searched breadth first, stopping as soon as all are found
+    list_to_process = deque([event])
+    while list_to_process and remaining:
+        this_item = list_to_process.popleft()
+        if isinstance(this_item,dict):
+            for key in this_item:
+                if key in idx:
+                    k_info = idx[key]
+                    if res[k_info[0]] == '':
+                        res[k_info[0]] = convert(this_item[key], k_info)
+                        if res[k_info[0]] != '':
+                            remaining.discard(key)
+                elif isinstance(this_item[key],dict):
+                    list_to_process.append(this_item[key])
 
 def lambda_handler(event, context):
 
@@ -9,7 +61,6 @@ def lambda_handler(event, context):
     if 'Cause' in event:
         print("Looks like a failure. Parsing out the info I need from the Cause field.")
         event = json.loads(event['Cause'])
-        event['Input'] = json.loads(event['Input'])
 
     # Intiailize an object to populate for the result
     res = {
@@ -25,38 +76,24 @@ def lambda_handler(event, context):
         "Iteration": ""
     }
 
-    idx = {
-        "StartDate": ["TestStartTimeEpoch",'','str'],
-        "StopDate": ["TestEndTimeEpoch",'','str'],
-        "Status": ["TestStatus",'','str'],
-        "StateMachineArn": ["StateMachineArn",'','str'],
-        "Name": ["Iteration",'','str'],
-        "test-run-id": ["test-run-id",'unknown','str']
-    }
-
-    list_to_process = [event]
-    while len(list_to_process) > 0:
-        this_item = list_to_process.pop(0)
-        if isinstance(this_item,dict):
-            for key in this_item:
-                #print("Looking at {} in {}".format(key,this_item))
-                if key in idx:
-                    k_info = idx[key]
-                    if res[k_info[0]] == '':
-                        val = this_item[key]
-                        #print("\t!!!Found key {}".format(key))                      
-                        if k_info[2] == 'str':
-                            val = str(val)
-                        elif k_info[2] == 'int':
-                            val = int(val)
-                        res[k_info[0]] = val
-                elif isinstance(this_item[key],dict):
-                    #print("\tValue is a dict, so adding to the list for further processing")
-                    list_to_process.append(this_item[key])
+    remaining = set()
+    for key, k_info in idx.items():
+        for path in k_info[3]:
+            val = lookup(event, path)
+            if val is not missing and convert(val, k_info) != '':
+                res[k_info[0]] = convert(val, k_info)
+                break
+        else:
+            remaining.add(key)
 
+    if remaining:
+        print("Searching the event for {}".format(sorted(remaining)))
+        if isinstance(event.get('Input'), str):
+            event['Input'] = json.loads(event['Input'])
+        walk(event, res, remaining)
 
     # Update additional properties based on the ones extracted above
-    res["TestDurationMs"] = str(int(res["TestEndTimeEpoch"]) - int(res["TestStartTimeEpoch"])  )  
+    res["TestDurationMs"] = str(int(res["TestEndTimeEpoch"]) - int(res["TestStartTimeEpoch"])  )
     res["TestName"] = res["StateMachineArn"].split(':')[-1]
 
     if res["TestStatus"] == "SUCCEEDED":
@@ -66,4 +103,20 @@ def lambda_handler(event, context):
         res["TestFaultMetricValue"] = 1
         res["TestSuccessMetricValue"] = 0
 
-    return res
\ No newline at end of file
+    # The metrics of this test. The distributor publishes the metrics of all of its tests with one call, later, so
+    # they carry the time the test ended (epoch milliseconds) and are recorded at that time
+    dimensions = [{"Name": "TestName", "Value": res["TestName"]}]
+    timestamp = int(res["TestEndTimeEpoch"])
+    res["Metrics"] = [{"MetricName": "TestSuccess", "Dimensions": dimensions, "Unit": "None", "Value": res["TestSuccessMetricValue"], "Timestamp": timestamp}]
+    if res["TestStatus"] == "SUCCEEDED":
+        res["Metrics"].insert(0, {"MetricName": "TestDuration", "Dimensions": dimensions, "Unit": "Milliseconds", "Value": res["TestDurationMs"], "Timestamp": timestamp})
+
+    # The recorder stores the result under this key. With result_shards above 1 the results of a test run are spread
+    # over that many keys, so they aren't all written to one partition and the report can read them in parallel
+    res["TestRunShardKey"] = res["test-run-id"]
+    result_shards = int(os.environ.get('result_shards', '1'))
+    if result_shards > 1:
+        shard = zlib.crc32(res["Iteration"].encode('utf-8')) % result_shards
+        res["TestRunShardKey"] = "{}#{}".format(res["test-run-id"], shard)
+
+    return res
@@ -1,59 +1,107 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 import json
+import math
+import os
+import shutil
+import tempfile
 import boto3
 from boto3.dynamodb.conditions import Key
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
 
-client = boto3.client('dynamodb')
+# How many partition keys of a sharded test run are queried at the same time
+max_query_concurrency = 32
 
-def lambda_handler(event, context):
-    
-    ip = event["Input"]
-    table_name = ip["table_name"]
-    test_run_id = ip["event_run_id"]
-    
-    print("Querying for results for test_run_id {}".format(test_run_id))
-    response = client.query(
-        TableName = table_name ,
-        KeyConditions  = {
-            'TestRunId': {
-                "ComparisonOperator":"EQ",
-                'AttributeValueList': [{'S': test_run_id }]
-                
-            }
-        }
-    )
-    
-    items = response["Items"]
-    
-    # Dymamo will limit responses to 1 MB in size. If there is more data to get, the LastEvaluatedKey will indicate this and can be used to get the next batch
-    while 'LastEvaluatedKey' in response:
-        print("\tGetting batch of results for test_run_id {}".format(test_run_id))
-        response = client.query(
-            TableName = table_name ,
-            KeyConditions  = {
-                'TestRunId': {
-                    "ComparisonOperator":"EQ",
-                    'AttributeValueList': [{'S': test_run_id }]
-                    
-                }
-            },
-            ExclusiveStartKey=response['LastEvaluatedKey']
-        )
-        items.extend(response['Items'])
-
-    test_count = 0
-    successful_tests = 0
-    failed_tests = 0
-    fastest_test = -1
-    slowest_test = -1
-    total_test_time = 0
-
-    print("Processing results for test_run_id {}".format(test_run_id))
-    max_size = 240 * 1024
-    results_truncated = False
-    res = []
-    for i in items:
+client = boto3.client('dynamodb', config = Config(max_pool_connections = max_query_concurrency))
+s3_client = boto3.client('s3')
+
+# The report is returned to the state machine, so the results listed in it have to stay below the 256 KB payload limit
+max_size = 240 * 1024
+
+# Durations are summarized with a sketch that answers quantiles within this relative error
+sketch_accuracy = 0.01
+
+class DurationSketch:
+    # A log-bucketed histogram, the idea behind DDSketch. Every bucket holds the durations within sketch_accuracy
+    # of each other, so memory depends on the range of the durations and not on how many there are. Sketches of
+    # different pages (or different readers) merge by adding up their buckets
+
+    def __init__(self, accuracy = sketch_accuracy):
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if value <= 0:
+            self.zeros += 1
+        else:
+            index = math.ceil(math.log(value) / self.log_gamma)
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.zeros += other.zeros
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def quantile(self, q):
+        if self.count == 0:
+            return -1
+        rank = int(q * (self.count - 1))
+        seen = self.zeros
+        if rank < seen:
+            return 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                # the middle of the bucket, within sketch_accuracy of every duration in it
+                return round(2 * self.gamma ** index / (self.gamma + 1))
+
+def get_s3_bucket():
+    # The bucket to write full results to comes from an environment variable
+    for k in os.environ:
+        if k.lower() == 's3bucket':
+            return os.environ[k]
+    return ''
+
+def get_result_shards():
+    # How many keys the recorder spreads the results of a test run over, see get_test_results_from_state_machine_output
+    return int(os.environ.get('result_shards', '1'))
+
+class ReportPart:
+    # The aggregates of the results read from one partition key. The parts of a sharded test run are read at the
+    # same time and merged into the report
+
+    def __init__(self):
+        self.test_count = 0
+        self.successful_tests = 0
+        self.failed_tests = 0
+        self.fastest_test = -1
+        self.slowest_test = -1
+        self.total_test_time = 0
+        self.sketch = DurationSketch()
+
+        self.results_truncated = False
+        self.res = []
+        self.res_size = len('[]')
+
+        # Every row is also written to a spill file. If the results don't fit in the report, the file goes to S3
+        self.spill = tempfile.SpooledTemporaryFile(max_size = 4 * 1024 * 1024, mode = 'w+b')
+
+    def add_result(self, row, row_json):
+        # The row is serialized once, its size is added to the size of the list so far
+        if self.results_truncated == False:
+            if self.res_size < max_size:
+                self.res.append(row)
+                self.res_size += len(row_json) + (len(', ') if len(self.res) > 1 else 0)
+            else:
+                self.results_truncated = True
+
+    def add(self, i):
         row = {"TestId": '', "TestName": '', "TestStatus": '', "TestDurationMs": 0}
         row["TestId"] = i["TestId"]["S"].split(':')[-1]
         row["TestName"] = i["TestName"]["S"]
@@ -61,41 +109,119 @@ def lambda_handler(event, context):
         row["TestDurationMs"] = int(i["TestDurationMs"]["N"])
 
         # maintain summary info
-        test_count += 1
-        total_test_time += row["TestDurationMs"]
+        self.test_count += 1
+        self.total_test_time += row["TestDurationMs"]
+        self.sketch.add(row["TestDurationMs"])
         if 'SUCCE' in row["TestStatus"].upper():
-            successful_tests += 1
+            self.successful_tests += 1
         else:
-            failed_tests += 1
+            self.failed_tests += 1
 
-        if fastest_test == -1 or fastest_test > row["TestDurationMs"]:
-            fastest_test = row["TestDurationMs"]
-        
-        if slowest_test == -1 or slowest_test < row["TestDurationMs"]:
-            slowest_test = row["TestDurationMs"]
+        if self.fastest_test == -1 or self.fastest_test > row["TestDurationMs"]:
+            self.fastest_test = row["TestDurationMs"]
+
+        if self.slowest_test == -1 or self.slowest_test < row["TestDurationMs"]:
+            self.slowest_test = row["TestDurationMs"]
+
+        row_json = json.dumps(row).encode('utf-8')
+        self.spill.write(row_json + b'\n')
+        self.add_result(row, row_json)
+
+    def merge(self, other):
+        self.test_count += other.test_count
+        self.successful_tests += other.successful_tests
+        self.failed_tests += other.failed_tests
+        self.total_test_time += other.total_test_time
+        self.sketch.merge(other.sketch)
+        for test in (other.fastest_test, other.slowest_test):
+            if test != -1:
+                if self.fastest_test == -1 or self.fastest_test > test:
+                    self.fastest_test = test
+                if self.slowest_test == -1 or self.slowest_test < test:
+                    self.slowest_test = test
+
+        for row in other.res:
+            self.add_result(row, json.dumps(row).encode('utf-8'))
+        if other.results_truncated:
+            self.results_truncated = True
+
+        other.spill.seek(0)
+        shutil.copyfileobj(other.spill, self.spill)
+        other.spill.close()
+
+def read_part(table_name, key):
+    part = ReportPart()
+
+    # Dymamo will limit responses to 1 MB in size. The paginator follows LastEvaluatedKey, and every page is
+    # processed as it arrives instead of collecting all of them first. We only read the attributes we report
+    paginator = client.get_paginator('query')
+    pages = paginator.paginate(
+        TableName = table_name ,
+        KeyConditions  = {
+            'TestRunId': {
+                "ComparisonOperator":"EQ",
+                'AttributeValueList': [{'S': key }]
+
+            }
+        },
+        ProjectionExpression = 'TestId, TestName, TestStatus, TestDurationMs'
+    )
+
+    for page in pages:
+        print("\tProcessing batch of {} results for {}".format(len(page['Items']), key))
+        for i in page['Items']:
+            part.add(i)
+
+    return part
+
+def lambda_handler(event, context):
+
+    ip = event["Input"]
+    table_name = ip["table_name"]
+    test_run_id = ip["event_run_id"]
+
+    # A query reads one partition key a page at a time. When the results are sharded, every shard is queried at
+    # the same time. The unsharded key is always read too, it holds the results recorded without shards
+    keys = [test_run_id]
+    result_shards = get_result_shards()
+    if result_shards > 1:
+        keys += ['{}#{}'.format(test_run_id, shard) for shard in range(result_shards)]
+
+    print("Querying for results for test_run_id {} from {} keys".format(test_run_id, len(keys)))
+    with ThreadPoolExecutor(max_workers = min(len(keys), max_query_concurrency)) as executor:
+        parts = list(executor.map(lambda key: read_part(table_name, key), keys))
+
+    report = parts[0]
+    for part in parts[1:]:
+        report.merge(part)
 
-        if results_truncated == False:           
-            if len(json.dumps(res).encode('utf-8')) < max_size:
-                res.append(row)
-            else:
-                results_truncated = True
-    
     average_duration = -1
-    if test_count > 0:
-        average_duration = total_test_time / test_count
+    if report.test_count > 0:
+        average_duration = report.total_test_time / report.test_count
 
     summary = {
-        'test_count': test_count,
-        'successful_count': successful_tests,
-        'failed_count': failed_tests,
+        'test_count': report.test_count,
+        'successful_count': report.successful_tests,
+        'failed_count': report.failed_tests,
         'average_duration_ms': average_duration,
-        'fastest_test_ms': fastest_test,
-        'slowest_test_ms': slowest_test, 
-        'results_truncated': results_truncated
+        'fastest_test_ms': report.fastest_test,
+        'slowest_test_ms': report.slowest_test,
+        'p50_duration_ms': report.sketch.quantile(0.5),
+        'p90_duration_ms': report.sketch.quantile(0.9),
+        'p99_duration_ms': report.sketch.quantile(0.99),
+        'results_truncated': report.results_truncated
     }
 
-    
+    resp = {'summary': summary,'test_results': report.res}
 
-    resp = {'summary': summary,'test_results': res}
+    # Instead of losing the results that didn't fit, all of them are written to S3 as JSON lines
+    s3_bucket = get_s3_bucket()
+    if report.results_truncated and s3_bucket != '':
+        s3_key = 'test_results/{}.jsonl'.format(test_run_id.split(':')[-1])
+        print("Writing all {} results to s3://{}/{}".format(report.test_count, s3_bucket, s3_key))
+        report.spill.seek(0)
+        s3_client.upload_fileobj(report.spill, s3_bucket, s3_key)
+        resp['results_location'] = {'s3_bucket': s3_bucket, 's3_key': s3_key}
+    report.spill.close()
 
     return resp
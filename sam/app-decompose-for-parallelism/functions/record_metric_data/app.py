@@ -1,35 +1,148 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
+import json
+import os
+import time
 import boto3
+from datetime import datetime, timezone
 from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+
+# How many put_metric_data calls are sent at the same time
+publish_concurrency = 8
 
 # Set a low number of retries for Metrics so that this will fall back to SFN retries more quickly
 config = Config (
     retries=dict(
         max_attempts=2
-    )
+    ),
+    max_pool_connections=publish_concurrency
 )
 cloudwatch = boto3.client('cloudwatch',config=config)
 
+# put_metric_data takes up to 1000 datums and 1 MB per call, and up to 150 distinct values per datum. Requests are
+# cut well below 1 MB using a rough estimate of their encoded size
+max_datums_per_call = 1000
+max_values_per_datum = 150
+max_call_bytes = 800 * 1024
+datum_bytes = 300
+value_bytes = 80
+
+# An Embedded Metric Format log event holds up to 100 values per metric
+max_emf_values = 100
+
+# Metrics carry the time their test ended as a Timestamp in epoch milliseconds, so they are recorded when the test
+# ran and not when they are published. CloudWatch keeps standard resolution metrics per minute, so values are
+# grouped by the minute they belong to
+timestamp_resolution_ms = 60 * 1000
+
+def get_mode(event):
+    # 'api' publishes with put_metric_data, 'emf' prints Embedded Metric Format logs that CloudWatch turns into metrics
+    return event.get('Mode', os.environ.get('metrics_mode', 'api')).lower()
+
+def iter_metrics(item):
+    # Input is one metric, a list of metrics, or the output of a Map state whose iterations each return their Metrics
+    if isinstance(item, list):
+        for i in item:
+            yield from iter_metrics(i)
+    elif isinstance(item, dict):
+        if 'MetricName' in item:
+            yield item
+        elif 'Metrics' in item:
+            yield from iter_metrics(item['Metrics'])
+
+def get_minute(metric):
+    # The minute of the metric's Timestamp in epoch milliseconds, None when it has none
+    if metric.get('Timestamp') is None:
+        return None
+    return int(metric['Timestamp']) // timestamp_resolution_ms * timestamp_resolution_ms
+
+def group_metrics(metrics, namespace):
+    # Metrics with the same name, dimensions, unit and minute become one datum, with a count for every distinct value
+    groups = {}
+    for m in metrics:
+        val = m['Value']
+        if (isinstance(val, str)):
+            val = float(val)
+        key = (m.get('Namespace', namespace), m['MetricName'], json.dumps(m.get('Dimensions', []), sort_keys=True), m.get('Unit', 'None'), get_minute(m))
+        counts = groups.setdefault(key, {})
+        counts[val] = counts.get(val, 0) + 1
+    return groups
+
+def build_datums(groups):
+    datums = {}
+    for (namespace, metric_name, dimensions, unit, minute), counts in groups.items():
+        values = list(counts.items())
+        for i in range(0, len(values), max_values_per_datum):
+            chunk = values[i:i + max_values_per_datum]
+            datum = {
+                'MetricName': metric_name,
+                'Dimensions': json.loads(dimensions),
+                'Unit': unit,
+                'Values': [v for v, c in chunk],
+                'Counts': [c for v, c in chunk]
+            }
+            if minute is not None:
+                datum['Timestamp'] = datetime.fromtimestamp(minute / 1000, tz=timezone.utc)
+            datums.setdefault(namespace, []).append(datum)
+    return datums
+
+def build_requests(datums):
+    requests = []
+    for namespace, namespace_datums in datums.items():
+        request = []
+        size = 0
+        for datum in namespace_datums:
+            this_size = datum_bytes + value_bytes * len(datum['Values'])
+            if request and (len(request) >= max_datums_per_call or size + this_size > max_call_bytes):
+                requests.append((namespace, request))
+                request = []
+                size = 0
+            request.append(datum)
+            size += this_size
+        if request:
+            requests.append((namespace, request))
+    return requests
+
+def emit_emf(groups):
+    lines = 0
+    for (namespace, metric_name, dimensions, unit, minute), counts in groups.items():
+        dimensions = json.loads(dimensions)
+        values = [v for v, c in counts.items() for _ in range(c)]
+        for i in range(0, len(values), max_emf_values):
+            document = {
+                '_aws': {
+                    'Timestamp': minute if minute is not None else int(time.time() * 1000),
+                    'CloudWatchMetrics': [{
+                        'Namespace': namespace,
+                        'Dimensions': [[d['Name'] for d in dimensions]],
+                        'Metrics': [{'Name': metric_name, 'Unit': unit}]
+                    }]
+                },
+                metric_name: values[i:i + max_emf_values]
+            }
+            for d in dimensions:
+                document[d['Name']] = d['Value']
+            print(json.dumps(document))
+            lines += 1
+    return lines
+
 def lambda_handler(event, context):
-    
+
     # Get Input
-    input = event['Input']
-    
-    val = input['Value']
-    if (isinstance(val, str)):
-        val = int(val)
-
-    # Create object with metric data. 
-    MetricData = [
-        {
-            'MetricName': input['MetricName'],
-            'Dimensions': input['Dimensions'],
-            'Unit': input['Unit'],
-            'Value': val
-        }
-        
-    ]
-    print(MetricData)
-    
-    response = cloudwatch.put_metric_data(MetricData = MetricData,Namespace = input['Namespace'])
\ No newline at end of file
+    metrics = list(iter_metrics(event['Input']))
+    groups = group_metrics(metrics, event.get('Namespace'))
+
+    if get_mode(event) == 'emf':
+        lines = emit_emf(groups)
+        return {'metrics': len(metrics), 'emf_events': lines}
+
+    # Create the metric data, packed into as few calls as the API allows, and send the calls concurrently
+    requests = build_requests(build_datums(groups))
+    print("Publishing {} metrics in {} calls".format(len(metrics), len(requests)))
+    with ThreadPoolExecutor(max_workers=publish_concurrency) as executor:
+        futures = [executor.submit(cloudwatch.put_metric_data, MetricData = MetricData, Namespace = namespace) for namespace, MetricData in requests]
+        for future in futures:
+            future.result()
+
+    return {'metrics': len(metrics), 'calls': len(requests)}
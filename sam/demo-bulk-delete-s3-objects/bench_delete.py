@@ -0,0 +1,232 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""Benchmark the bulk delete pipelines locally.
+
+Fills a bucket with keys in one of several layouts, then deletes them twice: with the single lister the
+state machine used to run (one ItemReader listing, delete_objects batches of 1000 at MaxConcurrency 5),
+and with the sharded pipeline (shard_keyspace, then delete_shard per shard at MaxConcurrency 100). Prints
+objects/sec for both, and the shards, list calls and estimate of the sharding step.
+
+Two backends are available:
+  moto  moto's in-memory S3. It lists in time proportional to the size of the bucket, about 3.5 s per
+        call at 1M keys, so its numbers show the number of calls more than the pipelines' concurrency.
+        Every list call copies the keys of the bucket, so only MOTO_LIST_CONCURRENCY of them run at once.
+  fake  a sorted list of keys that only adds latency per call (--list-ms, --delete-ms).
+
+Run it from this directory with "python3 bench_delete.py --backend moto --keys 1000000", it needs moto.
+At 1M keys moto needs a few GB per bucket, "--pipeline" runs one pipeline per process.
+The module is not deployed.
+"""
+import argparse
+import bisect
+import importlib.util
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+
+import boto3
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+OLD_MAX_CONCURRENCY = 5
+SHARD_MAX_CONCURRENCY = 100
+MOTO_LIST_CONCURRENCY = 4
+
+
+def layout_keys(layout, count):
+    """count keys in one of the layouts, sorted."""
+    rng = random.Random(7)
+    if layout == "hex":
+        return sorted(uuid.UUID(int=rng.getrandbits(128)).hex for _ in range(count))
+    if layout == "gsod":
+        # GSOD-like, a folder per year and station files in it
+        return sorted(f"{year}/{station:011d}.csv" for year in range(1929, 2023) for station in rng.sample(range(10 ** 11), count // 94))
+    if layout == "sequence":
+        # a few folders of sequence numbers, like YYYY/NNNNNN.csv
+        return [f"{year}/{n:06d}.csv" for year in range(2015, 2023) for n in range(count // 8)]
+    raise ValueError(f"Unknown layout {layout}")
+
+
+def load_function(name):
+    """Import functions/<name>/app.py as its own module, both functions are called app."""
+    spec = importlib.util.spec_from_file_location(name, os.path.join(HERE, "functions", name, "app.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class FakeS3:
+    """A sorted list of keys that answers list_objects_v2 and delete_objects after a fixed latency."""
+
+    def __init__(self, keys, list_ms, delete_ms):
+        self.keys = keys
+        self.deleted = set()
+        self.lock = threading.Lock()
+        self.list_seconds = list_ms / 1000
+        self.delete_seconds = delete_ms / 1000
+
+    def list_objects_v2(self, Bucket, Prefix="", StartAfter="", MaxKeys=1000, ContinuationToken=None):
+        time.sleep(self.list_seconds)
+        start_after = ContinuationToken or StartAfter
+        index = bisect.bisect_right(self.keys, start_after) if start_after >= Prefix else bisect.bisect_left(self.keys, Prefix)
+        contents = []
+        with self.lock:
+            while index < len(self.keys) and len(contents) < MaxKeys and self.keys[index].startswith(Prefix):
+                if self.keys[index] not in self.deleted:
+                    contents.append({"Key": self.keys[index]})
+                index += 1
+            truncated = index < len(self.keys) and self.keys[index].startswith(Prefix)
+        response = {"IsTruncated": truncated, "KeyCount": len(contents)}
+        if contents:
+            response["Contents"] = contents
+        if truncated:
+            response["NextContinuationToken"] = contents[-1]["Key"]
+        return response
+
+    def delete_objects(self, Bucket, Delete):
+        time.sleep(self.delete_seconds)
+        with self.lock:
+            self.deleted.update(item["Key"] for item in Delete["Objects"])
+        return {}
+
+    def empty(self):
+        return len(self.deleted) == len(self.keys)
+
+
+class MotoS3:
+    """moto's S3, filled through its backend because put_object through boto3 takes an hour for 1M keys."""
+
+    def __init__(self, keys):
+        from moto import mock_aws
+        from moto.core import DEFAULT_ACCOUNT_ID
+        from moto.s3.models import s3_backends
+
+        self.mock = mock_aws()
+        self.mock.start()
+        self.client = boto3.client("s3")
+        self.client.create_bucket(Bucket="bench")
+        backend = s3_backends[DEFAULT_ACCOUNT_ID]["aws"]
+        for key in keys:
+            backend.put_object("bench", key, b"")
+
+    def empty(self):
+        return self.client.list_objects_v2(Bucket="bench", MaxKeys=1).get("KeyCount", 0) == 0
+
+
+class Counted:
+    """Counts the list calls made through a client, and runs up to concurrency of them at once."""
+
+    def __init__(self, client, concurrency=None):
+        self.client = client
+        self.lists = 0
+        self.slots = threading.BoundedSemaphore(concurrency) if concurrency else None
+
+    def list_objects_v2(self, **kwargs):
+        self.lists += 1
+        if not self.slots:
+            return self.client.list_objects_v2(**kwargs)
+        with self.slots:
+            return self.client.list_objects_v2(**kwargs)
+
+    def delete_objects(self, **kwargs):
+        return self.client.delete_objects(**kwargs)
+
+
+class Context:
+    """A Lambda context that never runs out of time."""
+
+    def get_remaining_time_in_millis(self):
+        return 900000
+
+
+def delete_single_lister(client, bucket):
+    """The old pipeline: the ItemReader lists every key, batches of 1000 are deleted 5 at a time."""
+    deleted = 0
+    with ThreadPoolExecutor(max_workers=OLD_MAX_CONCURRENCY) as executor:
+        slots = threading.BoundedSemaphore(OLD_MAX_CONCURRENCY * 2)
+        futures = []
+        kwargs = {"Bucket": bucket, "MaxKeys": 1000}
+        while True:
+            response = client.list_objects_v2(**kwargs)
+            keys = [{"Key": item["Key"]} for item in response.get("Contents", [])]
+            if keys:
+                slots.acquire()
+                future = executor.submit(client.delete_objects, Bucket=bucket, Delete={"Objects": keys, "Quiet": True})
+                future.add_done_callback(lambda f: slots.release())
+                futures.append(future)
+                deleted += len(keys)
+            if not response.get("IsTruncated"):
+                break
+            kwargs["ContinuationToken"] = response["NextContinuationToken"]
+        for future in futures:
+            future.result()
+    return deleted
+
+
+def delete_sharded(client, shard_keyspace, delete_shard, bucket):
+    """The sharded pipeline. Returns the keys deleted, the output of shard_keyspace and the seconds and
+    list calls it took."""
+    shard_keyspace.s3_client = delete_shard.s3_client = client
+    started = time.perf_counter()
+    keyspace = shard_keyspace.lambda_handler({"Bucket": bucket, "Prefix": ""}, None)
+    sharding = (time.perf_counter() - started, client.lists)
+
+    def run(shard):
+        while not shard.get("Done"):
+            shard = delete_shard.lambda_handler(shard, Context())
+        return shard["Deleted"]
+
+    with ThreadPoolExecutor(max_workers=SHARD_MAX_CONCURRENCY) as executor:
+        return sum(executor.map(run, keyspace["Shards"])), keyspace, sharding
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backend", choices=["moto", "fake"], default="moto")
+    parser.add_argument("--keys", type=int, default=1000000)
+    parser.add_argument("--layout", choices=["gsod", "hex", "sequence"], default="gsod")
+    parser.add_argument("--pipeline", choices=["single lister", "sharded"], action="append", help="default both")
+    parser.add_argument("--list-ms", type=float, default=50, help="latency of a list call on the fake backend")
+    parser.add_argument("--delete-ms", type=float, default=300, help="latency of a delete call on the fake backend")
+    args = parser.parse_args()
+
+    shard_keyspace = load_function("shard_keyspace")
+    delete_shard = load_function("delete_shard")
+    keys = layout_keys(args.layout, args.keys)
+
+    for pipeline in args.pipeline or ["single lister", "sharded"]:
+        started = time.perf_counter()
+        if args.backend == "moto":
+            backend = MotoS3(keys)
+            client = Counted(backend.client, MOTO_LIST_CONCURRENCY)
+        else:
+            backend = FakeS3(keys, args.list_ms, args.delete_ms)
+            client = Counted(backend)
+        print(f"{pipeline}: {len(keys)} {args.layout} keys loaded in {time.perf_counter() - started:.1f}s", flush=True)
+
+        started = time.perf_counter()
+        if pipeline == "single lister":
+            deleted = delete_single_lister(client, "bench")
+        else:
+            deleted, keyspace, (sharding_seconds, sharding_lists) = delete_sharded(client, shard_keyspace, delete_shard, "bench")
+        seconds = time.perf_counter() - started
+        print(f"{pipeline}: deleted {deleted} keys in {seconds:.1f}s, {deleted / seconds:,.0f} objects/s, bucket empty: {backend.empty()}")
+        if pipeline == "sharded":
+            print(
+                f"{pipeline}: sharding took {sharding_seconds:.1f}s and {sharding_lists} list calls, "
+                f"{len(keyspace['Shards'])} shards, {keyspace['EstimatedKeys']} keys estimated"
+            )
+        if args.backend == "moto":
+            backend.mock.stop()
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
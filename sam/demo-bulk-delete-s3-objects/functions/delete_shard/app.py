@@ -0,0 +1,83 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+
+# How many delete_objects calls of up to 1000 keys are in flight at the same time
+DELETE_CONCURRENCY = int(os.environ.get("DELETE_CONCURRENCY", "8"))
+DELETE_MAX_ATTEMPTS = 5
+
+# Time kept back to finish the deletes in flight before handing the rest of the shard back
+DEADLINE_MARGIN_MS = 20000
+
+s3_client = boto3.client(
+    "s3",
+    config=Config(max_pool_connections=DELETE_CONCURRENCY + 1, retries={"max_attempts": 10, "mode": "adaptive"}),
+)
+
+
+def delete_keys(bucket, keys):
+    # Keys that come back in Errors are retried with jittered backoff
+    for attempt in range(DELETE_MAX_ATTEMPTS):
+        response = s3_client.delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True},
+        )
+        if not (errors := response.get("Errors")):
+            return
+        keys = [error["Key"] for error in errors]
+        time.sleep(random.uniform(0, min(10, 0.2 * 2 ** attempt)))
+
+    raise RuntimeError(f"Could not delete {len(keys)} keys from {bucket}: {errors[:5]}")
+
+
+def lambda_handler(event, context):
+    """Delete the keys of one shard made by the shard_keyspace function.
+
+    Pages are listed one after the other and deleted on a pool of threads. When the Lambda deadline
+    comes close the function stops listing, waits for the deletes in flight and returns the shard with
+    StartAfter moved to the last key it deleted and Done set to false, so the state machine calls it again.
+
+    Args:
+        event (dict): {"Bucket", "Prefix", "StartAfter", "LastKey" (optional), "Deleted" (optional)}
+    """
+    bucket = event["Bucket"]
+    last_key = event.get("LastKey")
+    start_after = event.get("StartAfter", "")
+    slots = threading.BoundedSemaphore(DELETE_CONCURRENCY * 2)
+    futures = []
+    deleted = 0
+    done = False
+
+    with ThreadPoolExecutor(max_workers=DELETE_CONCURRENCY) as executor:
+        while context.get_remaining_time_in_millis() > DEADLINE_MARGIN_MS:
+            response = s3_client.list_objects_v2(
+                Bucket=bucket, Prefix=event.get("Prefix", ""), StartAfter=start_after, MaxKeys=1000,
+            )
+            keys = [item["Key"] for item in response.get("Contents", [])]
+            if last_key is not None:
+                in_shard = [key for key in keys if key <= last_key]
+                done = len(in_shard) < len(keys)
+                keys = in_shard
+            if keys:
+                slots.acquire()
+                future = executor.submit(delete_keys, bucket, keys)
+                future.add_done_callback(lambda f: slots.release())
+                futures.append(future)
+                deleted += len(keys)
+                start_after = keys[-1]
+            if done or not response.get("IsTruncated"):
+                done = True
+                break
+
+    for future in futures:
+        future.result()
+
+    print(f"Deleted {deleted} keys, shard done: {done}")
+    return dict(event, StartAfter=start_after, Deleted=event.get("Deleted", 0) + deleted, Done=done)
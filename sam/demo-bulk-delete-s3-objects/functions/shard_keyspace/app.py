@@ -0,0 +1,269 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import bisect
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+
+# How many positions of the keyspace we sample at a time, each sample lists up to a page of keys. After the
+# first rounds, every round samples again inside the segments whose count we could only estimate. Rounds
+# stop early once every count is exact, and a keyspace with many small clusters of keys needs most of them
+SAMPLES = int(os.environ.get("SAMPLES", "64"))
+REFINE_ROUNDS = int(os.environ.get("REFINE_ROUNDS", "16"))
+
+# Shards are sized to hold about this many keys, up to MAX_SHARDS shards
+KEYS_PER_SHARD = int(os.environ.get("KEYS_PER_SHARD", "50000"))
+MAX_SHARDS = int(os.environ.get("MAX_SHARDS", "500"))
+
+PAGE_SIZE = 1000
+
+# Learning the characters of the keys takes fewer keys per sample
+LEARN_PAGE_SIZE = 100
+
+# Keys are placed on a number line by their first WIDTH characters after the common prefix. Every
+# character is read as a digit of the characters the keys use at that place, so keys like
+# "2022/12345.csv" spread evenly over the line. Characters we haven't seen round down to the closest one
+# we have, which keeps the order and only makes the estimate coarser. Keys that only differ after WIDTH
+# characters share a place, so it is wide enough for sequence numbers that follow a longer prefix
+PRINTABLE = "".join(chr(c) for c in range(0x20, 0x7F))
+CHARACTER_GROUPS = ["0123456789", "abcdef", "ghijklmnopqrstuvwxyz", "ABCDEF", "GHIJKLMNOPQRSTUVWXYZ"]
+WIDTH = 16
+
+# Characters of the last key we search for before settling for the last candidate, and how many
+# characters we probe at once for each of them
+MAX_KEY_SEARCH = 256
+SEARCH_FANOUT = 10
+
+s3_client = boto3.client("s3", config=Config(max_pool_connections=SAMPLES))
+
+
+def to_position(key, prefix, alphabets):
+    position = 0
+    rest = key[len(prefix):len(prefix) + WIDTH]
+    for i, alphabet in enumerate(alphabets):
+        digit = max(bisect.bisect_right(alphabet, rest[i]) - 1, 0) if i < len(rest) else 0
+        position = position * len(alphabet) + digit
+    return position
+
+
+def to_key(position, prefix, alphabets):
+    chars = []
+    for alphabet in reversed(alphabets):
+        position, digit = divmod(position, len(alphabet))
+        chars.append(alphabet[digit])
+    return prefix + "".join(reversed(chars))
+
+
+def learn_alphabets(keys, prefix):
+    # A place that had one digit (or hex letter, or other letter) in the samples can hold any of them
+    alphabets = []
+    for i in range(WIDTH):
+        chars = set()
+        for key in keys:
+            if len(key) <= len(prefix) + i:
+                # PRINTABLE[0] stands in for the end of keys shorter than that
+                chars.add(PRINTABLE[0])
+                continue
+            char = key[len(prefix) + i]
+            chars.update(next((group for group in CHARACTER_GROUPS if char in group), char))
+        alphabets.append("".join(sorted(chars or PRINTABLE[0])))
+    return alphabets
+
+
+def list_after(bucket, prefix, start_after, max_keys=PAGE_SIZE):
+    response = s3_client.list_objects_v2(Bucket=bucket, Prefix=prefix, StartAfter=start_after, MaxKeys=max_keys)
+    return [item["Key"] for item in response.get("Contents", [])]
+
+
+def find_last_key(bucket, prefix, first_key):
+    # A key after StartAfter=s exists for every s below the last key, so we find the last key one
+    # character at a time. At each position SEARCH_FANOUT characters are probed at once, which narrows
+    # the printable characters down to one in two rounds
+    found = prefix
+    candidate = first_key
+    while len(found) < len(prefix) + MAX_KEY_SEARCH:
+        low, high = 0, len(PRINTABLE) - 1
+        while low < high:
+            chars = sorted({low + 1 + (high - low) * i // SEARCH_FANOUT for i in range(SEARCH_FANOUT)})
+            pages = probe(bucket, prefix, [found + PRINTABLE[char] for char in chars], 1)
+            hits = [i for i, page in enumerate(pages) if page]
+            if not hits:
+                high = chars[0] - 1
+                continue
+            low, candidate = chars[hits[-1]], pages[hits[-1]][0]
+            if hits[-1] + 1 < len(chars):
+                high = chars[hits[-1] + 1] - 1
+        # the key right after the last probe is the last one when nothing follows it
+        if not list_after(bucket, prefix, candidate, 1):
+            break
+        found += PRINTABLE[low]
+    return candidate
+
+
+def probe(bucket, prefix, start_keys, page_size):
+    with ThreadPoolExecutor(max_workers=SAMPLES) as executor:
+        return list(executor.map(lambda start_key: list_after(bucket, prefix, start_key, page_size), start_keys))
+
+
+def measure(segment, end, end_key, common, alphabets, page_size):
+    """Count the keys of a segment, the keys after its start key up to and including end_key.
+
+    Returns the count, the keys of the page inside the segment and whether the count is exact.
+    """
+    page = segment[2]
+    inside = page[:bisect.bisect_right(page, end_key)]
+    if len(inside) < len(page) or len(page) < page_size or inside[-1] == end_key:
+        # the page reached the end of the segment
+        return len(inside), inside, True
+    # nothing lies between the start and the first key of the page, so we only extrapolate the density of
+    # the page over the rest of the segment
+    first = to_position(page[0], common, alphabets)
+    covered = max(to_position(page[-1], common, alphabets) - first, 1)
+    return len(page) * max(end - first, 1) / covered, inside, False
+
+
+def split_points(segment, end, common, alphabets):
+    """Where to sample again inside a segment whose page didn't reach its end.
+
+    Right after the page, which makes the counted part exact, and then at doubling distances past it. A
+    cluster of keys that ends somewhere in the segment is found within a factor of two of its size, so a
+    segment that is mostly empty can't be mistaken for one as dense as its page.
+    """
+    page = segment[2]
+    last = to_position(page[-1], common, alphabets)
+    step = max(last - to_position(page[0], common, alphabets), 1)
+    points = [(last, page[-1])]
+    while last + step < end:
+        points.append((last + step, to_key(last + step, common, alphabets)))
+        step *= 2
+    return points
+
+
+def measure_all(segments, high, last_key, common, alphabets, page_size):
+    """Measure every segment, a segment ends where the next one starts and the last one at the last key.
+
+    Returns (segment, end position, count, keys of the page inside the segment, exact) per segment.
+    """
+    ends = [(segment[0], segment[1]) for segment in segments[1:]] + [(high, last_key)]
+    return [
+        (segment, end) + measure(segment, end, end_key, common, alphabets, page_size)
+        for segment, (end, end_key) in zip(segments, ends)
+    ]
+
+
+def sample(bucket, prefix, common, alphabets, first_key, last_key, rounds, page_size=PAGE_SIZE):
+    """Estimate how many keys fall in segments of the keyspace.
+
+    The keyspace between the first and the last key is cut into SAMPLES even segments. Each round then
+    splits the segments whose count is still an estimate at their split points, largest first and up to
+    SAMPLES new segments. A segment holds the keys after its start key up to the start key of the next.
+    Returns (start, end, keys of the page inside the segment, count) per segment, in order.
+    """
+    low, high = to_position(first_key, common, alphabets), to_position(last_key, common, alphabets) + 1
+    starts = sorted({low + (high - low) * i // SAMPLES for i in range(SAMPLES)})
+    # the first segment starts before the first key, whatever key its position makes
+    start_keys = [""] + [to_key(start, common, alphabets) for start in starts[1:]]
+    pages = probe(bucket, prefix, start_keys, page_size)
+    segments = [[start, start_key, page] for start, start_key, page in zip(starts, start_keys, pages)]
+
+    for _ in range(rounds):
+        measured = measure_all(segments, high, last_key, common, alphabets, page_size)
+        uncertain = sorted((m for m in measured if not m[4]), key=lambda m: m[2], reverse=True)
+        points = []
+        for segment, end, _, _, _ in uncertain:
+            more = split_points(segment, end, common, alphabets)
+            if points and len(points) + len(more) > SAMPLES:
+                break
+            points += more[:SAMPLES]
+        if not points:
+            break
+        pages = probe(bucket, prefix, [start_key for _, start_key in points], page_size)
+        segments += [[start, start_key, page] for (start, start_key), page in zip(points, pages)]
+        segments.sort(key=lambda segment: segment[1])
+
+    return [
+        (segment[0], end, inside, count)
+        for segment, end, count, inside, _ in measure_all(segments, high, last_key, common, alphabets, page_size)
+    ]
+
+
+def lambda_handler(event, context):
+    """Split the keys of a bucket into ranges that hold about the same number of keys.
+
+    The ranges are found by sampling pages of keys at evenly spaced StartAfter positions, so the cost
+    barely depends on the number of keys. Together the ranges always cover every key and none of them is
+    empty, a poor estimate only makes them less even.
+
+    Args:
+        event (dict): {"Bucket": "bucket-name", "Prefix": "optional/prefix", "Shards": optional count}
+
+    Returns:
+        dict: {"Shards": [{"Bucket", "Prefix", "StartAfter", "LastKey"}, ...], "EstimatedKeys": count}
+        A shard holds the keys after StartAfter up to and including LastKey. The last shard has no
+        LastKey.
+    """
+    bucket = event["Bucket"]
+    prefix = event.get("Prefix", "")
+
+    first = list_after(bucket, prefix, "", 1)
+    if not first:
+        return {"Shards": [], "EstimatedKeys": 0}
+    last_key = find_last_key(bucket, prefix, first[0])
+    common = os.path.commonprefix([first[0], last_key])
+
+    # The first rounds learn which characters the keys use at every place, starting from all printable
+    # characters. The last one spreads the samples over the keys those characters can make
+    seen = {first[0], last_key}
+    alphabets = [PRINTABLE] * WIDTH
+    for _ in range(2):
+        segments = sample(bucket, prefix, common, alphabets, first[0], last_key, 0, LEARN_PAGE_SIZE)
+        seen = seen.union(*(page for _, _, page, _ in segments))
+        alphabets = learn_alphabets(seen, common)
+    segments = sample(bucket, prefix, common, alphabets, first[0], last_key, REFINE_ROUNDS)
+
+    total = sum(count for _, _, _, count in segments)
+    shards = int(event.get("Shards") or math.ceil(total / KEYS_PER_SHARD))
+    shards = max(1, min(shards, MAX_SHARDS))
+
+    # walk the segments and cut wherever the running count passes the next shard boundary. Past the keys
+    # we listed the cut is interpolated, and then moved to the first key after it
+    cuts = []
+    seen = 0.0
+    target = 1
+    for start, end, page, count in segments:
+        while target < shards and seen + count >= total * target / shards:
+            offset = total * target / shards - seen
+            if int(offset) < len(page):
+                cuts.append((page[int(offset)], True))
+            else:
+                first = to_position(page[0], common, alphabets)
+                cuts.append((to_key(first + int((end - first) * offset / count), common, alphabets), False))
+            target += 1
+        seen += count
+    interpolated = probe(bucket, prefix, [cut for cut, listed in cuts if not listed], 1)
+
+    # every boundary is a key, so every shard holds at least one. Cuts that land on the same key (like
+    # the ones interpolated into a gap between keys) make one boundary, there are never more shards than
+    # distinct keys we found to cut at
+    boundaries = []
+    for cut, listed in cuts:
+        if not listed:
+            page = interpolated.pop(0)
+            if not page:
+                continue
+            cut = page[0]
+        if cut < last_key and (not boundaries or cut > boundaries[-1]):
+            boundaries.append(cut)
+
+    starts = [""] + boundaries
+    ends = boundaries + [None]
+    return {
+        "Shards": [
+            dict({"Bucket": bucket, "Prefix": prefix, "StartAfter": start}, **({"LastKey": end} if end else {}))
+            for start, end in zip(starts, ends)
+        ],
+        "EstimatedKeys": round(total),
+    }
@@ -0,0 +1,108 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""Unit tests for the shard_keyspace function
+
+Run them from this directory with "python3 -m unittest app_test". S3 is replaced by a sorted list of
+keys. The module is not used by the function.
+"""
+import bisect
+import os
+import random
+import unittest
+import uuid
+from unittest.mock import patch
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+import app
+
+
+class FakeS3:
+    """Answers list_objects_v2 from a sorted list of keys."""
+
+    def __init__(self, keys):
+        self.keys = sorted(set(keys))
+
+    def list_objects_v2(self, Bucket, Prefix, StartAfter, MaxKeys):
+        index = bisect.bisect_right(self.keys, StartAfter) if StartAfter >= Prefix else bisect.bisect_left(self.keys, Prefix)
+        keys = [key for key in self.keys[index:index + MaxKeys] if key.startswith(Prefix)]
+        return {"Contents": [{"Key": key} for key in keys]} if keys else {}
+
+
+def layouts(count):
+    rng = random.Random(11)
+    return {
+        "uniform hex": [uuid.UUID(int=rng.getrandbits(128)).hex for _ in range(count)],
+        # a few folders of sequence numbers, their keys only fill a sliver of the keyspace
+        "YYYY/NNNNNN.csv": [f"{year}/{n:06d}.csv" for year in range(2015, 2023) for n in range(count // 8)],
+        # many small folders
+        "YYYY/station.csv": [f"{year}/{rng.randrange(10 ** 11):011d}.csv" for year in range(1929, 2023) for _ in range(count // 94)],
+        "tenant prefixes": [f"tenant-{tenant:03d}/{n:07d}.json" for tenant in range(0, 1000, 37) for n in range(count // 27)],
+        # keys that share their first characters, next to random ones
+        "skewed": [f"logs/{n:08d}" for n in range(count // 2)] + [f"z/{rng.getrandbits(48):012x}" for _ in range(count // 2)],
+    }
+
+
+class ShardKeyspaceTests(unittest.TestCase):
+
+    def shard(self, keys, event=None, keys_per_shard=app.KEYS_PER_SHARD):
+        s3 = FakeS3(keys)
+        with patch.object(app, "s3_client", s3), patch.object(app, "KEYS_PER_SHARD", keys_per_shard):
+            result = app.lambda_handler(dict({"Bucket": "bucket"}, **(event or {})), None)
+
+        prefix = (event or {}).get("Prefix", "")
+        scoped = [key for key in s3.keys if key.startswith(prefix)]
+        sizes = []
+        for shard in result["Shards"]:
+            start = bisect.bisect_right(scoped, shard["StartAfter"])
+            end = bisect.bisect_right(scoped, shard["LastKey"]) if "LastKey" in shard else len(scoped)
+            sizes.append(end - start)
+        # together the shards hold every key once, and each of them holds at least one
+        self.assertEqual(sum(sizes), len(scoped))
+        self.assertNotIn(0, sizes)
+        return result, sizes
+
+    def test_layouts_are_estimated_and_balanced(self):
+        for name, keys in layouts(40000).items():
+            with self.subTest(layout=name):
+                result, sizes = self.shard(keys, keys_per_shard=2000)
+
+                self.assertLess(abs(result["EstimatedKeys"] / len(keys) - 1), 0.25)
+                self.assertLess(max(sizes), 2000 * 2)
+
+    def test_sparse_sequence_numbers_are_not_extrapolated(self):
+        # a page that fills its segment's first keys used to be extrapolated over the whole segment
+        result, sizes = self.shard(layouts(8000)["YYYY/NNNNNN.csv"])
+
+        self.assertEqual(result["EstimatedKeys"], 8000)
+        self.assertEqual(sizes, [8000])
+
+    def test_shards_never_outnumber_the_keys(self):
+        result, sizes = self.shard(layouts(8000)["YYYY/NNNNNN.csv"], {"Shards": 500})
+        self.assertEqual(len(sizes), 500)
+
+        result, sizes = self.shard(["a", "b", "c"], {"Shards": 500})
+        self.assertEqual(sizes, [1, 1, 1])
+
+    def test_prefix(self):
+        keys = layouts(4000)["tenant prefixes"] + ["other/" + key for key in layouts(4000)["uniform hex"]]
+        result, sizes = self.shard(keys, {"Prefix": "other/", "Shards": 8})
+
+        self.assertEqual(result["EstimatedKeys"], 4000)
+        self.assertEqual(len(sizes), 8)
+        self.assertTrue(all(shard["Prefix"] == "other/" for shard in result["Shards"]))
+
+    def test_empty_bucket(self):
+        with patch.object(app, "s3_client", FakeS3([])):
+            self.assertEqual(app.lambda_handler({"Bucket": "bucket"}, None), {"Shards": [], "EstimatedKeys": 0})
+
+    def test_last_key(self):
+        rng = random.Random(5)
+        for _ in range(200):
+            keys = sorted({"".join(rng.choice("a~ 0/") for _ in range(rng.randint(1, 10))) for _ in range(rng.randint(1, 30))})
+            with patch.object(app, "s3_client", FakeS3(keys)):
+                self.assertEqual(app.find_last_key("bucket", "", keys[0]), keys[-1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,48 +1,83 @@
+import codecs
 import json
 import os
 import csv
-import io
+import random
+import time
 
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from decimal import Decimal
-from typing import Dict, List
+from functools import lru_cache
+from typing import Dict, Iterator, List, Tuple
 
 import boto3
+from boto3.dynamodb.types import TypeSerializer
+from botocore.config import Config
 
 
-S3_CLIENT = boto3.client("s3")
+# How many ResultWriter files the reducer downloads and reduces at the same time
+RESULT_FETCH_CONCURRENCY = int(os.environ.get("RESULT_FETCH_CONCURRENCY", "32"))
+
+# Size of the chunks result files are streamed and parsed in
+RESULT_CHUNK_BYTES = 256 * 1024
+
+# The reducer writes its results in parallel segments of 25 item batches. Unprocessed items are retried
+# with jittered exponential backoff
+DDB_WRITE_SEGMENTS = int(os.environ.get("DDB_WRITE_SEGMENTS", "4"))
+DDB_BATCH_SIZE = 25
+DDB_GET_BATCH_SIZE = 100
+DDB_MAX_ATTEMPTS = 8
+DDB_BASE_BACKOFF_SECONDS = 0.05
+DDB_MAX_BACKOFF_SECONDS = 5
+
+# With SKIP_UNCHANGED_HIGHS set to "true" the reducer reads the stored highs first and only writes the
+# months that changed
+SKIP_UNCHANGED_HIGHS = os.environ.get("SKIP_UNCHANGED_HIGHS", "false").lower() == "true"
+
+S3_CLIENT = boto3.client("s3", config=Config(max_pool_connections=RESULT_FETCH_CONCURRENCY))
+
+
+@lru_cache(maxsize=None)
+def _dynamodb_client():
+    # Created on first use, so the mapper doesn't pay for it
+    return boto3.client(
+        "dynamodb",
+        config=Config(max_pool_connections=DDB_WRITE_SEGMENTS, retries={"max_attempts": 10, "mode": "standard"}),
+    )
 
 
 def lambda_handler(event: dict, context):
     """Handler that will find the weather station that has the highest average temperature by month.
 
     Returns a dictionary with "year-month" as the key and dictionary (weather station info) as value.
+    The "_metrics" key holds the cost of the batch (bytes and seconds per item), which ends up in the
+    ResultWriter output where the batch planner reads it.
 
     """
     input_bucket_name = os.environ["INPUT_BUCKET_NAME"]
+    started = time.perf_counter()
 
-    high_by_month: Dict[str, Dict] = {}
+    highs: Dict[bytes, Tuple[float, Tuple[bytes, bytes], bytes, List[str]]] = {}
+    metrics: Dict = {"items": len(event["Items"]), "bytes": 0, "seconds": 0, "item_bytes": [], "item_seconds": []}
 
     for item in event["Items"]:
-        csv_data = get_file_from_s3(input_bucket_name, item["Key"])
-        dict_data = get_csv_dict_from_string(csv_data)
-
-        for row in dict_data:
-            avg_temp = float(row["TEMP"])
+        item_started = time.perf_counter()
+        data = get_bytes_from_s3(input_bucket_name, item["Key"])
+        scan_monthly_highs(data, highs)
 
-            date = datetime.fromisoformat(row["DATE"])
-            month_str = date.strftime("%Y-%m")
-
-            monthly_high_record = high_by_month.get(month_str) or {}
-
-            if not monthly_high_record:
-                row["TEMP"] = avg_temp
-                high_by_month[month_str] = row
-                continue
-
-            if avg_temp > float(monthly_high_record["TEMP"]):
-                high_by_month[month_str] = row
+        metrics["item_bytes"].append(item.get("Size", len(data)))
+        metrics["item_seconds"].append(round(time.perf_counter() - item_started, 4))
 
+    # Only the winning line of each month is turned into a row
+    high_by_month: Dict[str, Dict] = {}
+    for month, (avg_temp, _, line, columns) in highs.items():
+        row = dict(zip(columns, next(csv.reader([line.decode("utf-8")]))))
+        row["TEMP"] = avg_temp
+        high_by_month[month.decode("utf-8")] = row
+
+    metrics["bytes"] = sum(metrics["item_bytes"])
+    metrics["seconds"] = round(time.perf_counter() - started, 4)
+    high_by_month["_metrics"] = metrics
     return high_by_month
 
 
@@ -70,45 +105,250 @@ def reducer_handler(event: dict, context: dict):
     )
 
     maniftest_json = json.loads(manifest)
+    result_keys = [result["Key"] for result in maniftest_json["ResultFiles"].get("SUCCEEDED", [])]
+
+    _write_results_to_ddb(reduce_result_files(results_bucket, result_keys))
+
+
+def combiner_handler(event: dict, context: dict) -> Dict[str, Dict]:
+    """Combiner function will merge the outputs of K mapper invocations into one partial result.
+
+    It runs in every child of the combined state machine, after the mapper invocations of that child. The
+    ResultWriter files then hold one partial per K mapper batches, so the final reducer has K times less
+    to read. The partial has the same shape as a mapper output, without the "_metrics" key.
 
+    Args:
+        event (dict): The outputs of the mapper invocations:
+
+            {
+            "Partials": [
+                {"1929-01": {...}, "_metrics": {...}},
+                ...
+            ],
+        }
+        context (dict): Lambda context
+    """
+    partial: Dict[str, Dict] = {}
+    for monthly_highs in event["Partials"]:
+        merge_monthly_highs(partial, monthly_highs)
+    return partial
+
+
+def reduce_result_files(bucket: str, keys: List[str]) -> Dict[str, Dict]:
+    """Reduce ResultWriter files to the highs by month.
+
+    The files are streamed and reduced to a partial result each on a pool of threads, and the partials
+    are merged as they complete. Memory depends on the number of threads and months, not on the number
+    of files or map children.
+    """
     high_by_month: Dict[str, Dict] = {}
+    if not keys:
+        return high_by_month
+
+    with ThreadPoolExecutor(max_workers=min(RESULT_FETCH_CONCURRENCY, len(keys))) as executor:
+        futures = [executor.submit(reduce_result_file, bucket, key) for key in keys]
+        for future in as_completed(futures):
+            merge_monthly_highs(high_by_month, future.result())
+
+    return high_by_month
+
+
+def reduce_result_file(bucket: str, key: str) -> Dict[str, Dict]:
+    """Stream one ResultWriter file and reduce the outputs of its map children."""
+    partial: Dict[str, Dict] = {}
+    body = S3_CLIENT.get_object(Bucket=bucket, Key=key)["Body"]
+
+    for json_result in iter_json_array(body.iter_chunks(RESULT_CHUNK_BYTES)):
+        monthly_highs: Dict[str, Dict] = json.loads(json_result["Output"])
+        merge_monthly_highs(partial, monthly_highs)
 
-    for result in maniftest_json["ResultFiles"].get("SUCCEEDED", []):
-        results = get_file_from_s3(results_bucket, result["Key"])
+    return partial
 
-        for json_result in json.loads(results):
 
-            monthly_highs: Dict[str, Dict] = json.loads(json_result["Output"])
+def merge_monthly_highs(high_by_month: Dict[str, Dict], monthly_highs: Dict[str, Dict]) -> Dict[str, Dict]:
+    """Merge monthly highs into high_by_month, in place.
 
-            for month_str, row in monthly_highs.items():
-                high_temp = float(row["TEMP"])
+    Ties go to the smaller STATION and DATE, so the result doesn't depend on the order partials are
+    merged in.
+    """
+    for month_str, row in monthly_highs.items():
+        # keys starting with an underscore (like "_metrics") aren't months
+        if month_str.startswith("_"):
+            continue
+
+        monthly_high = high_by_month.get(month_str)
 
-                monthly_high = high_by_month.get(month_str)
+        if not monthly_high:
+            high_by_month[month_str] = row
+            continue
 
-                if not monthly_high:
-                    high_by_month[month_str] = row
-                    continue
+        high_temp = float(row["TEMP"])
+        current_temp = float(monthly_high["TEMP"])
+        if high_temp > current_temp or (
+            high_temp == current_temp
+            and (row.get("STATION", ""), row.get("DATE", "")) < (monthly_high.get("STATION", ""), monthly_high.get("DATE", ""))
+        ):
+            high_by_month[month_str] = row
 
-                if high_temp > float(monthly_high["TEMP"]):
-                    high_by_month[month_str] = row
+    return high_by_month
 
-    _write_results_to_ddb(high_by_month)
+
+def iter_json_array(chunks: Iterator[bytes]) -> Iterator:
+    """Yield the elements of a JSON array as its bytes arrive.
+
+    Only the element being parsed and the unparsed rest of the current chunk are held in memory, the
+    whole document never is.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    position = 0
+    started = False
+    finished = False
+
+    for chunk in chunks:
+        buffer = buffer[position:] + utf8.decode(chunk)
+        position = 0
+
+        while True:
+            # skip whitespace, the opening bracket and the commas between elements
+            while position < len(buffer) and buffer[position] in " \t\r\n,[":
+                if buffer[position] == "[":
+                    if started:
+                        break
+                    started = True
+                position += 1
+            if position < len(buffer) and buffer[position] == "]":
+                finished = True
+                break
+            if position >= len(buffer):
+                break
+
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # the element continues in the next chunk
+                break
+            position = end
+            yield element
+
+        if finished:
+            return
+
+    raise ValueError("Truncated JSON array")
 
 
 def _write_results_to_ddb(high_by_month: Dict[str, Dict]):
-    dynamodb = boto3.resource("dynamodb")
-    table = dynamodb.Table(os.environ["RESULTS_DYNAMODB_TABLE_NAME"])
+    table_name = os.environ["RESULTS_DYNAMODB_TABLE_NAME"]
+    serializer = TypeSerializer()
 
+    items: Dict[str, Dict] = {}
     for month_str, row in high_by_month.items():
         row["pk"] = month_str
         row["TEMP"] = round(Decimal(row["TEMP"]), 1)
-        table.put_item(Item=row)
+        items[month_str] = {name: serializer.serialize(value) for name, value in row.items()}
 
+    if SKIP_UNCHANGED_HIGHS:
+        items = _drop_unchanged_items(table_name, items)
 
-def get_file_from_s3(input_bucket_name: str, key: str) -> str:
+    requests = [{"PutRequest": {"Item": item}} for item in items.values()]
+    segments = [requests[i::DDB_WRITE_SEGMENTS] for i in range(DDB_WRITE_SEGMENTS)]
+    with ThreadPoolExecutor(max_workers=DDB_WRITE_SEGMENTS) as executor:
+        written = sum(executor.map(lambda segment: _write_segment(table_name, segment), segments))
+    print(f"Wrote {written} of {len(high_by_month)} months")
+
+
+def _backoff(attempt: int):
+    # Full jitter, so the segments don't retry in lockstep
+    time.sleep(random.uniform(0, min(DDB_MAX_BACKOFF_SECONDS, DDB_BASE_BACKOFF_SECONDS * 2 ** attempt)))
+
+
+def _write_segment(table_name: str, requests: List[Dict]) -> int:
+    client = _dynamodb_client()
+
+    for start in range(0, len(requests), DDB_BATCH_SIZE):
+        pending = requests[start:start + DDB_BATCH_SIZE]
+
+        for attempt in range(DDB_MAX_ATTEMPTS):
+            response = client.batch_write_item(RequestItems={table_name: pending})
+            pending = response.get("UnprocessedItems", {}).get(table_name, [])
+            if not pending:
+                break
+            _backoff(attempt)
+        else:
+            raise RuntimeError(f"{len(pending)} items were still unprocessed after {DDB_MAX_ATTEMPTS} attempts")
+
+    return len(requests)
+
+
+def _drop_unchanged_items(table_name: str, items: Dict[str, Dict]) -> Dict[str, Dict]:
+    """Drop the items that are already stored exactly as they are."""
+    client = _dynamodb_client()
+    changed = dict(items)
+    keys = list(items)
+
+    for start in range(0, len(keys), DDB_GET_BATCH_SIZE):
+        request = {table_name: {"Keys": [{"pk": {"S": key}} for key in keys[start:start + DDB_GET_BATCH_SIZE]]}}
+
+        for attempt in range(DDB_MAX_ATTEMPTS):
+            response = client.batch_get_item(RequestItems=request)
+            for stored in response["Responses"].get(table_name, []):
+                if stored == changed.get(stored["pk"]["S"]):
+                    del changed[stored["pk"]["S"]]
+            request = response.get("UnprocessedKeys")
+            if not request:
+                break
+            _backoff(attempt)
+        # keys we couldn't read are simply written again
+
+    return changed
+
+
+def scan_monthly_highs(data: bytes, highs: Dict[bytes, Tuple[float, Tuple[bytes, bytes], bytes, List[str]]]) -> None:
+    """Fold the rows of one GSOD CSV file into the running highs by month.
+
+    GSOD files quote every field, so rather than decoding the file and building a dict per row we split
+    the raw lines on the '","' separator, and only up to the DATE and TEMP columns. The month is the
+    first seven bytes of the ISO date. For each month we keep the highest temperature, the line it came
+    from and the file's columns. Ties go to the smaller STATION and DATE, like in merge_monthly_highs, so
+    the winner doesn't depend on the order of the rows. Lines that aren't fully quoted go through the csv
+    module instead.
+
+    Args:
+        data (bytes): The raw contents of the CSV file
+        highs (dict): Maps b"YYYY-MM" to (temperature, (station, date), line, columns), updated in place
+    """
+    lines = data.splitlines()
+    if not lines:
+        return
+
+    columns = next(csv.reader([lines[0].decode("utf-8")]))
+    date_index = columns.index("DATE")
+    temp_index = columns.index("TEMP")
+    station_index = columns.index("STATION") if "STATION" in columns else None
+    last_index = max(date_index, temp_index, station_index or 0)
+
+    for line in lines[1:]:
+        if not line:
+            continue
+
+        fields = line[1:-1].split(b'","', last_index + 1) if line[:1] == b'"' and line[-1:] == b'"' else []
+        if len(fields) <= last_index:
+            fields = [field.encode("utf-8") for field in next(csv.reader([line.decode("utf-8")]))]
+
+        avg_temp = float(fields[temp_index])
+        month = fields[date_index][:7]
+        tie_key = (fields[station_index] if station_index is not None else b"", fields[date_index])
+
+        monthly_high = highs.get(month)
+        if monthly_high is None or avg_temp > monthly_high[0] or (avg_temp == monthly_high[0] and tie_key < monthly_high[1]):
+            highs[month] = (avg_temp, tie_key, line, columns)
+
+
+def get_bytes_from_s3(input_bucket_name: str, key: str) -> bytes:
     resp = S3_CLIENT.get_object(Bucket=input_bucket_name, Key=key)
-    return resp["Body"].read().decode("utf-8")
+    return resp["Body"].read()
 
 
-def get_csv_dict_from_string(csv_string: str) -> dict:
-    return csv.DictReader(io.StringIO(csv_string))
+def get_file_from_s3(input_bucket_name: str, key: str) -> str:
+    return get_bytes_from_s3(input_bucket_name, key).decode("utf-8")
@@ -0,0 +1,128 @@
+"""Unit tests for the temps functions
+
+Run them from this directory with "python3 -m unittest app_test". The module is not used by the
+functions.
+"""
+import io
+import json
+import os
+import random
+import unittest
+from typing import Dict, List
+from unittest.mock import MagicMock, patch
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("INPUT_BUCKET_NAME", "input")
+
+import app
+
+
+COLUMNS = ["STATION", "DATE", "LATITUDE", "LONGITUDE", "NAME", "TEMP", "TEMP_ATTRIBUTES"]
+
+
+def gsod_file(rows: List[List[str]]) -> bytes:
+    """A GSOD CSV file, every field quoted like in the NOAA data."""
+    lines = [",".join(f'"{field}"' for field in row) for row in [COLUMNS] + rows]
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def synthetic_shards(rng: random.Random, count: int) -> List[bytes]:
+    """One file per station. Temperatures are drawn from a handful of values, so most months have
+    several stations, and several days of the same station, tied on the high."""
+    shards = []
+    for station in rng.sample(range(10000000000, 10000000000 + count * 10), count):
+        rows = []
+        for month in range(1, 7):
+            for day in rng.sample(range(1, 29), 5):
+                temp = rng.choice(["88.5", "90.1", "90.1", "91.0"])
+                rows.append([str(station), f"1990-{month:02d}-{day:02d}", "1.5", "2.5", f"STATION {station}", temp, "24"])
+        rng.shuffle(rows)
+        shards.append(gsod_file(rows))
+    return shards
+
+
+def result_writer_file(outputs: List[Dict]) -> bytes:
+    """A ResultWriter SUCCEEDED file holding the outputs of map children."""
+    return json.dumps([{"Output": json.dumps(output), "Status": "SUCCEEDED"} for output in outputs]).encode("utf-8")
+
+
+class CombinerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.files: Dict[str, bytes] = {}
+        s3 = MagicMock()
+        s3.get_object.side_effect = lambda Bucket, Key: {"Body": self.body(self.files[Key])}
+        patcher = patch.object(app, "S3_CLIENT", s3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def body(data: bytes) -> MagicMock:
+        body = MagicMock()
+        body.read.side_effect = lambda: data
+        # small chunks, so elements are split across chunks
+        body.iter_chunks.side_effect = lambda size: iter(lambda stream=io.BytesIO(data): stream.read(97), b"")
+        return body
+
+    def map_batches(self, shards: List[bytes], batch_size: int) -> List[Dict]:
+        """Run the mapper over batches of shards, like the map children do."""
+        outputs = []
+        for start in range(0, len(shards), batch_size):
+            items = []
+            for shard in shards[start:start + batch_size]:
+                key = f"shards/{len(self.files)}.csv"
+                self.files[key] = shard
+                items.append({"Key": key})
+            outputs.append(app.lambda_handler({"Items": items}, None))
+        return outputs
+
+    def reduce(self, outputs: List[Dict], files: int) -> Dict[str, Dict]:
+        """Write the outputs into ResultWriter files and run the reducer over them."""
+        keys = []
+        for i in range(files):
+            key = f"results/SUCCEEDED_{len(self.files)}_{i}.json"
+            self.files[key] = result_writer_file(outputs[i::files])
+            keys.append({"Key": key})
+        self.files["results/manifest.json"] = json.dumps({"ResultFiles": {"SUCCEEDED": keys}}).encode("utf-8")
+
+        with patch.object(app, "_write_results_to_ddb") as write:
+            app.reducer_handler({"ResultWriterDetails": {"Bucket": "results", "Key": "results/manifest.json"}}, None)
+        return write.call_args.args[0]
+
+    def test_combined_highs_equal_the_single_reducer(self):
+        for seed in range(5):
+            with self.subTest(seed=seed):
+                rng = random.Random(seed)
+                shards = synthetic_shards(rng, 40)
+                outputs = self.map_batches(shards, 3)
+
+                single = self.reduce(outputs, 4)
+
+                # combine K mapper outputs per child, in a different order
+                rng.shuffle(outputs)
+                k = rng.randint(2, 5)
+                partials = [app.combiner_handler({"Partials": outputs[i:i + k]}, None) for i in range(0, len(outputs), k)]
+                combined = self.reduce(partials, 3)
+
+                self.assertEqual(combined, single)
+
+                # and both equal one mapper that saw every shard
+                everything = self.map_batches(shards, len(shards))[0]
+                del everything["_metrics"]
+                self.assertEqual(json.loads(json.dumps(single)), json.loads(json.dumps(everything)))
+
+    def test_ties_go_to_the_smaller_station_and_date(self):
+        shards = [
+            gsod_file([["30000000000", "1990-01-02", "1", "2", "C", "90.1", "24"]]),
+            gsod_file([["10000000000", "1990-01-09", "1", "2", "A", "90.1", "24"],
+                       ["10000000000", "1990-01-03", "1", "2", "A", "90.1", "24"]]),
+            gsod_file([["20000000000", "1990-01-01", "1", "2", "B", "90.1", "24"]]),
+        ]
+        partials = [app.combiner_handler({"Partials": [output]}, None) for output in self.map_batches(shards, 1)]
+        highs = self.reduce(partials, 2)
+
+        self.assertEqual((highs["1990-01"]["STATION"], highs["1990-01"]["DATE"]), ("10000000000", "1990-01-03"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+"""Benchmark the reducer's DynamoDB writes against moto.
+
+Writes the same synthetic monthly highs once with one put_item call per month, like the reducer used
+to, and once with _write_results_to_ddb, then re-runs the batched writer with SKIP_UNCHANGED_HIGHS on
+after changing a single month. moto has no per-request network cost, so the numbers show the client
+side overhead of each approach rather than what DynamoDB itself sustains.
+
+Run it from this directory with "python3 bench_writes.py [months]", it needs moto. The module is not
+used by the functions.
+"""
+import os
+import sys
+import time
+from typing import Dict
+from unittest.mock import patch
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+os.environ["RESULTS_DYNAMODB_TABLE_NAME"] = "bench-highs"
+
+import boto3
+from moto import mock_aws
+
+import app
+
+
+def synthetic_highs(months: int) -> Dict[str, Dict]:
+    """Monthly highs shaped like the mapper rows, one per month starting in 1900-01."""
+    return {
+        f"{1900 + i // 12}-{i % 12 + 1:02d}": {
+            "STATION": f"{i:011d}",
+            "DATE": f"{1900 + i // 12}-{i % 12 + 1:02d}-15",
+            "NAME": f"STATION {i}",
+            "TEMP": str(50 + i % 40 + 0.5),
+        }
+        for i in range(months)
+    }
+
+
+def put_items(highs: Dict[str, Dict]):
+    """The reducer's old write path, one put_item call per month."""
+    table = boto3.resource("dynamodb").Table(os.environ["RESULTS_DYNAMODB_TABLE_NAME"])
+    for month_str, row in highs.items():
+        table.put_item(Item={**row, "pk": month_str, "TEMP": round(app.Decimal(row["TEMP"]), 1)})
+
+
+def timed(name: str, months: int, write, highs: Dict[str, Dict]):
+    started = time.perf_counter()
+    write(highs)
+    seconds = time.perf_counter() - started
+    print(f"{name:<24} {months} months in {seconds:.2f}s, {months / seconds:.0f} items/s")
+
+
+def main(months: int):
+    with mock_aws():
+        client = boto3.client("dynamodb")
+        client.create_table(
+            TableName=os.environ["RESULTS_DYNAMODB_TABLE_NAME"],
+            KeySchema=[{"AttributeName": "pk", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "pk", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        app._dynamodb_client.cache_clear()
+
+        timed("put_item", months, put_items, synthetic_highs(months))
+        timed("batch_write_item", months, app._write_results_to_ddb, synthetic_highs(months))
+
+        # the second run only has one month to write
+        highs = synthetic_highs(months)
+        highs["1900-01"]["TEMP"] = "99.5"
+        with patch.object(app, "SKIP_UNCHANGED_HIGHS", True):
+            timed("skip unchanged", months, app._write_results_to_ddb, highs)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3000)
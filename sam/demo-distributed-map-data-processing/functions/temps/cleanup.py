@@ -1,26 +1,150 @@
 
+import random
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
 import boto3
+from botocore.config import Config
 
-client = boto3.client('s3')
+# How many prefixes are listed, and how many delete_objects calls are in flight, at the same time
+LIST_CONCURRENCY = 8
+DELETE_CONCURRENCY = 16
 
-def handler(event, context):
-    bucket = event['Name']
+# delete_objects takes up to 1000 keys per call
+DELETE_BATCH_SIZE = 1000
+
+# Keys that come back in Errors are retried this many times before we give up
+DELETE_MAX_ATTEMPTS = 5
+
+# Time kept back to finish the deletes in flight and hand the rest of the bucket back to the state machine
+DEADLINE_MARGIN_MS = 30000
+
+# Prefixes are split on "/" until there are enough of them to list in parallel
+MAX_PREFIX_DEPTH = 3
+
+client = boto3.client(
+    's3',
+    config=Config(
+        max_pool_connections=LIST_CONCURRENCY + DELETE_CONCURRENCY,
+        retries={'max_attempts': 10, 'mode': 'adaptive'},
+    ),
+)
 
-    if object_keys := [{'Key': i['Key']} for i in event.get( 'Contents', [] )]:
+
+def delete_keys(bucket, keys):
+    for attempt in range(DELETE_MAX_ATTEMPTS):
         response = client.delete_objects(
             Bucket=bucket,
             Delete={
-                'Objects': object_keys,
+                'Objects': [{'Key': key} for key in keys],
+                'Quiet': True,
             },
         )
-        try:
-            print(f"Deleted { len(response['Deleted']) } items")
-        except KeyError:
-            print(response)
-            print(event)
-            raise
-
-    if token := event.get('NextContinuationToken'):
+        if not (errors := response.get('Errors')):
+            return
+
+        keys = [error['Key'] for error in errors]
+        print(f"Retrying {len(keys)} keys, first error: {errors[0]}")
+        time.sleep(random.uniform(0, min(10, 0.2 * 2 ** attempt)))
+
+    raise RuntimeError(f"Could not delete {len(keys)} keys from {bucket}: {errors[:5]}")
+
+
+class Deleter:
+    # Runs delete_objects calls on a pool of threads. submit blocks while too many are pending, so
+    # listing never runs far ahead of deleting
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.executor = ThreadPoolExecutor(max_workers=DELETE_CONCURRENCY)
+        self.slots = threading.BoundedSemaphore(DELETE_CONCURRENCY * 2)
+        self.futures = []
+        self.deleted = 0
+        self.lock = threading.Lock()
+
+    def submit(self, keys):
+        for i in range(0, len(keys), DELETE_BATCH_SIZE):
+            batch = keys[i:i + DELETE_BATCH_SIZE]
+            self.slots.acquire()
+            future = self.executor.submit(delete_keys, self.bucket, batch)
+            future.add_done_callback(lambda f, size=len(batch): self.done(f, size))
+            self.futures.append(future)
+
+    def done(self, future, size):
+        self.slots.release()
+        if not future.exception():
+            with self.lock:
+                self.deleted += size
+
+    def wait(self):
+        self.executor.shutdown(wait=True)
+        for future in self.futures:
+            # raises the first delete that failed for good
+            future.result()
+        return self.deleted
+
+
+def find_prefixes(bucket, deleter, out_of_time):
+    # Walks down the "/" hierarchy until there are enough prefixes to list in parallel. Objects found on
+    # the way are deleted right away. Returns None when we run out of time on the way
+    prefixes = ['']
+    for depth in range(MAX_PREFIX_DEPTH):
+        if len(prefixes) >= LIST_CONCURRENCY:
+            break
+        found = []
+        for prefix in prefixes:
+            for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+                deleter.submit([item['Key'] for item in page.get('Contents', [])])
+                found.extend(item['Prefix'] for item in page.get('CommonPrefixes', []))
+                if out_of_time():
+                    return None
+        if not found:
+            return []
+        prefixes = found
+    return prefixes
+
+
+def empty_prefix(bucket, prefix, deleter, out_of_time):
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        deleter.submit([item['Key'] for item in page.get('Contents', [])])
+        if out_of_time():
+            return False
+    return True
+
+
+def handler(event, context):
+    bucket = event['Name']
+    deleter = Deleter(bucket)
+
+    def out_of_time():
+        return context.get_remaining_time_in_millis() < DEADLINE_MARGIN_MS
+
+    # The page the state machine listed goes first
+    deleter.submit([i['Key'] for i in event.get('Contents', [])])
+
+    finished = True
+    if event.get('NextContinuationToken'):
+        prefixes = find_prefixes(bucket, deleter, out_of_time)
+        if prefixes is None:
+            finished = False
+        elif prefixes:
+            with ThreadPoolExecutor(max_workers=LIST_CONCURRENCY) as executor:
+                finished = all(executor.map(lambda prefix: empty_prefix(bucket, prefix, deleter, out_of_time), prefixes))
+
+    print(f"Deleted {deleter.wait()} items")
+
+    if finished:
+        return {}
+
+    # Out of time. Everything we listed is deleted, so the first page of what is left starts the next
+    # round. We delete it here and hand its continuation token back to the state machine
+    page = client.list_objects_v2(Bucket=bucket)
+    if keys := [item['Key'] for item in page.get('Contents', [])]:
+        delete_keys(bucket, keys)
+
+    if token := page.get('NextContinuationToken'):
         return {
             'NextContinuationToken': token,
             "BucketToEmpty": bucket,
@@ -28,6 +28,20 @@ variable "fedrate" {
   default = 8
 }
 
+# the size of an activity worker task. the worker runs one batch per vcpu
+# (WORKERS below) and every batch holds its frames and simulated paths in
+# memory, so give it at least 1 GB per vcpu. fargate only accepts certain
+# pairs, with 2 vcpu the memory has to be between 4 and 16 GB
+variable "taskcpu" {
+  type    = number
+  default = 2048
+}
+
+variable "taskmemory" {
+  type    = number
+  default = 4096
+}
+
 variable "tags" {
   type    = map(string)
   default = {
@@ -73,8 +87,16 @@ module "ecs" {
 #---data generation lambdas-----------------------------------
 data "archive_file" "dataseed" {
   type        = "zip"
-  source_file = "../shared/lambda/dataseed.py"
   output_path = "../shared/lambda/dataseed.py.zip"
+
+  source {
+    content  = file("../shared/lambda/dataseed.py")
+    filename = "dataseed.py"
+  }
+  source {
+    content  = file("../shared/lambda/s3io.py")
+    filename = "s3io.py"
+  }
 }
 
 module "lambda_dataseed" {
@@ -104,9 +126,10 @@ module "lambda_datagen" {
   tags    = var.tags
   name    = "datagen"
 
+  layers            = ["arn:aws:lambda:${data.aws_region.current.name}:336392948345:layer:AWSSDKPandas-Python310:5"]
   filehash          = data.archive_file.datagen.output_base64sha256
   filename          = "${abspath(path.root)}/../shared/lambda/datagen.py.zip"
-  memory            = 128
+  memory            = 256
   timeout           = 120
   recordcount       = var.recordcount
   sourcebucket      = module.s3.sourceid
@@ -115,8 +138,16 @@ module "lambda_datagen" {
 
 data "archive_file" "inventory" {
   type        = "zip"
-  source_file = "../shared/lambda/inventory.py"
   output_path = "../shared/lambda/inventory.py.zip"
+
+  source {
+    content  = file("../shared/lambda/inventory.py")
+    filename = "inventory.py"
+  }
+  source {
+    content  = file("../shared/lambda/s3io.py")
+    filename = "s3io.py"
+  }
 }
 
 module "lambda_inventory" {
@@ -149,7 +180,10 @@ module "lambda_manifest" {
   filehash          = data.archive_file.manifest.output_base64sha256
   filename          = "${abspath(path.root)}/../shared/lambda/manifest.py.zip"
   memory            = 2048
-  timeout           = 120
+  # one invocation lists every inventory file and writes every manifest part
+  # (and hashes every object when manifestchecksums is on), so give it the
+  # lambda maximum
+  timeout           = 900
   recordcount       = var.recordcount
   sourcebucket      = module.s3.sourceid
   destinationbucket = module.s3.destinationid
@@ -157,8 +191,16 @@ module "lambda_manifest" {
 
 data "archive_file" "partition" {
   type        = "zip"
-  source_file = "../shared/lambda/partition.py"
   output_path = "../shared/lambda/partition.py.zip"
+
+  source {
+    content  = file("../shared/lambda/partition.py")
+    filename = "partition.py"
+  }
+  source {
+    content  = file("../shared/lambda/s3io.py")
+    filename = "s3io.py"
+  }
 }
 
 module "lambda_partition" {
@@ -177,35 +219,17 @@ module "lambda_partition" {
   destinationbucket = module.s3.destinationid
 }
 
-#---data process lambda---------------------------------------
-data "archive_file" "process" {
-  type        = "zip"
-  source_file = "./lambda/process.py"
-  output_path = "./lambda/process.py.zip"
-}
-
-module "lambda_process" {
-  source  = "../shared/modules/lambda"
-  prefix  = var.prefix
-  tags    = var.tags
-  name    = "process"
-
-  layers            = ["arn:aws:lambda:${data.aws_region.current.name}:336392948345:layer:AWSSDKPandas-Python310:5"]
-  filehash          = data.archive_file.process.output_base64sha256
-  filename          = "${abspath(path.root)}/lambda/process.py.zip"
-  memory            = 2048
-  timeout           = 120
-  fedrate           = var.fedrate
-  recordcount       = var.recordcount
-  sourcebucket      = module.s3.sourceid
-  destinationbucket = module.s3.destinationid
-}
-
-# invoke the process lambda to generate the script used by our container
-resource "aws_lambda_invocation" "script" {
-  function_name = module.lambda_process.name
+#---data process worker---------------------------------------
+# the hosts download the packaged worker from the source bucket, build it
+# with "python3 ../shared/worker/package.py" before planning
+resource "aws_s3_object" "worker" {
+  provider  = aws.main
+  bucket    = module.s3.sourceid
+  key       = "script/montecarlo.pyz"
+  source    = "${abspath(path.root)}/../shared/worker/dist/montecarlo.pyz"
+  etag      = filemd5("${abspath(path.root)}/../shared/worker/dist/montecarlo.pyz")
 
-  input = jsonencode({})
+  tags  = merge(var.tags, {Name = "${var.prefix}-worker"})
 }
 
 #---step functions--------------------------------------------
@@ -221,7 +245,6 @@ module "stepfunctions" {
   dataseedarn       = module.lambda_dataseed.arn
   inventoryarn      = module.lambda_inventory.arn
   manifestarn       = module.lambda_manifest.arn
-  processlambda     = module.lambda_process.arn
   partitionlambda   = module.lambda_partition.arn
   ecscluster        = module.ecs.clustername
   ecsservice        = aws_ecs_service.sfndefault.name
@@ -397,19 +420,19 @@ resource "aws_ecs_task_definition" "sfndefault" {
   task_role_arn             = aws_iam_role.sfnrole.arn
   network_mode              = "awsvpc"
   requires_compatibilities  = ["FARGATE"]
-  cpu                       = 256
-  memory                    = 512
+  cpu                       = var.taskcpu
+  memory                    = var.taskmemory
   container_definitions = jsonencode([
     {
       name                = "${var.prefix}-sfn-docker"
       image               = "public.ecr.aws/amazonlinux/amazonlinux:2023"
-      cpu                 = 256
+      cpu                 = var.taskcpu
       command             = [
         "/bin/sh",
         "-c",
-        "yum -y update && yum -y install awscli python3-pip && aws s3 cp s3://${module.s3.sourceid}/script/process.py . && python3 -m pip install boto3 && python3 -m pip install pandas && python3 process.py"
+        "yum -y update && yum -y install awscli python3-pip && aws s3 cp s3://${module.s3.sourceid}/${aws_s3_object.worker.key} . && python3 -m pip install boto3 pandas pyarrow && exec python3 montecarlo.pyz activity"
       ]
-      memory              = 512
+      memory              = var.taskmemory
       essential           = true
       environment         = [
         {
@@ -431,6 +454,10 @@ resource "aws_ecs_task_definition" "sfndefault" {
         {
           name = "FEDRATE"
           value = tostring(var.fedrate)
+        },
+        {
+          name = "WORKERS"
+          value = tostring(max(1, floor(var.taskcpu / 1024)))
         }
       ]
       logConfiguration    = {
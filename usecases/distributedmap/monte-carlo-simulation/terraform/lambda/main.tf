@@ -51,8 +51,16 @@ module "s3" {
 #---data generation lambdas-----------------------------------
 data "archive_file" "dataseed" {
   type        = "zip"
-  source_file = "../shared/lambda/dataseed.py"
   output_path = "../shared/lambda/dataseed.py.zip"
+
+  source {
+    content  = file("../shared/lambda/dataseed.py")
+    filename = "dataseed.py"
+  }
+  source {
+    content  = file("../shared/lambda/s3io.py")
+    filename = "s3io.py"
+  }
 }
 
 module "lambda_dataseed" {
@@ -82,9 +90,10 @@ module "lambda_datagen" {
   tags    = var.tags
   name    = "datagen"
 
+  layers            = ["arn:aws:lambda:${data.aws_region.current.name}:336392948345:layer:AWSSDKPandas-Python310:5"]
   filehash          = data.archive_file.datagen.output_base64sha256
   filename          = "${abspath(path.root)}/../shared/lambda/datagen.py.zip"
-  memory            = 128
+  memory            = 256
   timeout           = 120
   recordcount       = var.recordcount
   sourcebucket      = module.s3.sourceid
@@ -93,8 +102,16 @@ module "lambda_datagen" {
 
 data "archive_file" "inventory" {
   type        = "zip"
-  source_file = "../shared/lambda/inventory.py"
   output_path = "../shared/lambda/inventory.py.zip"
+
+  source {
+    content  = file("../shared/lambda/inventory.py")
+    filename = "inventory.py"
+  }
+  source {
+    content  = file("../shared/lambda/s3io.py")
+    filename = "s3io.py"
+  }
 }
 
 module "lambda_inventory" {
@@ -127,7 +144,10 @@ module "lambda_manifest" {
   filehash          = data.archive_file.manifest.output_base64sha256
   filename          = "${abspath(path.root)}/../shared/lambda/manifest.py.zip"
   memory            = 2048
-  timeout           = 120
+  # one invocation lists every inventory file and writes every manifest part
+  # (and hashes every object when manifestchecksums is on), so give it the
+  # lambda maximum
+  timeout           = 900
   recordcount       = var.recordcount
   sourcebucket      = module.s3.sourceid
   destinationbucket = module.s3.destinationid
@@ -135,8 +155,16 @@ module "lambda_manifest" {
 
 data "archive_file" "partition" {
   type        = "zip"
-  source_file = "../shared/lambda/partition.py"
   output_path = "../shared/lambda/partition.py.zip"
+
+  source {
+    content  = file("../shared/lambda/partition.py")
+    filename = "partition.py"
+  }
+  source {
+    content  = file("../shared/lambda/s3io.py")
+    filename = "s3io.py"
+  }
 }
 
 module "lambda_partition" {
@@ -156,10 +184,23 @@ module "lambda_partition" {
 }
 
 #---data process lambda---------------------------------------
+# the handler is a thin wrapper around the shared montecarlo worker package
 data "archive_file" "process" {
   type        = "zip"
-  source_file = "./lambda/process.py"
   output_path = "./lambda/process.py.zip"
+
+  source {
+    content  = file("./lambda/process.py")
+    filename = "process.py"
+  }
+  source {
+    content  = file("../shared/worker/montecarlo/__init__.py")
+    filename = "montecarlo/__init__.py"
+  }
+  source {
+    content  = file("../shared/worker/montecarlo/engine.py")
+    filename = "montecarlo/engine.py"
+  }
 }
 
 module "lambda_process" {
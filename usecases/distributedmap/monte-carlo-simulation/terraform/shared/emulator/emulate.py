@@ -0,0 +1,687 @@
+#!/usr/bin/env python3
+# runs the monte carlo workflows on your machine so we can measure and tune
+# them without deploying anything. the state machine definitions are read
+# straight from the stepfunctions terraform module, the lambda handlers run
+# on a local process pool and a moto server stands in for S3.
+#
+# python3 emulate.py                   runs data generation and processing
+# python3 emulate.py datagen           only runs data generation
+# python3 emulate.py --records 5000 --var dmapbatchsize=50 --var dmapconcurrency=8
+# python3 emulate.py --set "File Generation DMap.ItemBatcher.MaxItemsPerBatch=250"
+#
+# we only emulate what our workflows use: Pass, Task (lambda:invoke, the
+# activity and ecs:updateService), inline and distributed Map states with
+# ItemReader, ItemBatcher, MaxConcurrency, ToleratedFailureCount and
+# ResultWriter, and Retry. at the end it prints latency, throughput and S3
+# request counts for every stage
+import os
+import re
+import sys
+import csv
+import gzip
+import json
+import time
+import logging
+import socket
+import argparse
+import importlib
+import threading
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+import boto3
+
+here = os.path.dirname(os.path.abspath(__file__))
+terraform = os.path.dirname(os.path.dirname(here))
+module = os.path.join(terraform, 'shared', 'modules', 'stepfunctions')
+
+# where the worker processes find our handlers
+handler_paths = [
+  os.path.join(terraform, 'shared', 'lambda'),
+  os.path.join(terraform, 'shared', 'worker'),
+  os.path.join(terraform, 'lambda', 'lambda')
+]
+
+# local stand-ins for the handlers behind every resource in the definitions
+handlers = {
+  'dataseed': ('dataseed', 'lambda_handler'),
+  'datagen': ('datagen', 'lambda_handler'),
+  'inventory': ('inventory', 'lambda_handler'),
+  'manifest': ('manifest', 'lambda_handler'),
+  'partition': ('partition', 'lambda_handler'),
+  'process': ('process', 'lambda_handler'),
+  'activity': ('process', 'lambda_handler')
+}
+
+# module variables that terraform fills in from other modules when deploying
+local_variables = {
+  'prefix': 'local',
+  'region': 'us-east-1',
+  'compute': 'lambda',
+  'dataseedarn': 'local:dataseed',
+  'datagenarn': 'local:datagen',
+  'inventoryarn': 'local:inventory',
+  'manifestarn': 'local:manifest',
+  'partitionlambda': 'local:partition',
+  'processlambda': 'local:process',
+  'sourcebucket': 'local-source',
+  'sourceprefix': 'data',
+  'destinationbucket': 'local-destination',
+  'destinationprefix': 'results/data',
+  'ecscluster': 'local',
+  'ecsservice': 'local'
+}
+
+# the state machines in sfn.tf for every workflow
+workflows = {
+  'datagen': lambda compute: 'sfnecsdatageneration',
+  'process': lambda compute: 'sfnlambdastatemachine' if compute == 'lambda' else 'sfnecsstatemachine'
+}
+
+# step functions caps the input of a child execution at 256 KiB
+max_batch_bytes = 256 * 1024
+
+class StatesError(Exception):
+  def __init__(self, error, cause=''):
+    super().__init__(cause or error)
+    self.error = error
+
+# ------------------------------------------------------------
+# terraform
+# ------------------------------------------------------------
+
+# reads the defaults of the module variables, the values we need are all
+# single line numbers, strings and bools
+def load_variables(path):
+  with open(path) as f:
+    text = f.read()
+  variables = {}
+  for name, body in re.findall(r'variable\s+"(\w+)"\s*\{(.*?)\n\}', text, re.S):
+    match = re.search(r'default\s*=\s*(.+)', body)
+    if match and not match.group(1).strip().startswith('{'):
+      variables[name] = json.loads(match.group(1).strip())
+  return variables
+
+def render_variable(value):
+  if isinstance(value, bool):
+    return 'true' if value else 'false'
+  return str(value)
+
+# pulls every state machine definition out of sfn.tf and substitutes the
+# variables. optional keys are written as ${var.x == null ? "" : "\"key\": ${var.x},"}
+# and left out when the variable is null. the only other interpolation is
+# the activity id of the ecs state machine, which we point at our local
+# activity worker
+def load_definitions(path, variables):
+  with open(path) as f:
+    text = f.read()
+  definitions = {}
+  for name, body in re.findall(r'resource\s+"aws_sfn_state_machine"\s+"(\w+)"\s*\{.*?definition\s*=\s*<<EOF\n(.*?)\nEOF', text, re.S):
+    def substitute(match):
+      if match.group(1) not in variables:
+        raise KeyError("{} uses var.{}, set it with --var".format(name, match.group(1)))
+      return render_variable(variables[match.group(1)])
+    def substitute_optional(match):
+      if variables.get(match.group(1)) is None:
+        return ''
+      return '"{}": {},'.format(match.group(2), render_variable(variables[match.group(1)]))
+    body = re.sub(r'\$\{var\.(\w+) == null \? "" : "\\"(\w+)\\": \$\{var\.\1\},"\}', substitute_optional, body)
+    body = re.sub(r'\$\{var\.(\w+)\}', substitute, body)
+    body = re.sub(r'\$\{[^}]+\}', 'local:activity', body)
+    definitions[name] = json.loads(body)
+  return definitions
+
+# finds a state by name anywhere in a definition, including map processors
+def find_state(machine, name):
+  for state_name, state in machine['States'].items():
+    if state_name == name:
+      return state
+    processor = state.get('ItemProcessor', state.get('Iterator'))
+    if processor:
+      found = find_state(processor, name)
+      if found is not None:
+        return found
+  return None
+
+# applies a --set override like "State Name.ItemBatcher.MaxItemsPerBatch=250"
+def apply_override(definitions, override):
+  target, value = override.split('=', 1)
+  state_name, path = target.split('.', 1)
+  try:
+    value = json.loads(value)
+  except ValueError:
+    pass
+  for machine in definitions.values():
+    state = find_state(machine, state_name)
+    if state is not None:
+      parts = path.split('.')
+      for part in parts[:-1]:
+        state = state.setdefault(part, {})
+      state[parts[-1]] = value
+      return
+  raise KeyError("no state named {}".format(state_name))
+
+# ------------------------------------------------------------
+# paths
+# ------------------------------------------------------------
+
+def get_path(data, path, context=None):
+  if path.startswith('$$'):
+    data, path = context, path[1:]
+  for part in path[2:].split('.') if len(path) > 1 else []:
+    data = data[part]
+  return data
+
+def set_path(data, path, value):
+  if path == '$':
+    return value
+  data = dict(data)
+  node = data
+  parts = path[2:].split('.')
+  for part in parts[:-1]:
+    node[part] = dict(node.get(part, {}))
+    node = node[part]
+  node[parts[-1]] = value
+  return data
+
+# fills in a Parameters / ItemSelector / BatchInput template
+def render(template, data, context=None):
+  if isinstance(template, dict):
+    rendered = {}
+    for key, value in template.items():
+      if key.endswith('.$'):
+        rendered[key[:-2]] = get_path(data, value, context)
+      else:
+        rendered[key] = render(value, data, context)
+    return rendered
+  if isinstance(template, list):
+    return [render(value, data, context) for value in template]
+  return template
+
+def apply_input(state, data, context):
+  path = state.get('InputPath', '$')
+  return {} if path is None else get_path(data, path, context)
+
+def apply_output(state, data, result, context):
+  if 'ResultSelector' in state:
+    result = render(state['ResultSelector'], result, context)
+  path = state.get('ResultPath', '$')
+  data = data if path is None else set_path(data, path, result)
+  path = state.get('OutputPath', '$')
+  return {} if path is None else get_path(data, path, context)
+
+# ------------------------------------------------------------
+# states
+# ------------------------------------------------------------
+
+def run_states(machine, data, run_state):
+  name = machine['StartAt']
+  while True:
+    state = machine['States'][name]
+    if state['Type'] == 'Succeed':
+      return data
+    if state['Type'] == 'Fail':
+      raise StatesError(state.get('Error', 'States.Fail'), state.get('Cause', ''))
+    if state['Type'] == 'Pass':
+      result = render(state['Parameters'], data) if 'Parameters' in state else state.get('Result', apply_input(state, data, None))
+      data = apply_output(state, data, result, None)
+    else:
+      data = run_state(name, state, data)
+    if state.get('End'):
+      return data
+    name = state['Next']
+
+def error_name(error):
+  return getattr(error, 'error', type(error).__name__)
+
+# runs a Task state, retrying the way its Retry block says. the retry
+# intervals are multiplied by retry_scale, 0 retries right away
+def run_task(state, data, context, invoke, retry_scale):
+  effective = apply_input(state, data, context)
+  if 'Parameters' in state:
+    effective = render(state['Parameters'], effective, context)
+  attempts = Counter()
+  while True:
+    try:
+      result = invoke(state['Resource'], effective)
+      break
+    except Exception as error:
+      name = error_name(error)
+      for index, retrier in enumerate(state.get('Retry', [])):
+        if name in retrier['ErrorEquals'] or 'States.ALL' in retrier['ErrorEquals'] or 'States.TaskFailed' in retrier['ErrorEquals']:
+          break
+      else:
+        raise
+      if attempts[index] >= retrier.get('MaxAttempts', 3):
+        raise
+      time.sleep(retrier.get('IntervalSeconds', 1) * retrier.get('BackoffRate', 2.0) ** attempts[index] * retry_scale)
+      attempts[index] += 1
+  return apply_output(state, data, result, context)
+
+# ------------------------------------------------------------
+# worker processes
+# ------------------------------------------------------------
+
+# every S3 call made through the default boto3 session is counted by
+# operation. the handlers create their clients when they are imported, so
+# we register the counter before importing any of them
+requests = Counter()
+requests_lock = threading.Lock()
+scope = threading.local()
+modules = {}
+
+def count_request(model, **kwargs):
+  with requests_lock:
+    requests[model.name] += 1
+    if getattr(scope, 'requests', None) is not None:
+      scope.requests[model.name] += 1
+
+def register_counter():
+  boto3.setup_default_session()
+  boto3.DEFAULT_SESSION.events.register('before-call.s3', count_request)
+
+def init_worker(env, verbose):
+  os.environ.update(env)
+  sys.path[:0] = handler_paths
+  register_counter()
+  # the handlers log a lot, we only show it when asked to
+  if not verbose:
+    sys.stdout = open(os.devnull, 'w')
+
+def call_handler(resource, parameters):
+  if resource == 'arn:aws:states:::lambda:invoke':
+    name = parameters['FunctionName'].split(':')[1]
+    return {'Payload': call_handler('local:' + name, parameters.get('Payload')), 'StatusCode': 200}
+  if resource.startswith('arn:aws:states:::aws-sdk:ecs:'):
+    # there are no workers to scale locally, the pool is always there
+    return {}
+  if not resource.startswith('local:') or resource.split(':')[1] not in handlers:
+    raise StatesError('States.Runtime', 'the emulator does not support {}'.format(resource))
+  module_name, function = handlers[resource.split(':')[1]]
+  if module_name not in modules:
+    modules[module_name] = importlib.import_module(module_name)
+  return getattr(modules[module_name], function)(parameters, None)
+
+# runs one child execution (or a single task of the parent) on a worker
+# process and reports how long it took and which S3 calls it made
+def run_child(machine, data, retry_scale):
+  def run_state(name, state, data):
+    if state['Type'] != 'Task':
+      raise StatesError('States.Runtime', 'the emulator only runs Task and Pass states in a child, {} is a {}'.format(name, state['Type']))
+    return run_task(state, data, {}, call_handler, retry_scale)
+
+  with requests_lock:
+    before = Counter(requests)
+  start = time.perf_counter()
+  output = None
+  error = None
+  try:
+    output = run_states(machine, data, run_state)
+  except Exception as e:
+    error = (error_name(e), str(e))
+  elapsed = time.perf_counter() - start
+  with requests_lock:
+    made = requests - before
+  return output, error, elapsed, made
+
+# ------------------------------------------------------------
+# parent execution
+# ------------------------------------------------------------
+
+class Emulator:
+  def __init__(self, pool, workers, retry_scale):
+    self.pool = pool
+    self.workers = workers
+    self.retry_scale = retry_scale
+    self.s3 = boto3.client('s3')
+    self.stages = {}
+    self.lock = threading.Lock()
+    self.runs = Counter()
+
+  def stage(self, name, kind):
+    with self.lock:
+      if name not in self.stages:
+        self.stages[name] = {
+          'kind': kind,
+          'start': None,
+          'end': None,
+          'items': 0,
+          'batches': 0,
+          'failed': 0,
+          'oversized': 0,
+          'durations': [],
+          'requests': Counter()
+        }
+      return self.stages[name]
+
+  def record(self, stage, start, end, durations, made, items=0, batches=0, failed=0, oversized=0):
+    with self.lock:
+      stage['start'] = start if stage['start'] is None else min(stage['start'], start)
+      stage['end'] = end if stage['end'] is None else max(stage['end'], end)
+      stage['durations'] += durations
+      stage['items'] += items
+      stage['batches'] += batches
+      stage['failed'] += failed
+      stage['oversized'] += oversized
+      stage['requests'].update(made)
+
+  def run(self, machine, data):
+    return run_states(machine, data, self.run_state)
+
+  def run_state(self, name, state, data, context=None):
+    if state['Type'] == 'Task':
+      return self.run_task(name, state, data)
+    if state['Type'] == 'Map':
+      return self.run_map(name, state, data, context)
+    raise StatesError('States.Runtime', 'the emulator does not support {} states'.format(state['Type']))
+
+  # tasks of the parent execution run on the pool too, so their S3 calls
+  # are counted like the ones of the children
+  def run_task(self, name, state, data):
+    stage = self.stage(name, 'task')
+    single = dict(state, End=True)
+    single.pop('Next', None)
+    start = time.perf_counter()
+    output, error, elapsed, made = self.pool.submit(run_child, {'StartAt': name, 'States': {name: single}}, data, self.retry_scale).result()
+    self.record(stage, start, time.perf_counter(), [elapsed], made, items=1, batches=1, failed=1 if error else 0)
+    if error:
+      raise StatesError(*error)
+    return output
+
+  def run_map(self, name, state, data, context):
+    effective = apply_input(state, data, context)
+    processor = state.get('ItemProcessor', state.get('Iterator'))
+    if processor.get('ProcessorConfig', {}).get('Mode', 'INLINE') == 'DISTRIBUTED':
+      result = self.run_distributed(name, state, effective, processor, context)
+    else:
+      result = self.run_inline(state, effective, processor)
+    return apply_output(state, data, result, context)
+
+  # inline iterations run on threads of this process, whatever tasks they
+  # hold go to the pool
+  def run_inline(self, state, data, processor):
+    items = get_path(data, state.get('ItemsPath', '$'))
+    def iteration(index):
+      context = {'Map': {'Item': {'Index': index, 'Value': items[index]}}}
+      value = render(state['ItemSelector'], data, context) if 'ItemSelector' in state else items[index]
+      return run_states(processor, value, lambda name, state, data: self.run_state(name, state, data, context))
+    if not items:
+      return []
+    concurrency = state.get('MaxConcurrency', 0) or len(items)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+      return list(executor.map(iteration, range(len(items))))
+
+  # a distributed map reads its items, batches them and runs every batch as
+  # a child execution on the pool, keeping at most MaxConcurrency children
+  # in flight
+  def run_distributed(self, name, state, data, processor, context):
+    stage = self.stage(name, 'map')
+    start = time.perf_counter()
+    durations = []
+    made = Counter()
+    failed = []
+
+    # the S3 calls the reader and the result writer make from this thread
+    # are counted towards the stage too
+    scope.requests = made
+    try:
+      if 'ItemReader' in state:
+        items = self.read_items(state['ItemReader'], data, context)
+      else:
+        items = get_path(data, state.get('ItemsPath', '$'))
+      children, oversized = self.batch_items(state, items, data, context)
+
+      concurrency = min(state.get('MaxConcurrency', 0) or self.workers, self.workers)
+      results = [None] * len(children)
+      pending = {}
+      queue = iter(enumerate(children))
+      while True:
+        for index, child in queue:
+          pending[self.pool.submit(run_child, processor, child, self.retry_scale)] = index
+          if len(pending) >= concurrency:
+            break
+        if not pending:
+          break
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+          index = pending.pop(future)
+          output, error, elapsed, requests_made = future.result()
+          durations.append(elapsed)
+          made.update(requests_made)
+          results[index] = {'Input': children[index], 'Output': output, 'Error': error}
+          if error:
+            failed.append(index)
+
+      tolerated = state.get('ToleratedFailureCount', 0)
+      percentage = state.get('ToleratedFailurePercentage', 0)
+      output = self.write_results(state, name, results) if 'ResultWriter' in state else [result['Output'] for result in results]
+    finally:
+      scope.requests = None
+    self.record(stage, start, time.perf_counter(), durations, made, items=len(items), batches=len(children), failed=len(failed), oversized=oversized)
+
+    if len(failed) > tolerated and (not children or len(failed) * 100 / len(children) > percentage):
+      error, cause = results[failed[0]]['Error']
+      raise StatesError('States.ExceedToleratedFailureThreshold', '{} children failed, first failure {}: {}'.format(len(failed), error, cause))
+    return output
+
+  def batch_items(self, state, items, data, context):
+    batcher = state.get('ItemBatcher')
+    if batcher is None:
+      children = []
+      for index, item in enumerate(items):
+        item_context = dict(context or {}, Map={'Item': {'Index': index, 'Value': item}})
+        children.append(render(state['ItemSelector'], data, item_context) if 'ItemSelector' in state else item)
+      return children, 0
+
+    batch_input = render(batcher.get('BatchInput', {}), data, context)
+    max_items = batcher.get('MaxItemsPerBatch', 0) or len(items) or 1
+    max_bytes = batcher.get('MaxInputBytesPerBatch', 0) or max_batch_bytes
+    base = len(json.dumps({'BatchInput': batch_input, 'Items': []}))
+    children = []
+    batch = []
+    size = base
+    for item in items:
+      item_size = len(json.dumps(item)) + 1
+      if batch and (len(batch) >= max_items or size + item_size > max_bytes):
+        children.append({'BatchInput': batch_input, 'Items': batch})
+        batch = []
+        size = base
+      batch.append(item)
+      size += item_size
+    if batch:
+      children.append({'BatchInput': batch_input, 'Items': batch})
+    # a single item that doesn't fit would fail the child on step functions
+    oversized = sum(1 for child in children if len(json.dumps(child)) > max_batch_bytes)
+    return children, oversized
+
+  def read_items(self, reader, data, context):
+    parameters = render(reader.get('Parameters', {}), data, context)
+    config = reader.get('ReaderConfig', {})
+    items = []
+    if reader['Resource'].endswith('s3:listObjectsV2'):
+      for page in self.s3.get_paginator('list_objects_v2').paginate(**parameters):
+        for obj in page.get('Contents', []):
+          items.append({
+            'Etag': obj['ETag'],
+            'Key': obj['Key'],
+            'LastModified': int(obj['LastModified'].timestamp()),
+            'Size': obj['Size'],
+            'StorageClass': obj.get('StorageClass', 'STANDARD')
+          })
+    elif reader['Resource'].endswith('s3:getObject'):
+      body = self.s3.get_object(**parameters)['Body'].read()
+      input_type = config.get('InputType', 'JSON')
+      if input_type == 'CSV':
+        if config.get('CSVHeaderLocation', 'FIRST_ROW') == 'FIRST_ROW':
+          items = list(csv.DictReader(body.decode('utf-8').splitlines()))
+        else:
+          items = [dict(zip(config['CSVHeaders'], row)) for row in csv.reader(body.decode('utf-8').splitlines())]
+      elif input_type == 'MANIFEST':
+        manifest = json.loads(body)
+        columns = [column.strip() for column in manifest['fileSchema'].split(',')]
+        for file in manifest['files']:
+          content = self.s3.get_object(Bucket=parameters['Bucket'], Key=file['key'])['Body'].read()
+          if file['key'].endswith('.gz'):
+            content = gzip.decompress(content)
+          items += [dict(zip(columns, row)) for row in csv.reader(content.decode('utf-8').splitlines())]
+      else:
+        items = json.loads(body)
+    else:
+      raise StatesError('States.Runtime', 'the emulator does not support {}'.format(reader['Resource']))
+    if config.get('MaxItems'):
+      items = items[:config['MaxItems']]
+    return items
+
+  # writes the child results the way ResultWriter does, a manifest plus
+  # one file for the succeeded and one for the failed children
+  def write_results(self, state, name, results):
+    parameters = render(state['ResultWriter']['Parameters'], {})
+    with self.lock:
+      self.runs[name] += 1
+      run = '{}-{}'.format(state.get('Label', name.replace(' ', '')), self.runs[name])
+    prefix = parameters['Prefix'].rstrip('/') + '/' + run + '/'
+    succeeded = [{'Input': json.dumps(r['Input']), 'Output': json.dumps(r['Output']), 'Status': 'SUCCEEDED'} for r in results if not r['Error']]
+    failed = [{'Input': json.dumps(r['Input']), 'Error': r['Error'][0], 'Cause': r['Error'][1], 'Status': 'FAILED'} for r in results if r['Error']]
+    files = []
+    for status, entries in (('SUCCEEDED', succeeded), ('FAILED', failed)):
+      if entries:
+        key = prefix + status + '_0.json'
+        body = json.dumps(entries).encode('utf-8')
+        self.s3.put_object(Bucket=parameters['Bucket'], Key=key, Body=body)
+        files.append({'Key': key, 'Size': len(body)})
+    manifest = {'DestinationBucket': parameters['Bucket'], 'MapRunArn': 'local:' + run, 'ResultFiles': {'SUCCEEDED': [f for f in files if 'SUCCEEDED' in f['Key']], 'FAILED': [f for f in files if 'FAILED' in f['Key']]}}
+    self.s3.put_object(Bucket=parameters['Bucket'], Key=prefix + 'manifest.json', Body=json.dumps(manifest).encode('utf-8'))
+    return {'ResultWriterDetails': {'Bucket': parameters['Bucket'], 'Key': prefix + 'manifest.json'}}
+
+# ------------------------------------------------------------
+# report
+# ------------------------------------------------------------
+
+def percentile(values, p):
+  if not values:
+    return 0.0
+  values = sorted(values)
+  return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def summarize(stages):
+  report = []
+  for name, stage in stages.items():
+    seconds = (stage['end'] or 0) - (stage['start'] or 0)
+    report.append({
+      'stage': name,
+      'kind': stage['kind'],
+      'seconds': round(seconds, 3),
+      'items': stage['items'],
+      'batches': stage['batches'],
+      'failed': stage['failed'],
+      'oversized_batches': stage['oversized'],
+      'items_per_second': round(stage['items'] / seconds, 1) if seconds else 0,
+      'child_p50': round(percentile(stage['durations'], 50), 3),
+      'child_p95': round(percentile(stage['durations'], 95), 3),
+      'child_max': round(max(stage['durations'] or [0]), 3),
+      's3_requests': sum(stage['requests'].values()),
+      's3_operations': dict(stage['requests'].most_common())
+    })
+  return report
+
+def print_report(report):
+  print("{:<36} {:>9} {:>9} {:>8} {:>7} {:>10} {:>8} {:>8} {:>8} {:>9}".format(
+    'stage', 'seconds', 'items', 'batches', 'failed', 'items/sec', 'p50 s', 'p95 s', 'max s', 's3 calls'))
+  for row in report:
+    print("{:<36} {:>9.3f} {:>9} {:>8} {:>7} {:>10.1f} {:>8.3f} {:>8.3f} {:>8.3f} {:>9}".format(
+      row['stage'][:36], row['seconds'], row['items'], row['batches'], row['failed'], row['items_per_second'],
+      row['child_p50'], row['child_p95'], row['child_max'], row['s3_requests']))
+    print("{:<36} {}".format('', ', '.join('{}={}'.format(op, n) for op, n in row['s3_operations'].items())))
+    if row['oversized_batches']:
+      print("{:<36} {} batches exceed the 256 KiB child input limit".format('', row['oversized_batches']))
+
+# ------------------------------------------------------------
+# main
+# ------------------------------------------------------------
+
+def free_port():
+  with socket.socket() as s:
+    s.bind(('127.0.0.1', 0))
+    return s.getsockname()[1]
+
+def start_s3(port, verbose):
+  try:
+    from moto.server import ThreadedMotoServer
+  except ImportError:
+    print('the emulator needs a local S3, install it with: pip install "moto[server]"')
+    sys.exit(1)
+  server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+  if not verbose:
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+  server.start()
+  return server
+
+def main():
+  parser = argparse.ArgumentParser(description="Run the monte carlo workflows locally and report per-stage metrics")
+  parser.add_argument('workflow', nargs='?', default='all', choices=['all', 'datagen'], help="all runs data generation followed by processing")
+  parser.add_argument('--records', type=int, default=1000, help="number of loans to generate (RECORDCOUNT)")
+  parser.add_argument('--fedrate', default='8', help="federal rate for the simulation (FEDRATE)")
+  parser.add_argument('--compute', default='lambda', choices=['lambda', 'ecs'], help="which processing state machine to run")
+  parser.add_argument('--workers', type=int, default=os.cpu_count(), help="size of the process pool, caps every MaxConcurrency")
+  parser.add_argument('--var', action='append', default=[], metavar='NAME=VALUE', help="override a stepfunctions module variable")
+  parser.add_argument('--set', action='append', default=[], metavar='STATE.PATH=VALUE', help="override a field of a state, e.g. \"File Generation DMap.MaxConcurrency=10\"")
+  parser.add_argument('--retry-scale', type=float, default=0, help="multiplier for Retry intervals, 0 retries right away")
+  parser.add_argument('--json', action='store_true', help="print the report as JSON")
+  parser.add_argument('--verbose', action='store_true', help="show the output of the handlers and the S3 server")
+  args = parser.parse_args()
+
+  variables = load_variables(os.path.join(module, 'variables.tf'))
+  variables.update(local_variables)
+  variables['compute'] = args.compute
+  for override in args.var:
+    name, value = override.split('=', 1)
+    try:
+      variables[name] = json.loads(value)
+    except ValueError:
+      variables[name] = value
+  definitions = load_definitions(os.path.join(module, 'sfn.tf'), variables)
+  for override in args.set:
+    apply_override(definitions, override)
+
+  # everything, including the worker processes, talks to the local S3 only
+  port = free_port()
+  for name in ('AWS_PROFILE', 'AWS_SESSION_TOKEN'):
+    os.environ.pop(name, None)
+  env = {
+    'AWS_ENDPOINT_URL': 'http://127.0.0.1:{}'.format(port),
+    'AWS_ACCESS_KEY_ID': 'local',
+    'AWS_SECRET_ACCESS_KEY': 'local',
+    'AWS_DEFAULT_REGION': variables['region'],
+    'REGION': variables['region'],
+    'RECORDCOUNT': str(args.records),
+    'FEDRATE': str(args.fedrate)
+  }
+  os.environ.update(env)
+  server = start_s3(port, args.verbose)
+  register_counter()
+  s3 = boto3.client('s3')
+  s3.create_bucket(Bucket=variables['sourcebucket'])
+  s3.create_bucket(Bucket=variables['destinationbucket'])
+
+  names = ['datagen'] if args.workflow == 'datagen' else ['datagen', 'process']
+  # spawn, so the workers don't inherit the threads of the S3 server
+  context = multiprocessing.get_context('spawn')
+  try:
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=context, initializer=init_worker, initargs=(env, args.verbose)) as pool:
+      emulator = Emulator(pool, args.workers, args.retry_scale)
+      for name in names:
+        start = time.perf_counter()
+        emulator.run(definitions[workflows[name](args.compute)], {})
+        if not args.json:
+          print("{} workflow finished in {:.3f}s".format(name, time.perf_counter() - start))
+  finally:
+    server.stop()
+
+  report = summarize(emulator.stages)
+  if args.json:
+    print(json.dumps(report, indent=2))
+  else:
+    print_report(report)
+
+if __name__ == "__main__":
+  main()
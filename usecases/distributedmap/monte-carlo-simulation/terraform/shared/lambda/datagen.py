@@ -1,24 +1,87 @@
 import boto3
 import csv
-from random import uniform, randrange, randint
-from datetime import datetime, timedelta
-from io import StringIO
+import numpy as np
+from datetime import datetime
+from io import BytesIO, StringIO
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
 import os
 
 region = os.getenv('REGION')
 count = os.getenv('RECORDCOUNT')
-s3_client = boto3.client('s3', region_name=region)
+
+# how many PUTs we keep in flight at the same time. the default can be
+# overridden with put_concurrency in the BatchInput of the workflow
+put_concurrency = 16
+max_put_concurrency = 64
+
+s3_client = boto3.client('s3', region_name=region, config=Config(max_pool_connections=max_put_concurrency))
 s3 = boto3.resource('s3')
 terms = [12, 24, 36, 48, 60, 72, 84, 96, 108, 120]
-term = terms[randint(0,9)]
-end = datetime.now()
-start = end - timedelta(days=((term / 12) * 365))
 
-def random_date(start, end):
-  delta = end - start
-  int_delta = (delta.days * 24 * 60 * 60) + delta.seconds
-  random_second = randrange(int_delta)
-  return start + timedelta(seconds=random_second)
+# with a seed in the BatchInput every batch draws from its own random
+# stream, keyed on the seed and the first record of the batch. re-running a
+# batch (or the whole run) then produces exactly the same loans. the
+# simulation in the montecarlo engine uses stream 1 of the same seed
+datagen_stream = 0
+
+headers = ['AccountID', 'ZipCode', 'Rate', 'Payment', 'LoanAmount', 'LoanTerm', 'OriginationDate', 'GrossIncome']
+
+# shards above the threshold are sent as multipart uploads
+transfer_config = TransferConfig(multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024)
+
+def get_rng(seed, first):
+  if seed is None:
+    return np.random.default_rng()
+  return np.random.default_rng(np.random.SeedSequence(int(seed), spawn_key=(datagen_stream, int(first))))
+
+# every loan was originated somewhere within its term before the as_of date
+def random_dates(rng, end, term):
+  seconds = rng.integers(0, (term / 12 * 365 * 24 * 60 * 60).astype('int64'))
+  dates = np.datetime_as_string(np.datetime64(end, 's') - seconds.astype('timedelta64[s]'), unit='D')
+  return [d[5:7] + '/' + d[8:10] + '/' + d[0:4] for d in dates]
+
+# instead of drawing every field of every loan one at a time we generate
+# whole columns at once and zip them into rows afterwards
+def generate_rows(rng, end, size):
+  term = rng.choice(terms, size)
+  return list(zip(
+    rng.integers(1000000, 10000000, size).tolist(),
+    rng.integers(10000, 100000, size).tolist(),
+    rng.uniform(1.0, 9.9, size).round(2).tolist(),
+    rng.integers(1000, 10001, size).tolist(),
+    rng.integers(10000, 10000001, size).tolist(),
+    term.tolist(),
+    random_dates(rng, end, term),
+    rng.integers(50000, 5000001, size).tolist()
+  ))
+
+# the origination dates are anchored to as_of (YYYY-MM-DD) when it's set in
+# the BatchInput, otherwise to today. the time of day is dropped so batches
+# of the same run agree on the anchor
+def get_as_of(value):
+  if value:
+    return datetime.strptime(value, '%Y-%m-%d')
+  return datetime.combine(datetime.utcnow().date(), datetime.min.time())
+
+def render(rows):
+  stream = StringIO()
+  writer = csv.writer(stream)
+  writer.writerow(headers)
+  writer.writerows(rows)
+  return stream.getvalue().encode('utf-8')
+
+# small objects go out as a single PUT, large shards are uploaded in parts
+def put_object(bucket, key, body):
+  if len(body) < transfer_config.multipart_threshold:
+    s3_client.put_object(Bucket=bucket, Key=key, Body=body)
+  else:
+    s3_client.upload_fileobj(BytesIO(body), bucket, key, Config=transfer_config)
+  return {
+    'Key': key,
+    'Size': len(body)
+  }
 
 def get_zeroes(current, total):
   x = total - len(str(current))
@@ -28,45 +91,37 @@ def get_zeroes(current, total):
   return ret + str(current)
 
 def lambda_handler(event, context):
-  batch = []
   length = len(str(count))
-  first = get_zeroes(event['Items'][0]['num'], length)
-  last = get_zeroes(event['Items'][len(event['Items']) - 1]['num'], length)
-  for item in event['Items']:
-    data = [{
-      'AccountID': randint(1000000,9999999),
-      'ZipCode': randint(10000,99999),
-      'Rate': round(uniform(1.0,9.9), 2),
-      'Payment': randint(1000,10000),
-      'LoanAmount': randint(10000,10000000),
-      'LoanTerm': term,
-      'OriginationDate': random_date(start, end).strftime('%m/%d/%Y'),
-      'GrossIncome': randint(50000,5000000)
-    }]
-
-    stream = StringIO()
-    headers = list(data[0].keys())
-    writer = csv.DictWriter(stream, fieldnames=headers)
-    writer.writeheader()
-    writer.writerows(data)
-    body = stream.getvalue()
-
-    number = get_zeroes(item['num'], length)
-
-    dst = s3.Object(event['BatchInput']['bucket'], 'data/data-gen-' + str(number) + '.csv')
-    dst.put(Body=body)
-
-    batch.append({
-      'Key': 'data/data-gen-' + number + '.csv',
-      'Size': len(body.encode('utf-8'))
-    })
-  
+  bucket = event['BatchInput']['bucket']
+  numbers = [get_zeroes(item['num'], length) for item in event['Items']]
+  first = numbers[0]
+  last = numbers[len(numbers) - 1]
+
+  # by default every loan is written to its own object. with records_per_object
+  # above 1 we write multi-record shards instead, named after the first record
+  # they hold, so the data/data-gen-NNN.csv keyspace stays the same for the
+  # rest of the pipeline
+  per_object = max(1, int(event['BatchInput'].get('records_per_object', 1)))
+  concurrency = max(1, min(int(event['BatchInput'].get('put_concurrency', put_concurrency)), max_put_concurrency))
+
+  rng = get_rng(event['BatchInput'].get('seed'), event['Items'][0]['num'])
+  rows = generate_rows(rng, get_as_of(event['BatchInput'].get('as_of')), len(numbers))
+  shards = [(numbers[i], rows[i:i + per_object]) for i in range(0, len(rows), per_object)]
+
+  # the PUTs run concurrently, map keeps the results in the same order as
+  # our shards so the batch file below lists them in order
+  with ThreadPoolExecutor(max_workers=concurrency) as executor:
+    batch = list(executor.map(
+      lambda shard: put_object(bucket, 'data/data-gen-' + shard[0] + '.csv', render(shard[1])),
+      shards
+    ))
+
   stream = StringIO()
-  headers = list(batch[0].keys())
-  writer = csv.DictWriter(stream, fieldnames=headers)
+  fields = list(batch[0].keys())
+  writer = csv.DictWriter(stream, fieldnames=fields)
   writer.writeheader()
   writer.writerows(batch)
   body = stream.getvalue()
 
-  dst = s3.Object(event['BatchInput']['bucket'], 'temp/data-batch-' + str(first) + '-' + str(last) + '.csv')
-  dst.put(Body=body)
\ No newline at end of file
+  dst = s3.Object(bucket, 'temp/data-batch-' + str(first) + '-' + str(last) + '.csv')
+  dst.put(Body=body)
@@ -1,26 +1,30 @@
 import boto3
-import csv
-from io import StringIO
+import io
+from boto3.s3.transfer import TransferConfig
 import os
+from s3io import ChunkStream
 
 region = os.getenv('REGION')
 count = os.getenv('RECORDCOUNT')
 s3_client = boto3.client('s3', region_name=region)
-s3 = boto3.resource('s3')
 
-def lambda_handler(event, context):
-  data = []
-  for i in range(1, (int(count) + 1)):
-    data.append({
-      'num': i
-    })
+# the numbers are rendered in blocks and uploaded in parts while we render
+# them, so memory stays flat no matter how many records we seed
+block_size = 100000
+transfer_config = TransferConfig(
+  multipart_threshold=8 * 1024 * 1024,
+  multipart_chunksize=8 * 1024 * 1024,
+  max_concurrency=4
+)
 
-  stream = StringIO()
-  headers = list(data[0].keys())
-  writer = csv.DictWriter(stream, fieldnames=headers)
-  writer.writeheader()
-  writer.writerows(data)
-  body = stream.getvalue()
+# the same csv that csv.DictWriter used to produce, header and \r\n line endings
+# included, one block of numbers at a time
+def generate_numbers(total):
+  yield b'num\r\n'
+  for start in range(1, total + 1, block_size):
+    end = min(start + block_size, total + 1)
+    yield ('\r\n'.join(map(str, range(start, end))) + '\r\n').encode('utf-8')
 
-  dst = s3.Object(event['bucket'], 'inventory/numbers.csv')
-  dst.put(Body=body)
\ No newline at end of file
+def lambda_handler(event, context):
+  stream = io.BufferedReader(ChunkStream(generate_numbers(int(count))))
+  s3_client.upload_fileobj(Fileobj=stream, Bucket=event['bucket'], Key='inventory/numbers.csv', Config=transfer_config)
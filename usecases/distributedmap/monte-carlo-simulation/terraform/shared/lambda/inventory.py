@@ -1,16 +1,30 @@
 import boto3
 import csv
-import gzip
-from io import StringIO
-from io import BytesIO
+import io
+import zlib
+from boto3.s3.transfer import TransferConfig
 from botocore.client import Config
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import os
+from s3io import ChunkStream
 
 # set a few variables we'll use to get our data
 region = os.getenv('REGION')
 count = os.getenv('RECORDCOUNT')
-s3_client = boto3.client('s3', region_name=region)
-s3 = boto3.resource('s3')
+
+# how many temp batch files we download at the same time
+fetch_concurrency = 32
+
+s3_client = boto3.client('s3', region_name=region, config=Config(max_pool_connections=fetch_concurrency))
+
+# the merged inventory is uploaded in parts while we produce it, so we only
+# ever hold a few parts in memory no matter how many records we merge
+transfer_config = TransferConfig(
+  multipart_threshold=8 * 1024 * 1024,
+  multipart_chunksize=8 * 1024 * 1024,
+  max_concurrency=4
+)
 
 def get_zeroes(current, total):
   x = total - len(str(current))
@@ -19,36 +33,59 @@ def get_zeroes(current, total):
     ret = ret + "0"
   return ret + str(current)
 
+# the temp batch files are named temp/data-batch-<first>-<last>.csv, so we
+# know the id range of the merged inventory from the keys alone and can
+# name the output before we start streaming it
+def get_range(key):
+  parts = key.split('/')[-1].replace('.csv', '').split('-')
+  return int(parts[2]), int(parts[3])
+
+# downloads the temp batch files on a bounded pool of threads and hands them
+# back in order, keeping only a small window of bodies in memory
+def fetch_objects(bucket, keys):
+  with ThreadPoolExecutor(max_workers=fetch_concurrency) as executor:
+    window = deque()
+    for key in keys:
+      window.append(executor.submit(lambda k: s3_client.get_object(Bucket=bucket, Key=k)['Body'].read(), key))
+      if len(window) >= fetch_concurrency * 2:
+        yield window.popleft().result()
+    while window:
+      yield window.popleft().result()
+
+# parses the temp batch files one at a time and yields the gzip compressed
+# inventory rows as they are produced
+def generate_inventory(bucket, keys):
+  compressor = zlib.compressobj(wbits=31)
+  stream = io.StringIO()
+  writer = csv.writer(stream)
+  for content in fetch_objects(bucket, keys):
+    reader = csv.reader(io.StringIO(content.decode('utf-8')))
+    header = next(reader, None)
+    if header is None:
+      continue
+    key_column = header.index('Key')
+    size_column = header.index('Size')
+    for row in reader:
+      writer.writerow([bucket, row[key_column], row[size_column]])
+
+    chunk = compressor.compress(stream.getvalue().encode('utf-8'))
+    stream.seek(0)
+    stream.truncate()
+    if chunk:
+      yield chunk
+  yield compressor.flush()
+
 def lambda_handler(event, context):
-  data = []
   length = len(str(count))
+  bucket = event['BatchInput']['bucket']
+  keys = [item['Key'] for item in event['Items']]
+
   start = 0
   end = 0
-  for x in range(0, len(event['Items'])):
-    source = s3_client.get_object(Bucket=event['BatchInput']['bucket'], Key=event['Items'][x]['Key'])
-    content = source.get('Body').read().decode('utf-8')
-    buf = StringIO(content)
-    reader = csv.DictReader(buf)
-    objects = list(reader)
-  
-    for item in objects:
-      start = int(item['Key'].split('-')[2].replace('.csv','')) if int(item['Key'].split('-')[2].replace('.csv','')) < int(start) or int(start) == 0 else int(start)
-      end = int(item['Key'].split('-')[2].replace('.csv','')) if int(item['Key'].split('-')[2].replace('.csv','')) > int(end) else int(end)
-      data.append({
-        'Bucket': event['BatchInput']['bucket'],
-        'Key': item['Key'],
-        'Size': item['Size']
-      })
-
-  mem = BytesIO()
-  with gzip.GzipFile(fileobj=mem, mode='w') as gz:
-    stream = StringIO()
-    headers = list(data[0].keys())
-    writer = csv.DictWriter(stream, fieldnames=headers)
-    writer.writerows(data)
-
-    gz.write(stream.getvalue().encode())
-    gz.close()
-    mem.seek(0)
-
-  s3_client.upload_fileobj(Fileobj=mem, Bucket=event['BatchInput']['bucket'], Key='inventory/data-gen-' + str(get_zeroes(start, length)) + '-' + str(get_zeroes(end, length)) + '.csv.gz')
\ No newline at end of file
+  for key in keys:
+    first, last = get_range(key)
+    start = first if first < start or start == 0 else start
+    end = last if last > end else end
+
+  stream = io.BufferedReader(ChunkStream(generate_inventory(bucket, keys)))
+  s3_client.upload_fileobj(Fileobj=stream, Bucket=bucket, Key='inventory/data-gen-' + str(get_zeroes(start, length)) + '-' + str(get_zeroes(end, length)) + '.csv.gz', Config=transfer_config)
@@ -1,27 +1,137 @@
 import boto3
+import hashlib
 import json
+from botocore.client import Config
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import time
 
-s3_client = boto3.client("s3")
-s3 = boto3.resource("s3")
+# how many objects we hash at the same time when checksums are asked for
+checksum_concurrency = 32
+
+# how many manifest parts we upload at the same time
+upload_concurrency = 4
+
+s3_client = boto3.client('s3', config=Config(max_pool_connections=checksum_concurrency + upload_concurrency))
+
+# the file list is cut into manifest parts of about this many bytes, so we
+# never hold more than a few parts in memory. when every file fits into one
+# part the list goes straight into manifest.json like it always did.
+# part_bytes in the event overrides this per run
+part_bytes = 8 * 1024 * 1024
+
+# streams the inventory files page by page as they are listed
+def list_files(bucket, prefix):
+  for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+    for obj in page.get('Contents', []):
+      yield {
+        'key': obj['Key'],
+        'size': obj['Size']
+      }
+
+# the ETag is only the MD5 of the content for objects uploaded in one part
+# without SSE-KMS, our inventory files are uploaded in parts. so when
+# checksums are asked for we read the objects and hash them ourselves
+def get_md5(bucket, key):
+  digest = hashlib.md5()
+  for chunk in s3_client.get_object(Bucket=bucket, Key=key)['Body'].iter_chunks(1024 * 1024):
+    digest.update(chunk)
+  return digest.hexdigest()
+
+# hashes the files on a bounded pool of threads and hands them back in order
+def add_checksums(bucket, files):
+  with ThreadPoolExecutor(max_workers=checksum_concurrency) as executor:
+    window = deque()
+    for file in files:
+      window.append((file, executor.submit(get_md5, bucket, file['key'])))
+      if len(window) >= checksum_concurrency * 2:
+        file, future = window.popleft()
+        yield dict(file, MD5checksum=future.result())
+    while window:
+      file, future = window.popleft()
+      yield dict(file, MD5checksum=future.result())
+
+# a json part is a manifest of its own, a jsonl part holds one file per line.
+# the entries are encoded once, when they are listed, and joined here
+def encode_part(header, entries, encoding):
+  if encoding == 'jsonl':
+    return ''.join(entry + '\n' for entry in entries)
+  return '{' + json.dumps(header)[1:-1] + ', "files": [' + ', '.join(entries) + ']}'
+
+# records the next part in parts and hands its upload to the executor, parts
+# are named after manifest.json, manifest-00001.json and so on
+def submit_part(executor, bucket, manifest_key, header, entries, encoding, parts):
+  key = manifest_key.replace('.json', '') + '-{:05d}.{}'.format(len(parts) + 1, encoding)
+  body = encode_part(header, entries, encoding).encode('utf-8')
+  parts.append({
+    'key': key,
+    'size': len(body),
+    'count': len(entries)
+  })
+  return executor.submit(s3_client.put_object, Bucket=bucket, Key=key, Body=body)
 
 def lambda_handler(event, context):
-  files = []
-  for item in event['Items']:
-    files.append({
-      "key": item['Key'],
-      "size": item['Size'],
-      "MD5checksum": item['Etag'].replace('"','')
-    })
-  manifest = {
-    "sourceBucket" : event['BatchInput']['bucket'],
-    "destinationBucket" : "arn:aws:s3:::" + event['BatchInput']['bucket'],
+  bucket = event['bucket']
+  prefix = event.get('prefix', 'inventory/data-gen-')
+  manifest_key = event.get('key', 'inventory/manifest.json')
+  encoding = event.get('format', 'json')
+  target_bytes = int(event.get('part_bytes', part_bytes))
+
+  header = {
+    "sourceBucket" : bucket,
+    "destinationBucket" : "arn:aws:s3:::" + bucket,
     "version" : "2016-11-30",
     "creationTimestamp" : time.mktime(datetime.now().timetuple()),
     "fileFormat" : "CSV",
-    "fileSchema" : "Bucket, Key, Size",
-    "files" : files
+    "fileSchema" : "Bucket, Key, Size"
+  }
+
+  files = list_files(bucket, prefix)
+  if event.get('checksums'):
+    files = add_checksums(bucket, files)
+
+  parts = []
+  pending = []
+  entries = []
+  size = 0
+  total = 0
+  with ThreadPoolExecutor(max_workers=upload_concurrency) as executor:
+    for file in files:
+      entry = json.dumps(file)
+      entries.append(entry)
+      size += len(entry) + 2
+      total += 1
+      if size < target_bytes:
+        continue
+
+      # the part is full, it goes up in the background while we keep listing
+      pending.append(submit_part(executor, bucket, manifest_key, header, entries, encoding, parts))
+      entries = []
+      size = 0
+
+      # don't let finished parts pile up in memory faster than we upload them
+      if len(pending) >= upload_concurrency * 2:
+        pending.pop(0).result()
+
+    if not parts:
+      # everything fits into manifest.json
+      body = encode_part(header, entries, 'json')
+    else:
+      # the rest goes into a last part and manifest.json points at the parts
+      if entries:
+        pending.append(submit_part(executor, bucket, manifest_key, header, entries, encoding, parts))
+      body = json.dumps(dict(header, files=[], parts=parts))
+
+    # manifest.json is written last, once all of its parts are in place
+    for future in pending:
+      future.result()
+  s3_client.put_object(Bucket=bucket, Key=manifest_key, Body=body.encode('utf-8'))
+
+  print("Wrote {} files to {} in {} parts".format(total, manifest_key, len(parts)))
+  return {
+    'bucket': bucket,
+    'key': manifest_key,
+    'files': total,
+    'parts': len(parts)
   }
-  dst = s3.Object(event['BatchInput']['bucket'], 'inventory/manifest.json')
-  dst.put(Body=(bytes(json.dumps(manifest).encode('UTF-8'))))
\ No newline at end of file
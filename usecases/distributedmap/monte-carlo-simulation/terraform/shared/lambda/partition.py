@@ -1,15 +1,111 @@
 import boto3
 import json
 import csv
+import numpy as np
 import pandas as pd
-import io
+import pyarrow.parquet as pq
 import os
+from concurrent.futures import ThreadPoolExecutor
+from s3io import S3File
 
 region = os.getenv('REGION')
 count = os.getenv('RECORDCOUNT')
 s3_client = boto3.client('s3', region_name=region)
 s3_resource = boto3.resource('s3')
 
+# when sampling we re-partition the inventory into parts of this many rows.
+# partition_target_rows and partition_target_bytes in the workshop_variables
+# block override this per run, a part is closed before it would go over
+# either of them. bytes are the utf-8 encoded size of the part
+partition_target_rows = 250000
+partition_target_bytes = 0
+
+# we read the inventory files in chunks of this many rows, so memory depends
+# on the chunk and part size and not on the size of the inventory
+chunk_rows = 50000
+
+# how many parts we upload at the same time
+upload_concurrency = 8
+
+# reads an inventory file chunk by chunk. CSV files (gzip or plain) are
+# streamed straight from S3, parquet S3 Inventory reports are read one row
+# group at a time with ranged GETs, so we never download the whole file.
+# parquet inventories carry more columns than we need, we only keep bucket,
+# key and size and rename them to match the CSV inventories. any other
+# parquet file (like the simulation output) isn't an inventory
+def read_inventory(bucket, key, inventory_format):
+  if inventory_format == 'PARQUET' or key.endswith('.parquet'):
+    parquet = pq.ParquetFile(S3File(s3_client, bucket, key))
+    columns = {c.lower(): c for c in parquet.schema_arrow.names}
+    missing = [c for c in ('bucket', 'key', 'size') if c not in columns]
+    if missing:
+      raise ValueError('{} is not an S3 Inventory file, it has no {} column'.format(key, ', '.join(missing)))
+    for group in range(parquet.num_row_groups):
+      df = parquet.read_row_group(group, columns=[columns['bucket'], columns['key'], columns['size']]).to_pandas()
+      df.columns = ['Bucket', 'Key', 'Size']
+      for start in range(0, len(df), chunk_rows):
+        yield df.iloc[start:start + chunk_rows]
+  else:
+    body = s3_client.get_object(Bucket=bucket, Key=key)['Body']
+    # if the key contains .gz then we are reading the .gz file and not the .csv file
+    compression = 'gzip' if '.gz' in key else None
+    for df in pd.read_csv(body, compression=compression, names=['Bucket', 'Key', 'Size'], header=None, chunksize=chunk_rows):
+      yield df
+
+# manifest.json lists the inventory files itself or, for large inventories,
+# points at the manifest parts the manifest function wrote. parts are json
+# manifests of their own or json lines with one file per line, we read them
+# one at a time
+def manifest_files(bucket, manifest):
+  for file in manifest['files']:
+    yield file
+  for part in manifest.get('parts', []):
+    body = s3_client.get_object(Bucket=bucket, Key=part['key'])['Body']
+    if part['key'].endswith('.jsonl'):
+      for line in body.iter_lines():
+        if line:
+          yield json.loads(line)
+    else:
+      for file in json.loads(body.read())['files']:
+        yield file
+
+# the utf-8 encoded csv lines of a chunk, one per row. a key with a line
+# break in it is quoted and spans several lines, when that happens we encode
+# the rows of the chunk one by one
+def encode_rows(df):
+  lines = df.to_csv(index=False, header=False).encode('utf-8').splitlines(keepends=True)
+  if len(lines) == len(df):
+    return lines
+  return [df.iloc[i:i + 1].to_csv(index=False, header=False).encode('utf-8') for i in range(len(df))]
+
+# uploads one re-partitioned inventory part together with its manifest
+def write_part(bucket, csv_name, body, manifest_name, inventory_manifest):
+  s3_resource.Object(bucket, csv_name).put(Body=body)
+  inventory_manifest['files'].append({
+    'key': csv_name,
+    'size': len(body)
+  })
+  print(inventory_manifest)
+  s3_resource.Object(bucket, manifest_name).put(Body=json.dumps(inventory_manifest))
+
+# builds the manifest for a part, records it in the output manifest (in
+# order) and hands the upload to the executor
+def submit_part(executor, original_manifest_json, bucket, prefix, im, part, output_manifest_manifest):
+  inventory_manifest = {
+    'files': []
+  }
+  inventory_manifest['sourceBucket'] = original_manifest_json['sourceBucket']
+  inventory_manifest['destinationBucket'] = original_manifest_json['destinationBucket']
+  inventory_manifest['fileFormat'] = 'CSV'
+  inventory_manifest['fileSchema'] = 'Bucket, Key, Size'
+  csv_tmp_name = prefix + 'inventory-' + format(im) + '.csv'
+  manifest_name = prefix + 'manifest--{}.json'.format(im)
+  output_manifest_manifest['files'].append({
+    'key': manifest_name,
+    'bucket': bucket
+  })
+  return executor.submit(write_part, bucket, csv_tmp_name, b''.join(part), manifest_name, inventory_manifest)
+
 def lambda_handler(event, context):
   bucket_v = event['inventory']['bucket']
   manifest_key_v = event['inventory']['key']
@@ -19,7 +115,6 @@ def lambda_handler(event, context):
   original_manifest_json = json.loads(original_manifest['Body'].read())
   print(original_manifest_json)
   bucket = s3_resource.Bucket(bucket_v)
-  df_batch_inventory = pd.DataFrame()
   output_manifest_manifest = {
     'files': []
   }
@@ -29,10 +124,14 @@ def lambda_handler(event, context):
   total_records = 0
   output_records = 0
   
+  # step functions only reads CSV inventories, so parquet inventories always
+  # go through the rewrite below even when we don't sample
+  inventory_format = original_manifest_json['fileFormat'].upper()
+
   #If not sampling the input (sampling = 1) then we can just re-write manifest.json files only
   manifest_counter = 1
-  if input_sampling == 1:
-    for file in original_manifest_json['files']:
+  if input_sampling == 1 and inventory_format == 'CSV':
+    for file in manifest_files(bucket_v, original_manifest_json):
       inventory_manifest = {
         'files': []
       }
@@ -53,50 +152,74 @@ def lambda_handler(event, context):
       manifest_counter += 1
   #If sampling or filtering the input dataset we will read and process the inventory CVS's and create modified versions for processing        
   else:
+    # we stream through the inventory chunk by chunk, sample as we go and
+    # cut the sampled rows into parts that are uploaded in the background.
+    # the sampling offset carries over from chunk to chunk (and file to
+    # file), so we keep every n-th record of the whole inventory
+    target_rows = int(event['workshop_variables'].get('partition_target_rows', partition_target_rows))
+    target_bytes = int(event['workshop_variables'].get('partition_target_bytes', partition_target_bytes))
     im = 1
-    i_files = 1
-    for file in original_manifest_json['files']:
-      obj = s3_resource.Object(bucket_v,file['key'])
-      print(obj.key)
-      obj_data = io.BytesIO(obj.get()['Body'].read())
-      # if file['key'] contains .gz then we are reading the .gz file and not the .csv file
-      if '.gz' in file['key']:
-        df_temp = pd.read_csv(obj_data, compression='gzip', names=['Bucket', 'Key', 'Size'], header=None)
-      else:
-        df_temp = pd.read_csv(obj_data, names=['Bucket', 'Key', 'Size'], header=None)
-      total_records += len(df_temp)
-      print("Current observed record count: " + format(total_records))
-      df_batch_inventory = pd.concat([df_batch_inventory,df_temp])
-      if (len(df_batch_inventory) > 250000) or i_files == len(original_manifest_json['files']):
-        inventory_manifest = {
-          'files': []
-        }
-        inventory_manifest['sourceBucket'] = original_manifest_json['sourceBucket']
-        inventory_manifest['destinationBucket'] = original_manifest_json['destinationBucket']
-        inventory_manifest['fileFormat'] = original_manifest_json['fileFormat']
-        inventory_manifest['fileSchema'] = original_manifest_json['fileSchema']
-        df_batch_inventory = df_batch_inventory[::input_sampling]
-        csv_buffer = io.StringIO()
-        output_records += len(df_batch_inventory)
-        print("Output records this batch: " + format(len(df_batch_inventory)))
+    offset = 0
+    part = []
+    part_rows = 0
+    part_bytes = 0
+    pending = []
+    with ThreadPoolExecutor(max_workers=upload_concurrency) as executor:
+      for file in manifest_files(bucket_v, original_manifest_json):
+        print(file['key'])
+        for df_temp in read_inventory(bucket_v, file['key'], inventory_format):
+          total_records += len(df_temp)
+          sampled = df_temp.iloc[(-offset) % input_sampling::input_sampling]
+          offset += len(df_temp)
+          print("Current observed record count: " + format(total_records))
+
+          # we cut the chunk into parts with the cumulative row and byte
+          # counts and slice whole runs of rows at a time. a part is closed
+          # before the row that would take it over the target, a single row
+          # larger than partition_target_bytes still gets a part of its own
+          lines = encode_rows(sampled)
+          offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+          np.cumsum(np.fromiter(map(len, lines), dtype=np.int64, count=len(lines)), out=offsets[1:])
+          start = 0
+          while start < len(lines):
+            stop = start + min(len(lines) - start, target_rows - part_rows)
+            if target_bytes > 0:
+              room = offsets[start] + target_bytes - part_bytes
+              stop = start + int(np.searchsorted(offsets[start + 1:stop + 1], room, side='right'))
+              if stop == start and part_rows == 0:
+                stop = start + 1
+            if stop > start:
+              part.append(b''.join(lines[start:stop]))
+              part_rows += stop - start
+              part_bytes += int(offsets[stop] - offsets[start])
+              start = stop
+            if start == len(lines):
+              break
+
+            # the part is full
+            pending.append(submit_part(executor, original_manifest_json, bucket_v, new_manifest_key_prefix, im, part, output_manifest_manifest))
+            output_records += part_rows
+            print("Output records this batch: " + format(part_rows))
+            print("Total output records to this point: " + format(output_records))
+            im += 1
+            part = []
+            part_rows = 0
+            part_bytes = 0
+
+            # don't let finished parts pile up in memory faster than we upload them
+            if len(pending) >= upload_concurrency * 2:
+              pending.pop(0).result()
+
+      # whatever is left goes into the last part
+      if part_rows > 0:
+        pending.append(submit_part(executor, original_manifest_json, bucket_v, new_manifest_key_prefix, im, part, output_manifest_manifest))
+        output_records += part_rows
+        print("Output records this batch: " + format(part_rows))
         print("Total output records to this point: " + format(output_records))
-        df_batch_inventory.to_csv(csv_buffer, index=False, header=False)
-        csv_tmp_name = new_manifest_key_prefix + 'inventory-' + format(im) + '.csv'
-        s3_resource.Object(bucket_v, csv_tmp_name.format(im)).put(Body=csv_buffer.getvalue())
-        inventory_manifest['files'].append({
-          'key': csv_tmp_name,
-          'size': len(csv_buffer.getvalue())
-        })
-        print(inventory_manifest)
-        inventory_manifest_json = json.dumps(inventory_manifest)
-        s3_resource.Object(bucket_v, new_manifest_key_prefix + 'manifest--{}.json'.format(im)).put(Body=inventory_manifest_json)
-        output_manifest_manifest['files'].append({
-          'key': new_manifest_key_prefix + 'manifest--{}.json'.format(im),
-          'bucket': bucket_v
-        })
-        im += 1
-        df_batch_inventory = pd.DataFrame(None)
-      i_files += 1
+
+      # surface upload errors
+      for future in pending:
+        future.result()
   return {
     'statusCode': 200,
     'body': output_manifest_manifest
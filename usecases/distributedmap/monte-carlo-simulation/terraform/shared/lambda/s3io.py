@@ -0,0 +1,63 @@
+import io
+
+# file objects over S3 the lambdas share. terraform zips this module next to
+# every handler that imports it
+
+# a read-only, seekable file object over an S3 object. every read is a
+# ranged GET, so readers that seek around (like parquet) only download the
+# bytes they actually need instead of the whole object
+class S3File(io.RawIOBase):
+  def __init__(self, client, bucket, key):
+    self.client = client
+    self.bucket = bucket
+    self.key = key
+    self.size = client.head_object(Bucket=bucket, Key=key)['ContentLength']
+    self.position = 0
+
+  def readable(self):
+    return True
+
+  def seekable(self):
+    return True
+
+  def tell(self):
+    return self.position
+
+  def seek(self, offset, whence=io.SEEK_SET):
+    if whence == io.SEEK_SET:
+      self.position = offset
+    elif whence == io.SEEK_CUR:
+      self.position += offset
+    else:
+      self.position = self.size + offset
+    return self.position
+
+  def readinto(self, buffer):
+    if self.position >= self.size or len(buffer) == 0:
+      return 0
+    end = min(self.position + len(buffer), self.size) - 1
+    data = self.client.get_object(Bucket=self.bucket, Key=self.key, Range='bytes={}-{}'.format(self.position, end))['Body'].read()
+    buffer[:len(data)] = data
+    self.position += len(data)
+    return len(data)
+
+# a read-only file object over a generator of byte chunks, this lets
+# upload_fileobj pull the data as it is generated
+class ChunkStream(io.RawIOBase):
+  def __init__(self, chunks):
+    self.chunks = chunks
+    self.pending = b''
+
+  def readable(self):
+    return True
+
+  def readinto(self, buffer):
+    while not self.pending:
+      try:
+        self.pending = next(self.chunks)
+      except StopIteration:
+        return 0
+    size = min(len(buffer), len(self.pending))
+    buffer[:size] = self.pending[:size]
+    self.pending = self.pending[size:]
+    return size
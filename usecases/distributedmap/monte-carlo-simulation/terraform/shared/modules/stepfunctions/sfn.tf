@@ -278,7 +278,11 @@ resource "aws_sfn_state_machine" "sfnecsdatageneration" {
       "ItemBatcher": {
         "MaxItemsPerBatch": 1000,
         "BatchInput": {
-          "bucket": "${var.sourcebucket}"
+          "bucket": "${var.sourcebucket}",
+          "records_per_object": ${var.recordsperobject},
+          "put_concurrency": ${var.putconcurrency},
+          ${var.seed == null ? "" : "\"seed\": ${var.seed},"}
+          "as_of": "${var.asof}"
         }
       },
       "ResultWriter": {
@@ -346,64 +350,36 @@ resource "aws_sfn_state_machine" "sfnecsdatageneration" {
           "Prefix": "${var.prefix}-inventory-results"
         }
       },
-      "Next": "Manifest Generation DMap"
+      "Next": "Manifest Generation"
     },
-    "Manifest Generation DMap": {
-      "Type": "Map",
-      "ItemProcessor": {
-        "ProcessorConfig": {
-          "Mode": "DISTRIBUTED",
-          "ExecutionType": "STANDARD"
+    "Manifest Generation": {
+      "Type": "Task",
+      "Resource": "arn:aws:states:::lambda:invoke",
+      "OutputPath": "$.Payload",
+      "Parameters": {
+        "Payload": {
+          "bucket": "${var.sourcebucket}",
+          "prefix": "inventory/data-gen-",
+          "key": "${var.inventorypath}",
+          "part_bytes": ${var.manifestpartbytes},
+          "format": "${var.manifestformat}",
+          "checksums": ${var.manifestchecksums}
         },
-        "StartAt": "Manifest Generation",
-        "States": {
-          "Manifest Generation": {
-            "Type": "Task",
-            "Resource": "arn:aws:states:::lambda:invoke",
-            "OutputPath": "$.Payload",
-            "Parameters": {
-              "Payload.$": "$",
-              "FunctionName": "${var.manifestarn}:$LATEST"
-            },
-            "Retry": [
-              {
-                "ErrorEquals": [
-                  "Lambda.ServiceException",
-                  "Lambda.AWSLambdaException",
-                  "Lambda.SdkClientException",
-                  "Lambda.TooManyRequestsException"
-                ],
-                "IntervalSeconds": 2,
-                "MaxAttempts": 6,
-                "BackoffRate": 2
-              }
-            ],
-            "End": true
-          }
-        }
+        "FunctionName": "${var.manifestarn}:$LATEST"
       },
-      "ItemReader": {
-        "Resource": "arn:aws:states:::s3:listObjectsV2",
-        "Parameters": {
-          "Bucket": "${var.sourcebucket}",
-          "Prefix": "inventory/data-gen-"
-        }
-      },
-      "MaxConcurrency": 1,
-      "Label": "ManifestGenerationDMap",
-      "ItemBatcher": {
-        "MaxItemsPerBatch": 1000,
-        "BatchInput": {
-          "bucket": "${var.sourcebucket}"
-        }
-      },
-      "ResultWriter": {
-        "Resource": "arn:aws:states:::s3:putObject",
-        "Parameters": {
-          "Bucket": "${var.destinationbucket}",
-          "Prefix": "${var.prefix}-manifest-results"
+      "Retry": [
+        {
+          "ErrorEquals": [
+            "Lambda.ServiceException",
+            "Lambda.AWSLambdaException",
+            "Lambda.SdkClientException",
+            "Lambda.TooManyRequestsException"
+          ],
+          "IntervalSeconds": 2,
+          "MaxAttempts": 6,
+          "BackoffRate": 2
         }
-      },
+      ],
       "End": true
     }
   }
@@ -442,7 +418,16 @@ resource "aws_sfn_state_machine" "sfnlambdastatemachine" {
           "output_prefix": "${var.outputpath}",
           "batch_output_files": "${var.batchoutput}",
           "input_sampling": ${var.sampling},
-          "output_rows_per_file": ${var.dmapbatchsize}
+          "output_rows_per_file": ${var.dmapbatchsize},
+          "fetch_concurrency": ${var.fetchconcurrency},
+          "simulation_paths": ${var.simulationpaths},
+          "output_format": "${var.outputformat}",
+          "output_compression": "${var.outputcompression}",
+          "output_row_group_size": ${var.outputrowgroupsize},
+          "partition_target_rows": ${var.partitiontargetrows},
+          "partition_target_bytes": ${var.partitiontargetbytes},
+          ${var.seed == null ? "" : "\"seed\": ${var.seed},"}
+          "skip_unchanged": ${var.skipunchanged}
         }
       }
     },
@@ -591,7 +576,16 @@ resource "aws_sfn_state_machine" "sfnecsstatemachine" {
           "output_prefix": "${var.outputpath}",
           "batch_output_files": "${var.batchoutput}",
           "input_sampling": ${var.sampling},
-          "output_rows_per_file": ${var.dmapbatchsize}
+          "output_rows_per_file": ${var.dmapbatchsize},
+          "fetch_concurrency": ${var.fetchconcurrency},
+          "simulation_paths": ${var.simulationpaths},
+          "output_format": "${var.outputformat}",
+          "output_compression": "${var.outputcompression}",
+          "output_row_group_size": ${var.outputrowgroupsize},
+          "partition_target_rows": ${var.partitiontargetrows},
+          "partition_target_bytes": ${var.partitiontargetbytes},
+          ${var.seed == null ? "" : "\"seed\": ${var.seed},"}
+          "skip_unchanged": ${var.skipunchanged}
         }
       }
     },
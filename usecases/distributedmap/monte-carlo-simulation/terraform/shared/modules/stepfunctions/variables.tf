@@ -54,6 +54,21 @@ variable "outputpath" {
   default = "output-data"
 }
 
+variable "outputformat" {
+  type    = string
+  default = "csv"
+}
+
+variable "outputcompression" {
+  type    = string
+  default = "snappy"
+}
+
+variable "outputrowgroupsize" {
+  type    = number
+  default = 100000
+}
+
 variable "batchoutput" {
   type    = string
   default = "yes"
@@ -90,6 +105,67 @@ variable "dmapbatchsize" {
   default = 100
 }
 
+variable "recordsperobject" {
+  type    = number
+  default = 1
+}
+
+variable "putconcurrency" {
+  type    = number
+  default = 16
+}
+
+variable "fetchconcurrency" {
+  type    = number
+  default = 32
+}
+
+variable "simulationpaths" {
+  type    = number
+  default = 500
+}
+
+variable "partitiontargetrows" {
+  type    = number
+  default = 250000
+}
+
+variable "partitiontargetbytes" {
+  type    = number
+  default = 0
+}
+
+variable "manifestpartbytes" {
+  type    = number
+  default = 8388608
+}
+
+variable "manifestformat" {
+  type    = string
+  default = "json"
+}
+
+variable "manifestchecksums" {
+  type    = bool
+  default = false
+}
+
+variable "seed" {
+  type     = number
+  nullable = true
+  default  = null
+}
+
+variable "asof" {
+  type    = string
+  default = ""
+}
+
+variable "skipunchanged" {
+  type    = bool
+  default = false
+}
+
 variable "activitytimeout" {
   type    = number
   default = 300
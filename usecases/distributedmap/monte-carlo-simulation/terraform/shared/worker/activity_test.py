@@ -0,0 +1,57 @@
+"""Unit tests for the montecarlo activity worker
+
+Run them from this directory with "python3 -m unittest activity_test". The
+module is not packaged into montecarlo.pyz.
+"""
+import json
+import multiprocessing
+import os
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from unittest.mock import patch, MagicMock
+
+os.environ.setdefault('REGION', 'us-east-1')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import botocore
+from montecarlo import activity, engine
+
+
+# runs in a spawned worker process, like process_batch does on the hosts
+def slow_down(event):
+    error = botocore.exceptions.ClientError({'Error': {'Code': 'SlowDown', 'Message': 'Please reduce your request rate.'}}, 'GetObject')
+    engine.handle_processing_errors(error)
+
+
+class RunTaskTests(unittest.TestCase):
+
+    def test_slow_down_crosses_the_process_boundary(self):
+        client_mock = MagicMock()
+        context = multiprocessing.get_context('spawn')
+        with patch.object(activity, 'client', client_mock), \
+                patch.object(activity, 'process_batch', slow_down), \
+                ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=activity.init_worker) as pool:
+            activity.run_task(pool, 'token', {})
+
+        client_mock.send_task_success.assert_not_called()
+        client_mock.send_task_failure.assert_called_once_with(
+            taskToken='token',
+            error='SlowDown',
+            cause='Reduce S3 Requests')
+
+    def test_success_is_reported_with_the_batch_output(self):
+        client_mock = MagicMock()
+        pool_mock = MagicMock()
+        pool_mock.submit.return_value.exception.return_value = None
+        pool_mock.submit.return_value.result.return_value = {'metrics': {'items': 1}}
+        with patch.object(activity, 'client', client_mock), \
+                patch.object(activity.futures, 'wait', return_value=MagicMock(done={1})):
+            activity.run_task(pool_mock, 'token', {})
+
+        client_mock.send_task_success.assert_called_once_with(
+            taskToken='token',
+            output=json.dumps({'message': 'success', 'metrics': {'items': 1}}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+"""Unit tests for the montecarlo batch engine
+
+Run them from this directory with "python3 -m unittest engine_test". They
+need moto for the S3 writes. The module is not packaged into montecarlo.pyz.
+"""
+import os
+import random
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+os.environ.setdefault('REGION', 'us-east-1')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+
+import boto3
+import botocore
+import pandas as pd
+from moto import mock_aws
+
+from montecarlo import engine
+
+
+class WriteOutputTests(unittest.TestCase):
+
+    def setUp(self):
+        self.mock = mock_aws()
+        self.mock.start()
+        self.s3_resource = boto3.resource('s3', region_name='us-east-1')
+        self.s3_resource.create_bucket(Bucket='output')
+        patcher = patch.object(engine, 's3_resource', self.s3_resource)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.mock.stop)
+        self.batch = pd.DataFrame({'AccountID': [1, 2], 'WillDefault': [0.1, 0.2]})
+
+    def test_output_is_written_with_its_digest(self):
+        engine.write_output('output', self.batch, 'out/data-gen-1.csv', {}, 'abc')
+
+        obj = self.s3_resource.Object('output', 'out/data-gen-1.csv')
+        self.assertEqual(obj.metadata, {'input-digest': 'abc'})
+        self.assertEqual(obj.get()['Body'].read().decode('utf-8'), 'AccountID,WillDefault\n1,0.1\n2,0.2\n')
+
+    def test_failed_put_fails_the_batch(self):
+        with self.assertRaises(botocore.exceptions.ClientError) as raised:
+            engine.write_output('no-such-bucket', self.batch, 'out/data-gen-1.csv', {}, 'abc')
+        self.assertEqual(raised.exception.response['Error']['Code'], 'NoSuchBucket')
+
+
+# an S3 client that answers after a random delay and throws SlowDown for the
+# keys in slow_keys the first time they are requested
+class FakeS3:
+
+    def __init__(self, slow_keys=(), always_slow=False):
+        self.slow_keys = set(slow_keys)
+        self.always_slow = always_slow
+        self.lock = threading.Lock()
+        self.random = random.Random(7)
+
+    def get_object(self, Bucket, Key):
+        with self.lock:
+            delay = self.random.uniform(0, 0.01)
+            slow = self.always_slow or Key in self.slow_keys
+            self.slow_keys.discard(Key)
+        time.sleep(delay)
+        if slow:
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'SlowDown'}}, 'GetObject')
+        body = MagicMock()
+        body.read.return_value = Key.encode('utf-8')
+        return {'Body': body}
+
+
+class FetchObjectsTests(unittest.TestCase):
+
+    def fetch(self, client, count, concurrency):
+        items = [{'Bucket': 'input', 'Key': 'data-gen-{}.csv'.format(i)} for i in range(count)]
+        with patch.object(engine, 's3', client):
+            return items, list(engine.fetch_objects(items, concurrency))
+
+    def test_results_keep_the_item_order(self):
+        items, fetched = self.fetch(FakeS3(), 100, 16)
+
+        self.assertEqual([item for item, _, _, _ in fetched], items)
+        self.assertEqual([content.decode('utf-8') for _, content, _, _ in fetched], [item['Key'] for item in items])
+
+    def test_window_shrinks_on_slowdown_and_recovers(self):
+        items, fetched = self.fetch(FakeS3(slow_keys=['data-gen-10.csv']), 40, 8)
+        windows = [window for _, _, _, window in fetched]
+
+        self.assertEqual([item for item, _, _, _ in fetched], items)
+        self.assertEqual(windows[:10], [8] * 10)
+        self.assertEqual(windows[10:15], [4, 5, 6, 7, 8])
+        self.assertEqual(windows[-1], 8)
+
+    def test_slowdown_at_a_single_download_fails_the_batch(self):
+        with self.assertRaises(engine.SlowDown):
+            self.fetch(FakeS3(always_slow=True), 10, 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,3 @@
+# the monte carlo simulation worker. engine holds the batch processing code
+# every compute back-end shares, activity the step functions activity worker
+# the ec2/fargate hosts run
@@ -0,0 +1,139 @@
+# command line entry point of the worker, run it with python3 -m montecarlo
+# (or python3 montecarlo.pyz once packaged) followed by one of the commands
+import sys
+import json
+import time
+import resource
+import numpy as np
+
+# starts the activity worker, this is what the ec2/fargate hosts run
+def cmd_activity(cli_args):
+  from montecarlo import activity
+  activity.run()
+
+# processes a single batch event (a file, or - for stdin), the same way the
+# lambda handler and the activity workers do
+def cmd_batch(cli_args):
+  from montecarlo import engine
+  if len(cli_args) < 1:
+    print("Error: No event file provided.")
+    sys.exit(1)
+  with (sys.stdin if cli_args[0] == '-' else open(cli_args[0])) as f:
+    event = json.load(f)
+  print(json.dumps(engine.process_batch(event)))
+
+# builds a single-loan CSV object per item, like datagen does
+def make_objects(size, rng):
+  objects = []
+  for i in range(size):
+    objects.append((
+      "AccountID,ZipCode,Rate,Payment,LoanAmount,LoanTerm,OriginationDate,GrossIncome\r\n" +
+      "{},{},{},{},{},{},01/01/2020,{}\r\n".format(
+        rng.integers(1000000, 10000000),
+        rng.integers(10000, 100000),
+        round(rng.uniform(1.0, 9.9), 2),
+        rng.integers(1000, 10001),
+        rng.integers(10000, 10000001),
+        rng.choice([12, 24, 36, 48, 60, 72, 84, 96, 108, 120]),
+        rng.integers(50000, 5000001)
+      )
+    ).encode('utf-8'))
+  return objects
+
+# runs the compute part of a batch (parse, score, serialize) on synthetic
+# objects without touching S3 and reports rows/sec and the peak RSS. all
+# three compute back-ends run this same code, so one benchmark covers them.
+# usage: bench [batch sizes...] [--paths N] [--format csv|parquet]
+def cmd_bench(cli_args):
+  from montecarlo import engine
+  sizes = []
+  variables = {}
+  paths = engine.simulation_paths
+  args = list(cli_args)
+  while args:
+    arg = args.pop(0)
+    if arg == '--paths':
+      paths = int(args.pop(0))
+    elif arg == '--format':
+      variables['output_format'] = args.pop(0)
+    else:
+      sizes.append(int(arg))
+  sizes = sizes or [10, 100, 1000]
+
+  rng = np.random.default_rng(0)
+  print("{:>8} {:>12} {:>12} {:>14}".format('items', 'seconds', 'rows/sec', 'peak rss (MB)'))
+  for size in sorted(sizes):
+    objects = make_objects(size, rng)
+    start = time.perf_counter()
+    frames = [engine.read_frame('data/data-gen-{}.csv'.format(i), content) for i, content in enumerate(objects)]
+    batch = engine.calculate_default(engine.pd.concat(frames, ignore_index=True), engine.fedrate or 8, paths, rng)
+    engine.serialize(batch, variables)
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is reported in kilobytes on linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print("{:>8} {:>12.3f} {:>12.0f} {:>14.1f}".format(size, elapsed, len(batch) / elapsed, peak))
+
+# recommends ItemBatcher and MaxConcurrency settings from the ResultWriter
+# output of a finished processing run. --key reads the metrics of another
+# map run, like the _metrics of the NOAA temperatures demo.
+# usage: plan <manifest.json> [--target seconds] [--items N] [--concurrency N] [--key name]
+def cmd_plan(cli_args):
+  from montecarlo import planner
+  location = None
+  target = 60
+  items = None
+  concurrency = planner.lambda_concurrency
+  key = 'metrics'
+  args = list(cli_args)
+  while args:
+    arg = args.pop(0)
+    if arg == '--target':
+      target = float(args.pop(0))
+    elif arg == '--items':
+      items = int(args.pop(0))
+    elif arg == '--concurrency':
+      concurrency = int(args.pop(0))
+    elif arg == '--key':
+      key = args.pop(0)
+    else:
+      location = arg
+  if location is None:
+    print("Error: No manifest provided, pass s3://bucket/prefix/<run>/manifest.json")
+    sys.exit(1)
+
+  children, failures = planner.read_results(location, key)
+  if not children:
+    print("Error: the map run has no batch metrics, was it run with the current worker?")
+    sys.exit(1)
+  print(json.dumps({
+    'observed': planner.observed(children, failures),
+    'recommended': planner.plan(children, target, items, concurrency)
+  }, indent=2))
+
+def main():
+  # Available commands to be run along with a description of each
+  commands = {
+    'activity': (cmd_activity, "Poll the step functions activity and process batches until SIGTERM"),
+    'batch': (cmd_batch, "Process a single batch event from a file (or - for stdin)"),
+    'bench': (cmd_bench, "Benchmark the batch engine on synthetic data"),
+    'plan': (cmd_plan, "Recommend batch sizes and concurrency from the results of a map run")
+  }
+
+  args = sys.argv
+  if (len(args) < 2):
+    print("Error: No command provided.\n")
+  else:
+    if args[1] in commands:
+      cmd = commands[args[1]]
+      cmd[0](args[2:])
+      sys.exit(0)
+    else:
+      print("{} is not a recognized command\n".format(args[1]))
+
+  print("Supported commands:")
+  for cn in commands:
+    print("\t{}: {}".format(cn, commands[cn][1]))
+  sys.exit(1)
+
+if __name__ == "__main__":
+  main()
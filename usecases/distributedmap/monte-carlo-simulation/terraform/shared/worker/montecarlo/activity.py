@@ -0,0 +1,141 @@
+# the step functions activity worker the ec2/fargate hosts run. the actual
+# work is done by the same engine the lambda handler uses, we only take care
+# of polling the activity, spreading batches across the cores of the host
+# and reporting back to step functions
+import boto3
+import botocore
+import os
+import json
+import random
+import signal
+import threading
+import multiprocessing
+from botocore.config import Config
+from concurrent import futures
+from concurrent.futures import ProcessPoolExecutor
+
+from montecarlo.engine import process_batch
+
+# set initial variables for the rest of the script
+config = Config(
+  connect_timeout=65,
+  read_timeout=65,
+  retries={'max_attempts': 0}
+)
+region = os.getenv('REGION')
+client = boto3.client('stepfunctions', region_name=region, config=config)
+
+# set a few variables we'll use to get our data
+activity_arn = os.getenv('ACTIVITY_ARN')
+worker_name = os.getenv('HOSTNAME')
+
+# how many worker processes and activity pollers we run on this host. by
+# default we run one of each per core, both can be overridden with the
+# WORKERS and POLLERS environment variables
+workers = int(os.getenv('WORKERS', os.cpu_count() or 1))
+pollers = int(os.getenv('POLLERS', workers))
+
+# how often (in seconds) we tell step functions we are still working on a
+# task, this has to stay below the HeartbeatSeconds of the activity state
+heartbeat_interval = int(os.getenv('HEARTBEAT_INTERVAL', 60))
+
+# when the activity has no work for us we back off exponentially between
+# polls, starting at idle_backoff up to max_idle_backoff seconds
+idle_backoff = 1
+max_idle_backoff = 60
+
+# set when we receive SIGTERM. pollers stop picking up new tasks and we
+# drain the tasks that are already running before we exit
+stopping = threading.Event()
+
+# this function hands a task to the worker processes and waits for it to
+# finish. long batches keep sending heartbeats so step functions doesn't
+# give up on them, and failures are reported back instead of killing the
+# poller
+def run_task(pool, token, event):
+  future = pool.submit(process_batch, event)
+  try:
+    while not futures.wait([future], timeout=heartbeat_interval).done:
+      client.send_task_heartbeat(taskToken = token)
+
+    error = future.exception()
+    if error is None:
+      client.send_task_success(
+        taskToken = token,
+        output = json.dumps(dict({'message': 'success'}, **future.result()))
+      )
+    else:
+      print('task failed: ' + repr(error))
+      client.send_task_failure(
+        taskToken = token,
+        error = type(error).__name__[:256],
+        cause = str(error)[:32768]
+      )
+  except botocore.exceptions.ClientError as error:
+    # most likely the task timed out on the step functions side already,
+    # it will be retried there so all we can do is log it and move on
+    print('could not report task status: ' + repr(error))
+
+# each poller asks the activity for work and only takes a worker slot once
+# it got a task, so pollers that are long polling or backing off don't hold
+# capacity. while a task waits for a free slot we keep sending heartbeats,
+# and when there's nothing to do we back off with jitter instead of
+# sleeping a fixed amount of time
+def poll(pool, slots):
+  backoff = idle_backoff
+  while not stopping.is_set():
+    try:
+      response = client.get_activity_task(
+        activityArn = activity_arn,
+        workerName = worker_name
+      )
+    except (botocore.exceptions.ClientError, botocore.exceptions.ConnectionError) as error:
+      print('polling failed: ' + repr(error))
+      response = {}
+
+    if 'input' not in response.keys() or 'taskToken' not in response.keys():
+      wait = backoff + random.uniform(0, backoff)
+      print('no tasks to process...waiting {:.1f} seconds to try again'.format(wait))
+      stopping.wait(wait)
+      backoff = min(backoff * 2, max_idle_backoff)
+      continue
+
+    # a task we got while shutting down is still processed, that's part
+    # of draining the host
+    backoff = idle_backoff
+    token = response['taskToken']
+    while not slots.acquire(timeout=heartbeat_interval):
+      try:
+        client.send_task_heartbeat(taskToken = token)
+      except botocore.exceptions.ClientError as error:
+        print('could not report task status: ' + repr(error))
+    try:
+      run_task(pool, token, json.loads(response['input']))
+    finally:
+      slots.release()
+
+def drain(signum, frame):
+  print('received SIGTERM, finishing in-flight tasks before exiting')
+  stopping.set()
+
+# the worker processes leave SIGTERM to the main process, which decides when
+# the host is drained
+def init_worker():
+  signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+# this is the entry point of the ec2/fargate hosts, it polls the activity
+# until we receive SIGTERM
+def run():
+  signal.signal(signal.SIGTERM, drain)
+  slots = threading.Semaphore(workers)
+
+  # we spawn (rather than fork) the workers, forking while the pollers have
+  # requests in flight can leave locks in the children in a bad state
+  context = multiprocessing.get_context('spawn')
+  with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker) as pool:
+    threads = [threading.Thread(target=poll, args=(pool, slots), name='poller-' + str(i)) for i in range(pollers)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+  print('all tasks drained, exiting')
@@ -0,0 +1,360 @@
+# the monte carlo batch engine. every compute back-end runs this code, the
+# lambda handler calls process_batch directly and the ec2/fargate activity
+# workers call it from their worker processes
+import boto3
+import botocore
+import hashlib
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+from io import BytesIO, StringIO
+from botocore.config import Config
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# set initial variables for the rest of the script
+config = Config(retries = dict(max_attempts = 2, mode = 'standard'))
+region = os.getenv('REGION')
+count = os.getenv('RECORDCOUNT')
+fedrate = os.getenv('FEDRATE')
+
+# how many source objects we download at the same time. the default can be
+# overridden per run with fetch_concurrency in the workshop_variables block
+fetch_concurrency = 32
+max_fetch_concurrency = 64
+
+# the fetch client retries in adaptive mode, so S3 SlowDown responses make
+# it throttle itself (backpressure) instead of failing the batch right away
+fetch_config = Config(
+  retries = dict(max_attempts = 10, mode = 'adaptive'),
+  max_pool_connections = max_fetch_concurrency
+)
+s3 = boto3.client('s3', region_name=region, config=fetch_config)
+s3_resource = boto3.resource('s3', config=config)
+
+# output format settings, they can be overridden per run with output_format,
+# output_compression and output_row_group_size in the workshop_variables block
+output_format = 'csv'
+output_compression = 'snappy'
+output_row_group_size = 100000
+
+# the knobs of our default model. rates are in percentage points, the
+# income shock is the standard deviation of a log-normal factor and a loan
+# is considered in default on a path when the monthly payment takes more
+# than max_payment_to_income of the borrower's monthly income
+fed_volatility = 0.75
+rate_passthrough = 0.5
+income_volatility = 0.2
+max_payment_to_income = 0.43
+
+# how many paths we simulate per loan. more paths give tighter confidence
+# intervals at the cost of CPU time, the default can be overridden per run
+# with simulation_paths in the workshop_variables block
+simulation_paths = 500
+
+# upper bound for the number of loan x path cells we hold in memory at once
+max_chunk_cells = 2000000
+
+# with a seed in the workshop_variables block every output file is simulated
+# with its own random stream, keyed on the seed and the first loan in the
+# file. a retried or re-run batch then writes byte-identical output, no
+# matter which worker picks it up. data generation uses stream 0
+simulation_stream = 1
+
+# this function runs the monte carlo simulation that estimates how likely a
+# given loan is to default when the federal rate moves. every path draws a
+# fed rate shock that is (partially) passed on to the loan rate, we re-amortize
+# the loan at that rate and compare the payment against a shocked monthly
+# income. the share of paths that end in default is our probability, together
+# with a 95% (wilson) confidence interval. everything runs as array operations
+# over the whole batch, chunked so large batches don't blow up memory
+def calculate_default(df, fedrate, paths=simulation_paths, rng=None):
+  rng = np.random.default_rng() if rng is None else rng
+  paths = max(1, int(paths))
+  rate = df['Rate'].to_numpy(dtype=float)
+  payment = df['Payment'].to_numpy(dtype=float)
+  amount = df['LoanAmount'].to_numpy(dtype=float)
+  term = df['LoanTerm'].to_numpy(dtype=float)
+  income = df['GrossIncome'].to_numpy(dtype=float) / 12
+
+  # the fed rate shocks are shared by every loan in the batch, a rate
+  # hike hits the whole portfolio at the same time
+  fed = np.maximum(float(fedrate or 0) + rng.normal(0, fed_volatility, paths), 0)
+
+  defaults = np.empty(len(df))
+  rows = max(1, max_chunk_cells // paths)
+  for lo in range(0, len(df), rows):
+    hi = min(lo + rows, len(df))
+
+    # monthly rate on every path, only the move of the fed rate away from its
+    # current level is passed on. floored so the amortization stays defined
+    monthly = np.maximum(rate[lo:hi, None] + rate_passthrough * (fed - float(fedrate or 0)), 0.0001) / 1200
+    due = amount[lo:hi, None] * monthly / (1 - (1 + monthly) ** -term[lo:hi, None])
+    due = np.maximum(due, payment[lo:hi, None])
+
+    # idiosyncratic income shock, centered so the expected income is unchanged
+    shock = rng.lognormal(-income_volatility ** 2 / 2, income_volatility, (hi - lo, paths))
+    defaults[lo:hi] = (due > max_payment_to_income * income[lo:hi, None] * shock).mean(axis=1)
+
+  z = 1.96
+  center = (defaults + z ** 2 / (2 * paths)) / (1 + z ** 2 / paths)
+  spread = z * np.sqrt(defaults * (1 - defaults) / paths + z ** 2 / (4 * paths ** 2)) / (1 + z ** 2 / paths)
+  df['WillDefault'] = defaults
+  df['DefaultLow'] = np.clip(center - spread, 0, 1)
+  df['DefaultHigh'] = np.clip(center + spread, 0, 1)
+  return df
+
+# this function returns the random generator for an output file, without a
+# seed we fall back to fresh entropy like before
+def get_rng(seed, first):
+  if seed is None:
+    return np.random.default_rng()
+  return np.random.default_rng(np.random.SeedSequence(int(seed), spawn_key=(simulation_stream, int(first))))
+
+# this function fingerprints everything an output file depends on: the
+# source objects (we only keep their sha256), the seed and the model and output settings. we store it
+# in the object metadata so unchanged batches can be skipped on a re-run
+def get_digest(variables, paths, contents):
+  settings = {
+    'seed': variables.get('seed'),
+    'paths': int(paths),
+    'fedrate': fedrate,
+    'model': [fed_volatility, rate_passthrough, income_volatility, max_payment_to_income],
+    'output': [variables.get('output_format', output_format), variables.get('output_compression', output_compression), int(variables.get('output_row_group_size', output_row_group_size))]
+  }
+  digest = hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8'))
+  for key, content in contents:
+    digest.update(key.encode('utf-8'))
+    digest.update(content)
+  return digest.hexdigest()
+
+# raised when S3 keeps answering with SlowDown. it lives at module level so
+# it can be pickled back from the activity worker processes, step functions
+# matches its name in the Retry and Catch of the processing state
+class SlowDown(Exception):
+  pass
+
+# you always need a little error handling :) in this case what we
+# are specifically looking for is SlowDown errors from S3. when that 
+# occurs we are raising the error to let Step Functions handle it
+def handle_processing_errors(error):
+  print("botocore Error Caught")
+  if error.response['Error']['Code'] == 'SlowDown':
+    print ("Client SlowDown Error")
+    # Throw 503 from S3
+    raise SlowDown('Reduce S3 Requests')
+
+# this function fetches a single source object. SlowDown responses are
+# retried by the fetch client's adaptive retry mode first, which slows our
+# request rate down, and only when that isn't enough we let Step Functions
+# retry the whole batch
+def get_content(item):
+  try:
+    source = s3.get_object(Bucket=item['Bucket'], Key=item['Key'])
+    return source['Body'].read()
+  except botocore.exceptions.ClientError as error:
+    handle_processing_errors(error)
+    raise
+
+# this function fetches a single source object and times the request, the
+# timings end up in the metrics of the batch
+def get_timed_content(item):
+  start = time.perf_counter()
+  content = get_content(item)
+  return content, time.perf_counter() - start
+
+# this function loads a source object into a dataframe. source objects can
+# be CSV or parquet files, we pick the reader based on the extension
+def read_frame(key, content):
+  if key.endswith('.parquet'):
+    return pd.read_parquet(BytesIO(content))
+  return pd.read_csv(BytesIO(content))
+
+# this function downloads the source objects on a bounded pool of threads.
+# we only keep a small window of downloads ahead of the consumer and hand
+# the results back in the same order as the items, so memory stays bounded
+# and our output files don't depend on which download finished first.
+# the window adapts to S3: a SlowDown that got past the client retries
+# halves it and the object is fetched again, every object that arrives
+# grows it by one up to the configured concurrency. only when we are down
+# to a single download and still get SlowDown do we fail the batch
+def fetch_objects(items, concurrency):
+  limit = max(1, min(int(concurrency), max_fetch_concurrency))
+  window = limit
+  items = iter(items)
+  with ThreadPoolExecutor(max_workers=limit) as executor:
+    pending = deque()
+    while True:
+      while len(pending) < window * 2:
+        item = next(items, None)
+        if item is None:
+          break
+        pending.append((item, executor.submit(get_timed_content, item)))
+      if not pending:
+        return
+      item, future = pending.popleft()
+      while True:
+        try:
+          content, seconds = future.result()
+          break
+        except SlowDown:
+          if window == 1:
+            raise
+          window = max(1, window // 2)
+          future = executor.submit(get_timed_content, item)
+      yield item, content, seconds, window
+      window = min(limit, window + 1)
+
+# this function just prepends zeroes to the object names
+# to make it prettier and easier to read
+def get_zeroes(current, total):
+  x = total - len(str(current))
+  ret = ""
+  for i in range(0, x):
+    ret = ret + "0"
+  return ret + str(current)
+
+# this function finds the lowest value in the list of object names
+def get_start(id,start):
+  ret = id if id < int(start) or int(start) == 0 else int(start)
+  return ret
+
+# this function finds the highest value in the list of object names
+def get_end(id,end):
+  ret = id if id > int(end) else int(end)
+  return ret
+
+# this function serializes a scored batch. by default we write CSV, with
+# output_format set to parquet in the workshop_variables block we write a
+# compressed columnar file instead, which is a lot smaller and cheaper to
+# scan in athena
+def serialize(batch, variables):
+  if variables.get('output_format', output_format) == 'parquet':
+    buffer = BytesIO()
+    batch.to_parquet(
+      buffer,
+      index=False,
+      compression=variables.get('output_compression', output_compression),
+      row_group_size=int(variables.get('output_row_group_size', output_row_group_size))
+    )
+    return ".parquet", buffer.getvalue()
+  buffer = StringIO()
+  batch.to_csv(buffer, index=False)
+  return ".csv", buffer.getvalue()
+
+# this function builds the name of an output file
+def get_key(rowsper, prefix, start, end, variables):
+  extension = ".parquet" if variables.get('output_format', output_format) == 'parquet' else ".csv"
+  return prefix + "/data-gen-" + get_zeroes(start, len(count)) + extension if rowsper == 1 else prefix + "/data-gen-batch-" + get_zeroes(start, len(count)) + "_" + get_zeroes(end, len(count)) + extension
+
+# this function checks if an output file was already written from the same
+# inputs and settings
+def is_unchanged(bucket, key, digest):
+  try:
+    return s3_resource.Object(bucket, key).metadata.get('input-digest') == digest
+  except botocore.exceptions.ClientError as error:
+    if error.response['Error']['Code'] in ('404', 'NoSuchKey'):
+      return False
+    handle_processing_errors(error)
+    raise
+
+# this functions writes to s3
+def write_output(bucket, batch, key, variables, digest):
+  # write the data
+  body = serialize(batch, variables)[1]
+
+  # write the object. anything but SlowDown fails the batch, a batch
+  # without its output object must not be reported as processed
+  try:
+    s3_resource.Object(bucket, key).put(Body=body, Metadata={'input-digest': digest})
+  except botocore.exceptions.ClientError as error:
+    handle_processing_errors(error)
+    raise
+
+# this function processes one batch of items handed to us by the
+# distributed map, no matter which compute back-end runs it. it returns the
+# cost of the batch: how many bytes every item had and how long it took to
+# fetch and parse it, plus the time spent simulating and writing. that's the
+# output of the child execution, so it ends up in the ResultWriter files of
+# the map run where the batch planner (python3 -m montecarlo plan) reads it
+def process_batch(event):
+  started = time.perf_counter()
+  # set variables passed from the Set Variables step of the Step Function workflow
+  variables = event['BatchInput']['workshop_variables']
+  prefix = variables['output_prefix']
+  bucket = variables['output_bucket']
+  rowsper = variables['output_rows_per_file']
+  paths = variables.get('simulation_paths', simulation_paths)
+  seed = variables.get('seed')
+  skip_unchanged = variables.get('skip_unchanged', False) and seed is not None
+  start = 0
+  end = 0
+
+  # our s3 inventory report may contain objects we don't care about. this
+  # filter will ensure we only process source CSV or parquet files, skipping folders
+  # and other metadata object entries.
+  items = [item for item in event['Items'] if str(item['Key']).endswith((".csv", ".parquet"))]
+
+  # we collect the dataframes in a plain list and only concatenate them
+  # once per output file. growing a dataframe with pd.concat for every
+  # object copies the whole batch each time, which gets slow quickly with
+  # 1000 item batches
+  frames = []
+  contents = []
+  metrics = {
+    'items': len(items),
+    'bytes': 0,
+    'seconds': 0,
+    'compute_seconds': 0,
+    'item_bytes': [],
+    'item_seconds': [],
+    'min_fetch_window': None
+  }
+
+  # load the full batch from Step Functions into the dataframes. the
+  # objects are small so a single child spends most of its time waiting on
+  # S3, that's why we fetch them concurrently
+  fetched = fetch_objects(items, variables.get('fetch_concurrency', fetch_concurrency))
+  for x, (item, content, seconds, window) in enumerate(fetched, start=1):
+    # with data in hand we can load the content into a dataframe
+    parse_start = time.perf_counter()
+    frames.append(read_frame(item['Key'], content))
+    contents.append((item['Key'], hashlib.sha256(content).digest()))
+    metrics['item_bytes'].append(len(content))
+    metrics['item_seconds'].append(round(seconds + time.perf_counter() - parse_start, 4))
+    metrics['min_fetch_window'] = window if metrics['min_fetch_window'] is None else min(metrics['min_fetch_window'], window)
+
+    # our file names will include the first and last object
+    # id to make them easier to find. 
+    id = int(item['Key'].split('-')[2].split('.')[0])
+    start = get_start(id, start)
+    end = get_end(id, end)
+    
+    # do we need to write yet? we'll check to see we hit that yet
+    if len(frames) == rowsper or x == len(items):
+      compute_start = time.perf_counter()
+      key = get_key(rowsper, prefix, str(start), str(end), variables)
+      digest = get_digest(variables, paths, contents)
+
+      # on a re-run with the same seed we leave files that were already
+      # written from the same inputs alone
+      if not (skip_unchanged and is_unchanged(bucket, key, digest)):
+        # build the batch and calculate our percentage for defaulting
+        batch = calculate_default(pd.concat(frames, ignore_index=True), fedrate, paths, get_rng(seed, start))
+
+        # write the object(s)
+        write_output(bucket, batch, key, variables, digest)
+      metrics['compute_seconds'] += time.perf_counter() - compute_start
+
+      # rinse and repeat :)
+      start = 0
+      end = 0
+      frames = []
+      contents = []
+
+  metrics['bytes'] = sum(metrics['item_bytes'])
+  metrics['compute_seconds'] = round(metrics['compute_seconds'], 4)
+  metrics['seconds'] = round(time.perf_counter() - started, 4)
+  return {'metrics': metrics}
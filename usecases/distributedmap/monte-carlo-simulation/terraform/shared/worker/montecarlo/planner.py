@@ -0,0 +1,142 @@
+# the batch planner. every child of the processing map returns the cost of
+# its batch (see process_batch), which step functions writes to the
+# ResultWriter files of the map run. from those we fit a simple cost model
+# and recommend the ItemBatcher and MaxConcurrency settings for the next run,
+# so children finish within a target duration instead of timing out on big
+# batches while small ones leave capacity idle. other map runs can be
+# planned too, as long as their children return the same metrics under a
+# key of their own (the NOAA temperatures demo uses _metrics)
+import os
+import json
+import math
+import boto3
+import numpy as np
+from statistics import NormalDist
+
+# step functions caps the input of a child execution at 256 KiB
+max_batch_input_bytes = 256 * 1024
+
+# we size batches so that this share of them finishes within the target
+target_quantile = 95
+
+# limits the concurrency recommendation respects: the lambda concurrency we
+# can count on and the GET requests per second S3 supports per prefix
+lambda_concurrency = 1000
+s3_get_rate = 5500
+
+# reads the ResultWriter output of a map run. location is the manifest.json
+# the map run wrote, either s3://bucket/key or a local copy next to its
+# result files, key is where the children put their metrics
+def read_results(location, key='metrics'):
+  if location.startswith('s3://'):
+    s3 = boto3.client('s3')
+    bucket, manifest_key = location[5:].split('/', 1)
+    read = lambda name: s3.get_object(Bucket=bucket, Key=name)['Body'].read()
+    manifest = json.loads(read(manifest_key))
+  else:
+    folder = os.path.dirname(location)
+    read = lambda name: open(os.path.join(folder, os.path.basename(name)), 'rb').read()
+    manifest = json.loads(read(location))
+
+  children = []
+  failures = []
+  for result in manifest['ResultFiles'].get('SUCCEEDED', []):
+    for entry in json.loads(read(result['Key'])):
+      output = json.loads(entry.get('Output') or 'null') or {}
+      if key not in output:
+        continue
+      items = json.loads(entry['Input']).get('Items', [])
+      output[key]['item_json_bytes'] = [len(json.dumps(item)) + 1 for item in items]
+      children.append(output[key])
+  for result in manifest['ResultFiles'].get('FAILED', []):
+    for entry in json.loads(read(result['Key'])):
+      failures.append(entry.get('Error', 'unknown'))
+  return children, failures
+
+# fits child seconds = overhead + items * per_item + bytes * per_byte over
+# all children. when the children are too alike to tell the terms apart we
+# drop the bytes term, and then the overhead, until the fit makes sense
+def fit(children):
+  x = np.array([[1, c['items'], c['bytes']] for c in children], dtype=float)
+  y = np.array([c['seconds'] for c in children], dtype=float)
+  coef = np.zeros(3)
+  for columns in ([0, 1, 2], [0, 1], [1]):
+    if len(children) < len(columns):
+      continue
+    coef[:] = 0
+    coef[columns] = np.linalg.lstsq(x[:, columns], y, rcond=None)[0]
+    if (coef >= 0).all():
+      break
+  else:
+    coef = np.array([0, np.median(y / np.maximum(x[:, 1], 1)), 0])
+  residual = np.percentile(y - x @ coef, target_quantile)
+  return coef, max(float(residual), 0.0)
+
+def plan(children, target_seconds, total_items=None, concurrency_limit=lambda_concurrency, get_rate=s3_get_rate):
+  coef, residual = fit(children)
+  item_bytes = np.concatenate([np.asarray(c['item_bytes'], dtype=float) for c in children])
+  item_json = np.concatenate([np.asarray(c['item_json_bytes'], dtype=float) for c in children])
+  mean_bytes = float(item_bytes.mean())
+  sd_bytes = float(item_bytes.std())
+  z = NormalDist().inv_cdf(target_quantile / 100)
+
+  # the bytes of a batch of n items vary less the more items it holds, we
+  # size for the upper quantile of that sum
+  def predict(n, quantile=True):
+    batch_bytes = n * mean_bytes + (z * math.sqrt(n) * sd_bytes if quantile else 0)
+    return coef[0] + coef[1] * n + coef[2] * batch_bytes + (residual if quantile else 0)
+
+  # the batch input has to stay below the step functions limit, we keep
+  # some room for the BatchInput itself
+  json_per_item = float(np.percentile(item_json, 99))
+  max_items = max(1, int((max_batch_input_bytes * 0.9) // json_per_item))
+
+  # largest batch that still finishes within the target
+  low, high = 1, max_items
+  while low < high:
+    middle = (low + high + 1) // 2
+    if predict(middle) <= target_seconds:
+      low = middle
+    else:
+      high = middle - 1
+  items_per_batch = low
+
+  total_items = total_items or sum(c['items'] for c in children)
+  batches = math.ceil(total_items / items_per_batch)
+  gets_per_child = items_per_batch / max(predict(items_per_batch, False), 0.001)
+  concurrency = max(1, min(batches, concurrency_limit, int(get_rate // gets_per_child)))
+
+  return {
+    'MaxItemsPerBatch': items_per_batch,
+    'MaxInputBytesPerBatch': min(max_batch_input_bytes, int(math.ceil(items_per_batch * json_per_item * 1.1)) + 1024),
+    'MaxConcurrency': concurrency,
+    'batches': batches,
+    'expected_child_seconds': round(predict(items_per_batch, False), 3),
+    'expected_child_seconds_p{}'.format(target_quantile): round(predict(items_per_batch), 3),
+    'expected_run_seconds': round(math.ceil(batches / concurrency) * predict(items_per_batch, False), 1),
+    'model': {
+      'overhead_seconds': round(float(coef[0]), 4),
+      'seconds_per_item': round(float(coef[1]), 6),
+      'seconds_per_mb': round(float(coef[2]) * 1024 * 1024, 4),
+      'mean_item_bytes': round(mean_bytes),
+      'p99_item_input_bytes': round(json_per_item)
+    }
+  }
+
+def observed(children, failures):
+  seconds = [c['seconds'] for c in children]
+  item_seconds = np.concatenate([np.asarray(c['item_seconds'], dtype=float) for c in children])
+  errors = {}
+  for error in failures:
+    errors[error] = errors.get(error, 0) + 1
+  return {
+    'children': len(children),
+    'failed': len(failures),
+    'errors': errors,
+    'items': sum(c['items'] for c in children),
+    'child_seconds_p50': round(float(np.percentile(seconds, 50)), 3),
+    'child_seconds_p95': round(float(np.percentile(seconds, 95)), 3),
+    'child_seconds_max': round(max(seconds), 3),
+    'item_seconds_p50': round(float(np.percentile(item_seconds, 50)), 4),
+    'item_seconds_p95': round(float(np.percentile(item_seconds, 95)), 4)
+  }
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# packages the montecarlo worker into a single executable archive that the
+# ec2/fargate hosts download and run with "python3 montecarlo.pyz activity".
+#
+# next to every source file we ship its precompiled bytecode, so the hosts
+# don't have to parse and compile the worker every time they start. the
+# bytecode is only used when the host runs the same python version as the
+# one running this script, otherwise python falls back to the sources.
+import os
+import sys
+import zipfile
+import tempfile
+import py_compile
+
+here = os.path.dirname(os.path.abspath(__file__))
+package = 'montecarlo'
+output = os.path.join(here, 'dist', package + '.pyz')
+
+# the archive's own entry point, it hands over to the package's command line
+launcher = "from montecarlo.__main__ import main\nmain()\n"
+
+# every entry gets the same timestamp so rebuilding unchanged sources gives
+# a byte-identical archive and terraform doesn't upload it again
+def write_entry(archive, arcname, data):
+  info = zipfile.ZipInfo(arcname, date_time=(1980, 1, 1, 0, 0, 0))
+  info.compress_type = zipfile.ZIP_DEFLATED
+  archive.writestr(info, data)
+
+def add_module(archive, arcname, source):
+  write_entry(archive, arcname, source)
+
+  # zipimport only looks for bytecode next to the source (module.pyc), not
+  # in __pycache__, so we compile it to that legacy location
+  with tempfile.TemporaryDirectory() as tmp:
+    src = os.path.join(tmp, 'module.py')
+    with open(src, 'w') as f:
+      f.write(source)
+    pyc = os.path.join(tmp, 'module.pyc')
+    py_compile.compile(src, cfile=pyc, dfile=arcname, doraise=True,
+                       invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+    with open(pyc, 'rb') as f:
+      write_entry(archive, arcname + 'c', f.read())
+
+def main():
+  os.makedirs(os.path.dirname(output), exist_ok=True)
+  with zipfile.ZipFile(output, 'w') as archive:
+    add_module(archive, '__main__.py', launcher)
+    for name in sorted(os.listdir(os.path.join(here, package))):
+      if name.endswith('.py'):
+        with open(os.path.join(here, package, name)) as f:
+          add_module(archive, package + '/' + name, f.read())
+  print("Packaged {} for python {}.{}".format(output, sys.version_info[0], sys.version_info[1]))
+
+if __name__ == "__main__":
+  main()